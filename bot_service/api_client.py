@@ -0,0 +1,107 @@
+import logging
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import httpx
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del pool de conexiones ---
+API_TIMEOUT = float(os.environ.get("API_TIMEOUT", "10"))
+API_CONNECT_TIMEOUT = float(os.environ.get("API_CONNECT_TIMEOUT", "5"))
+API_MAX_CONNECTIONS = int(os.environ.get("API_MAX_CONNECTIONS", "20"))
+API_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("API_MAX_KEEPALIVE_CONNECTIONS", "10"))
+API_KEEPALIVE_EXPIRY = float(os.environ.get("API_KEEPALIVE_EXPIRY", "30"))
+
+
+class APIClient:
+    """
+    Cliente asíncrono compartido para la API de Django.
+
+    Mantiene un único ``httpx.AsyncClient`` con conexiones keep-alive reutilizables,
+    un límite de conexiones simultáneas y un timeout por defecto que cada llamada
+    puede sobrescribir con ``timeout=...``. El cliente se crea de forma perezosa para
+    que quede ligado al event loop en el que corre el bot.
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str],
+        timeout: float = API_TIMEOUT,
+        connect_timeout: float = API_CONNECT_TIMEOUT,
+        max_connections: int = API_MAX_CONNECTIONS,
+        max_keepalive_connections: int = API_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry: float = API_KEEPALIVE_EXPIRY,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+    ):
+        self.base_url = base_url
+        self._timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        # (ruta, parámetros) -> (ETag, JSON) de la última respuesta validable
+        self._validated: Dict[Tuple[str, tuple], Tuple[str, Any]] = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url or "",
+                timeout=self._timeout,
+                limits=self._limits,
+                transport=self._transport,
+            )
+        return self._client
+
+    async def request(self, method: str, path: str, *, timeout: Optional[float] = None, **kwargs) -> httpx.Response:
+        """Realiza una petición reutilizando el pool. ``timeout`` sobrescribe el de por defecto."""
+        if timeout is not None:
+            kwargs["timeout"] = httpx.Timeout(timeout, connect=min(timeout, self._timeout.connect))
+        return await self.client.request(method, path, **kwargs)
+
+    async def get(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", path, **kwargs)
+
+    async def get_json(self, path: str, *, params: Optional[dict] = None, **kwargs) -> Any:
+        """
+        GET condicional: reenvía el ETag de la respuesta anterior en ``If-None-Match`` y,
+        si la API contesta 304 Not Modified, devuelve el JSON ya descargado sin volver a
+        transferirlo ni decodificarlo. Pensado para recursos consultados una y otra vez
+        (catálogo, FAQs).
+        """
+        key = (path, tuple(sorted((params or {}).items())))
+        cached = self._validated.get(key)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+        response = await self.get(path, params=params, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            METRICS.incr("api.not_modified")
+            return cached[1]
+        response.raise_for_status()
+        data = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            self._validated[key] = (etag, data)
+        else:
+            self._validated.pop(key, None)
+        return data
+
+    async def post(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", path, **kwargs)
+
+    async def delete(self, path: str, **kwargs) -> httpx.Response:
+        return await self.request("DELETE", path, **kwargs)
+
+    async def aclose(self):
+        """Cierra las conexiones abiertas del pool."""
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+            logger.info("Cliente HTTP de la API cerrado.")
+        self._client = None
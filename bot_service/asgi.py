@@ -0,0 +1,15 @@
+"""
+Punto de entrada ASGI del bot en modo webhook.
+
+Se ejecuta con un servidor ASGI, por ejemplo::
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT
+
+Requiere ``WEBHOOK_URL`` (URL pública https que apunta a ``WEBHOOK_PATH``) y
+``WEBHOOK_SECRET_TOKEN``. El modo polling sigue disponible con ``python main.py``.
+"""
+
+from main import build_application
+from webhook import create_webhook_app
+
+app = create_webhook_app(build_application())
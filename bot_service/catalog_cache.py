@@ -0,0 +1,118 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Awaitable, Callable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración de la caché ---
+CATALOG_CACHE_TTL = float(os.environ.get("CATALOG_CACHE_TTL", "60"))
+CATALOG_CACHE_STALE_TTL = float(os.environ.get("CATALOG_CACHE_STALE_TTL", "600"))
+
+
+class CachedResource:
+    """
+    Caché en memoria para un recurso de la API (catálogo, FAQs...).
+
+    - Mientras los datos tienen menos de ``ttl`` segundos se sirven desde memoria.
+    - Entre ``ttl`` y ``ttl + stale_ttl`` se sirven los datos viejos y se lanza un
+      refresco en segundo plano (stale-while-revalidate).
+    - Pasado ese tiempo, o tras ``invalidate()``, la siguiente lectura espera al refresco.
+
+    Solo hay un refresco en curso a la vez, por lo que la API recibe como mucho
+    una petición por intervalo aunque lleguen muchos mensajes simultáneos.
+    ``version`` se incrementa cada vez que el contenido cambia y ``fingerprint`` es un
+    hash del contenido, estable entre procesos y reinicios.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[], Awaitable[List[dict]]],
+        ttl: float = CATALOG_CACHE_TTL,
+        stale_ttl: float = CATALOG_CACHE_STALE_TTL,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.name = name
+        self._loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._clock = clock
+        self._data: Optional[List[dict]] = None
+        self._fetched_at = 0.0
+        self._generation = 0
+        # Se incrementa en cada invalidate(): un refresco iniciado antes no deja los datos como frescos
+        self._invalidations = 0
+        self._lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.version = 0
+        self.fingerprint = ""
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def _age(self) -> float:
+        return self._clock() - self._fetched_at
+
+    async def get(self) -> List[dict]:
+        """Devuelve los datos, refrescándolos si es necesario."""
+        if self._data is not None:
+            age = self._age()
+            if age < self.ttl:
+                self.stats["hits"] += 1
+                return self._data
+            if age < self.ttl + self.stale_ttl:
+                self.stats["stale_hits"] += 1
+                self._schedule_refresh()
+                return self._data
+        self.stats["misses"] += 1
+        return await self.refresh()
+
+    def _schedule_refresh(self):
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            # Ya se registró en refresh(); seguimos sirviendo los datos viejos.
+            logger.debug(f"Refresco en segundo plano de '{self.name}' falló: {e}")
+
+    async def refresh(self) -> List[dict]:
+        """Recarga los datos desde la API (una sola recarga concurrente)."""
+        generation = self._generation
+        async with self._lock:
+            # Otro llamador ya refrescó mientras esperábamos el lock
+            if self._data is not None and self._generation != generation and self._age() < self.ttl:
+                return self._data
+            invalidations = self._invalidations
+            try:
+                data = await self._loader()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.error(f"No se pudo refrescar la caché '{self.name}': {e}")
+                if self._data is not None:
+                    return self._data
+                raise
+            self.stats["refreshes"] += 1
+            if data != self._data:
+                self.version += 1
+                self.fingerprint = hashlib.sha1(
+                    json.dumps(data, sort_keys=True, default=str).encode("utf-8")
+                ).hexdigest()
+                logger.info(f"Caché '{self.name}' actualizada a la versión {self.version} ({len(data)} elementos).")
+            self._data = data
+            self._generation += 1
+            if self._invalidations == invalidations:
+                self._fetched_at = self._clock()
+            else:
+                # Invalidada mientras se descargaba: los datos pueden ser anteriores al cambio
+                logger.debug(f"Caché '{self.name}' invalidada durante el refresco; se volverá a descargar.")
+            return data
+
+    def invalidate(self):
+        """Marca los datos como caducados; la siguiente lectura espera al refresco."""
+        self._invalidations += 1
+        self._fetched_at = self._clock() - (self.ttl + self.stale_ttl)
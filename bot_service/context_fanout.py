@@ -0,0 +1,63 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Iterable
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ContextSource:
+    """
+    Una fuente de contexto para el prompt (FAQs, catálogo, historial, pedidos...).
+
+    ``deadline`` es el tiempo máximo en segundos que se espera a la fuente y
+    ``fallback`` el texto que se usa si falla o no llega a tiempo. Las fuentes no
+    ``required`` nunca alargan la espera: solo se usan si terminaron antes que las
+    obligatorias.
+    """
+    name: str
+    fetch: Callable[[], Awaitable[str]]
+    deadline: float
+    fallback: str
+    required: bool = True
+
+
+async def _run_with_deadline(source: ContextSource) -> str:
+    try:
+        return await asyncio.wait_for(source.fetch(), timeout=source.deadline)
+    except asyncio.TimeoutError:
+        logger.warning(f"Fuente de contexto '{source.name}' superó su plazo de {source.deadline}s. Usando valor degradado.")
+    except Exception as e:
+        logger.error(f"Fuente de contexto '{source.name}' falló: {e}. Usando valor degradado.")
+    return source.fallback
+
+
+async def gather_context(sources: Iterable[ContextSource]) -> Dict[str, str]:
+    """
+    Lanza todas las fuentes a la vez y devuelve ``{nombre: texto}``.
+
+    La espera total queda acotada por la fuente obligatoria más lenta (o su plazo),
+    no por la suma de todas.
+    """
+    sources = list(sources)
+    started = time.monotonic()
+    tasks = {s.name: asyncio.create_task(_run_with_deadline(s)) for s in sources}
+
+    required = [tasks[s.name] for s in sources if s.required]
+    if required:
+        await asyncio.wait(required)
+
+    results: Dict[str, str] = {}
+    for source in sources:
+        task = tasks[source.name]
+        if task.done():
+            results[source.name] = task.result()
+        else:
+            task.cancel()
+            logger.info(f"Fuente opcional '{source.name}' no llegó a tiempo; se omite.")
+            results[source.name] = source.fallback
+
+    logger.info(f"Contexto reunido en {time.monotonic() - started:.2f}s ({', '.join(results)}).")
+    return results
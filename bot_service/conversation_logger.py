@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from typing import List, Optional, Set
+
+import httpx
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del registro diferido de conversaciones ---
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", "1000"))
+LOG_BATCH_SIZE = int(os.environ.get("LOG_BATCH_SIZE", "100"))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", "2"))
+LOG_ENQUEUE_TIMEOUT = float(os.environ.get("LOG_ENQUEUE_TIMEOUT", "0.5"))
+LOG_SPILL_PATH = os.environ.get("LOG_SPILL_PATH", "conversation_log_spill.jsonl")
+
+BULK_MESSAGES_PATH = "/api/messages/bulk/"
+
+
+class ConversationLogger:
+    """
+    Registro diferido (write-behind) de los mensajes del bot en la API.
+
+    Los handlers solo encolan los mensajes y siguen; un worker en segundo plano los
+    agrupa y los envía en lotes al endpoint de ingesta masiva. La cola está acotada:
+    si se llena, el handler espera como mucho ``enqueue_timeout`` (backpressure) y,
+    si sigue llena, el mensaje se guarda en disco. Si la API no responde, el lote
+    también se guarda en disco y se reenvía en cuanto vuelva a estar disponible.
+    ``stop()`` vacía la cola antes de terminar.
+
+    Si recibe una ``IdentityCache``, los mensajes llevan la conversación ya conocida
+    (la API no tiene que resolverla) y la caché se rellena con lo que la API devuelve.
+    Si la API rechaza mensajes de un lote, se reenvían los demás y se olvida la
+    conversación de los rechazados, que se reintentan solo con el ``telegram_id``.
+
+    La E/S del archivo de respaldo se hace con ``asyncio.to_thread``. Un
+    ``<spill_path>.sending`` que quedó a medias (el proceso murió mientras se
+    reenviaba) se recupera en el siguiente arranque.
+    """
+
+    def __init__(
+        self,
+        client,
+        *,
+        max_queue: int = LOG_QUEUE_MAX,
+        batch_size: int = LOG_BATCH_SIZE,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        enqueue_timeout: float = LOG_ENQUEUE_TIMEOUT,
+        spill_path: str = LOG_SPILL_PATH,
+        identities=None,
+    ):
+        self.client = client
+        self.identities = identities
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.spill_path = spill_path
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue)
+        self._worker: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    # --- Productores (handlers) ---
+
+    async def log_exchange(self, user, user_text: str, bot_text: str, received_at: Optional[datetime] = None):
+        """
+        Encola el mensaje del usuario y la respuesta del bot.
+
+        El mensaje del usuario lleva ``received_at`` (cuando llegó); la respuesta, la hora actual.
+        """
+        replied_at = datetime.now(timezone.utc)
+        timestamps = {"user": (received_at or replied_at).isoformat(), "bot": replied_at.isoformat()}
+        identity = {
+            "telegram_id": str(user.id),
+            "username": user.username,
+            "first_name": user.first_name,
+            "last_name": user.last_name,
+        }
+        known = self.identities.get(user.id) if self.identities is not None else None
+        if known is not None and known.conversation_pk is not None:
+            identity["conversation"] = known.conversation_pk
+        for sender, content in (("user", user_text), ("bot", bot_text)):
+            await self._enqueue({**identity, "sender": sender, "content": content, "timestamp": timestamps[sender]})
+
+    async def _enqueue(self, record: dict):
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            METRICS.incr("conversation_log.backpressure")
+            try:
+                await asyncio.wait_for(self._queue.put(record), timeout=self.enqueue_timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Cola de registro llena; guardando el mensaje en disco.")
+                await self._spill([record])
+                return
+        METRICS.observe("conversation_log.queue_depth", self._queue.qsize())
+
+    # --- Worker ---
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._stopping = False
+            self._worker = asyncio.create_task(self._run())
+            logger.info("Registro diferido de conversaciones iniciado.")
+
+    async def stop(self):
+        """Detiene el worker enviando antes todo lo pendiente."""
+        self._stopping = True
+        if self._worker is not None:
+            await self._worker
+            self._worker = None
+        # Lo que no se pudo enviar queda en disco para el próximo arranque
+        remaining = self._drain_queue(self._queue.qsize())
+        if remaining and not await self._send(remaining):
+            await self._spill(remaining)
+        logger.info("Registro diferido de conversaciones detenido.")
+
+    async def _run(self):
+        while not self._stopping:
+            batch = await self._next_batch()
+            if batch:
+                await self.flush(batch)
+            elif await asyncio.to_thread(self._has_spilled):
+                await self._retry_spilled()
+
+    async def _next_batch(self) -> List[dict]:
+        """Espera hasta ``flush_interval`` por un lote de como mucho ``batch_size`` mensajes."""
+        batch = []
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size and not self._stopping:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout=timeout))
+            except asyncio.TimeoutError:
+                break
+            batch.extend(self._drain_queue(self.batch_size - len(batch)))
+        return batch
+
+    def _drain_queue(self, limit: int) -> List[dict]:
+        items = []
+        while len(items) < limit:
+            try:
+                items.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return items
+
+    async def flush(self, batch: List[dict]):
+        """Envía un lote; si la API no está disponible, lo guarda en disco."""
+        if await self._send(batch):
+            if await asyncio.to_thread(self._has_spilled):
+                await self._retry_spilled()
+        else:
+            await self._spill(batch)
+
+    async def _send(self, batch: List[dict]) -> bool:
+        if not batch:
+            return True
+        try:
+            response = await self.client.post(BULK_MESSAGES_PATH, json={"messages": batch})
+            if 400 <= response.status_code < 500 and response.status_code not in (404, 408, 429):
+                # Datos inválidos: reintentar el lote tal cual no sirve de nada
+                logger.error(f"La API rechazó un lote de {len(batch)} mensajes: {response.status_code} {response.text[:200]}")
+                rejected = self._rejected_indexes(response, len(batch)) or set(range(len(batch)))
+                accepted = [record for i, record in enumerate(batch) if i not in rejected]
+                await self._resend(accepted + self._retry_rejected([batch[i] for i in sorted(rejected)]))
+                return True
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error(f"No se pudo enviar el lote de {len(batch)} mensajes a la API: {e}")
+            METRICS.incr("conversation_log.failed_batches")
+            return False
+        rejected = self._rejected_indexes(response, len(batch))
+        if rejected:
+            logger.warning(f"La API rechazó {len(rejected)} de {len(batch)} mensajes del lote.")
+            await self._resend(self._retry_rejected([batch[i] for i in sorted(rejected)]))
+        if self.identities is not None:
+            try:
+                self._remember_identities(batch, response.json().get("results", []))
+            except ValueError:
+                pass
+        METRICS.incr("conversation_log.sent", len(batch) - len(rejected))
+        METRICS.incr("conversation_log.batches")
+        return True
+
+    @staticmethod
+    def _rejected_indexes(response, size: int) -> Set[int]:
+        """Índices de los mensajes que la API rechazó (``errors``), o todos si no los detalla."""
+        try:
+            body = response.json()
+            errors = body.get("errors") if isinstance(body, dict) else None
+        except ValueError:
+            errors = None
+        if errors is None:
+            return set() if response.is_success else set(range(size))
+        return {error["index"] for error in errors if isinstance(error.get("index"), int) and 0 <= error["index"] < size}
+
+    async def _resend(self, records: List[dict]):
+        if records and not await self._send(records):
+            await self._spill(records)
+
+    def _retry_rejected(self, rejected: List[dict]) -> List[dict]:
+        """
+        De los mensajes rechazados, devuelve los que merece la pena reintentar: los que
+        llevaban una conversación (probablemente obsoleta) van solo con el ``telegram_id``
+        y esa conversación se olvida en la caché. El resto se descarta.
+        """
+        retry = []
+        for record in rejected:
+            if "conversation" in record and "telegram_id" in record:
+                if self.identities is not None:
+                    self.identities.forget_conversation(record["telegram_id"])
+                retry.append({key: value for key, value in record.items() if key != "conversation"})
+        if len(retry) < len(rejected):
+            METRICS.incr("conversation_log.rejected", len(rejected) - len(retry))
+        return retry
+
+    def _remember_identities(self, batch: List[dict], results: List[dict]):
+        for result in results:
+            index = result.get("index")
+            if index is None or not 0 <= index < len(batch) or "telegram_id" not in batch[index]:
+                continue
+            record = batch[index]
+            if record.get("conversation") not in (None, result["conversation"]):
+                # La conversación enviada ya no existía y la API usó otra: se reemplaza
+                self.identities.remember(record["telegram_id"], result["user"], result["conversation"])
+            else:
+                self.identities.fill(record["telegram_id"], result["user"], result["conversation"])
+
+    # --- Persistencia en disco ---
+
+    @property
+    def _sending_path(self) -> str:
+        return f"{self.spill_path}.sending"
+
+    def _has_spilled(self) -> bool:
+        return os.path.exists(self.spill_path) or os.path.exists(self._sending_path)
+
+    async def _spill(self, records: List[dict]):
+        await asyncio.to_thread(self._write_spill, records)
+
+    def _write_spill(self, records: List[dict]):
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            METRICS.incr("conversation_log.spilled", len(records))
+        except OSError as e:
+            logger.error(f"No se pudieron guardar {len(records)} mensajes en disco: {e}")
+            METRICS.incr("conversation_log.dropped", len(records))
+
+    def _take_spilled(self) -> Optional[List[dict]]:
+        """
+        Pasa el archivo de respaldo a ``.sending`` y devuelve sus mensajes. Si ya había
+        un ``.sending`` (el proceso murió mientras lo reenviaba), se devuelve ese primero.
+        """
+        if not os.path.exists(self._sending_path):
+            try:
+                os.replace(self.spill_path, self._sending_path)
+            except FileNotFoundError:
+                return None
+        else:
+            logger.info("Recuperando mensajes de un reenvío interrumpido.")
+        records = []
+        with open(self._sending_path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Línea a medio escribir por una caída
+                    METRICS.incr("conversation_log.dropped")
+        return records
+
+    async def _retry_spilled(self):
+        """Reenvía lo guardado en disco; si vuelve a fallar, se conserva para más tarde."""
+        records = await asyncio.to_thread(self._take_spilled)
+        if records is None:
+            return
+        for start in range(0, len(records), self.batch_size):
+            chunk = records[start:start + self.batch_size]
+            if not await self._send(chunk):
+                await self._spill(records[start:])
+                break
+        else:
+            logger.info(f"Reenviados {len(records)} mensajes guardados en disco.")
+        await asyncio.to_thread(os.remove, self._sending_path)
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional, Set
+
+import httpx
+
+from llm import generate_text
+from llm_scheduler import LLM_EXPECTED_OUTPUT_TOKENS, ModelOverloaded, Priority
+from metrics import METRICS
+from retrieval import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración de la memoria de conversación ---
+# Mensajes recientes que se pasan literalmente al prompt
+HISTORY_TAIL_MESSAGES = int(os.environ.get("HISTORY_TAIL_MESSAGES", "6"))
+# Cada cuántos mensajes fuera de la cola reciente se actualiza el resumen
+SUMMARY_EVERY_MESSAGES = int(os.environ.get("SUMMARY_EVERY_MESSAGES", "8"))
+SUMMARY_MAX_WORDS = int(os.environ.get("SUMMARY_MAX_WORDS", "120"))
+
+NO_HISTORY_TEXT = "No hay historial previo."
+
+
+def format_messages(messages: List[dict]) -> str:
+    lines = []
+    for msg in messages:
+        sender = "Usuario" if msg['sender'] == 'user' else "Asistente"
+        # Limpiamos el texto para evitar problemas con markdown o caracteres especiales
+        lines.append(f"{sender}: {msg['content'].strip()}")
+    return "\n".join(lines)
+
+
+class ConversationMemory:
+    """
+    Historial para el prompt con tamaño casi constante: un resumen acumulado de
+    la conversación más los mensajes que aún no cubre, literales.
+
+    La memoria llega de ``/api/bot-context/``: ``tail`` (últimos mensajes) y
+    ``pending`` (los anteriores sin resumir). Cuando hay ``summarize_every`` pendientes
+    o más se condensan en segundo plano junto con el resumen anterior y el nuevo
+    resumen se guarda en la API; la respuesta actual no espera a que termine y lleva
+    los ``summarize_every`` pendientes más recientes, así el prompt no pierde turnos
+    pero tampoco crece si el resumen se retrasa.
+    """
+
+    def __init__(
+        self,
+        client,
+        model,
+        *,
+        tail: int = HISTORY_TAIL_MESSAGES,
+        summarize_every: int = SUMMARY_EVERY_MESSAGES,
+        max_words: int = SUMMARY_MAX_WORDS,
+        scheduler=None,
+    ):
+        self.client = client
+        self.model = model
+        self.tail = tail
+        self.summarize_every = summarize_every
+        self.max_words = max_words
+        self.scheduler = scheduler
+        self._summarizing: Set[int] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def render(self, conversation_pk: int, memory: dict) -> str:
+        """Formatea la memoria que devolvió la API y, si toca, lanza la actualización del resumen."""
+        pending = memory.get("pending", [])
+        if self.model is not None and len(pending) >= self.summarize_every:
+            self._schedule_summary(conversation_pk, memory["summary"], memory["summary_until"], pending)
+
+        parts = []
+        if memory.get("summary"):
+            parts.append(f"Resumen de la conversación anterior: {memory['summary']}")
+        shown = pending[-self.summarize_every:] if self.summarize_every > 0 else []
+        if len(pending) > len(shown):
+            parts.append(f"({len(pending) - len(shown)} mensajes anteriores pendientes de resumir)")
+        recent = format_messages(shown + memory.get("tail", []))
+        if recent:
+            parts.append(recent)
+        return "\n\n".join(parts) or NO_HISTORY_TEXT
+
+    def _schedule_summary(self, conversation_pk: int, summary: str, summary_until: Optional[int], pending: List[dict]):
+        if conversation_pk in self._summarizing:
+            return
+        self._summarizing.add(conversation_pk)
+        task = asyncio.create_task(self.summarize(conversation_pk, summary, summary_until, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda _: self._summarizing.discard(conversation_pk))
+
+    def summary_prompt(self, summary: str, pending: List[dict]) -> str:
+        return (
+            "Eres el asistente de compras de TechRetail. Actualiza el resumen de la conversación con un cliente. "
+            f"Escribe como máximo {self.max_words} palabras, en español y en tercera persona. "
+            "Conserva lo útil para seguir atendiéndolo: productos que le interesan o se le recomendaron (con su ID), "
+            "preferencias, presupuesto, pedidos o reservas mencionados y preguntas pendientes. "
+            "Omite saludos y detalles sin importancia. Responde solo con el resumen.\n\n"
+            f"Resumen actual:\n{summary or '(vacío)'}\n\n"
+            f"Mensajes nuevos:\n{format_messages(pending)}"
+        )
+
+    async def summarize(self, conversation_pk: int, summary: str, summary_until: Optional[int],
+                        pending: List[dict]) -> Optional[str]:
+        """Condensa ``pending`` en el resumen y lo guarda; devuelve el nuevo resumen o ``None``."""
+        prompt = self.summary_prompt(summary, pending)
+        try:
+            if self.scheduler is not None:
+                async with self.scheduler.slot(Priority.LOW, estimate_tokens(prompt) + LLM_EXPECTED_OUTPUT_TOKENS):
+                    new_summary = await generate_text(self.model, prompt)
+            else:
+                new_summary = await generate_text(self.model, prompt)
+        except ModelOverloaded:
+            # Se reintentará con el próximo mensaje
+            METRICS.incr("conversation_memory.deferred")
+            return None
+        except Exception as e:
+            logger.error(f"No se pudo resumir la conversación {conversation_pk}: {e}")
+            METRICS.incr("conversation_memory.failed")
+            return None
+
+        new_summary = new_summary.strip()
+        if not new_summary:
+            return None
+        try:
+            response = await self.client.post(
+                f"/api/conversations/{conversation_pk}/summary/",
+                json={"summary": new_summary, "until": pending[-1]["id"], "previous_until": summary_until},
+            )
+            if response.status_code == 409:
+                # Otro worker actualizó el resumen mientras tanto
+                METRICS.incr("conversation_memory.conflicts")
+                return None
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error(f"No se pudo guardar el resumen de la conversación {conversation_pk}: {e}")
+            METRICS.incr("conversation_memory.failed")
+            return None
+        METRICS.incr("conversation_memory.summaries")
+        METRICS.observe("conversation_memory.summarized_messages", len(pending))
+        logger.info(f"Resumen de la conversación {conversation_pk} actualizado ({len(pending)} mensajes condensados).")
+        return new_summary
+
+    async def wait_idle(self):
+        """Espera a los resúmenes en curso (al detener el bot)."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
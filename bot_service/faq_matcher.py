@@ -0,0 +1,83 @@
+import os
+import re
+from difflib import SequenceMatcher
+from typing import Dict, List, Optional, Tuple
+
+from retrieval import fold_accents, tokenize
+
+# Puntuación mínima (0-1) para responder directamente con la FAQ sin pasar por el modelo
+FAQ_MATCH_THRESHOLD = float(os.environ.get("FAQ_MATCH_THRESHOLD", "0.82"))
+# Diferencia mínima con la segunda mejor FAQ; por debajo la pregunta se considera ambigua
+FAQ_MATCH_MARGIN = float(os.environ.get("FAQ_MATCH_MARGIN", "0.08"))
+
+_PUNCTUATION_RE = re.compile(r"[^a-z0-9 ]+")
+_SPACES_RE = re.compile(r"\s+")
+
+
+def normalize_question(text: str) -> str:
+    """Minúsculas, sin tildes ni signos de puntuación y con espacios simples."""
+    text = _PUNCTUATION_RE.sub(" ", fold_accents(text))
+    return _SPACES_RE.sub(" ", text).strip()
+
+
+def similarity(query: str, question: str) -> float:
+    """
+    Puntuación 0-1 entre dos preguntas ya normalizadas.
+
+    Combina la similitud de caracteres (tolera erratas) con el solapamiento de
+    palabras significativas (tolera cambios de orden y palabras vacías).
+    """
+    if not query or not question:
+        return 0.0
+    if query == question:
+        return 1.0
+    char_score = SequenceMatcher(None, query, question).ratio()
+    query_terms, question_terms = set(tokenize(query)), set(tokenize(question))
+    if query_terms and question_terms:
+        common = len(query_terms & question_terms)
+        precision = common / len(query_terms)
+        recall = common / len(question_terms)
+        token_score = 2 * precision * recall / (precision + recall) if common else 0.0
+    else:
+        token_score = 0.0
+    return 0.5 * char_score + 0.5 * token_score
+
+
+class FAQMatcher:
+    """Encuentra la FAQ cuya pregunta coincide (casi) literalmente con la del usuario."""
+
+    def __init__(self, threshold: float = FAQ_MATCH_THRESHOLD, margin: float = FAQ_MATCH_MARGIN):
+        self.threshold = threshold
+        self.margin = margin
+        # Preguntas normalizadas de la última lista de FAQs; se rehace cuando la caché
+        # entrega una lista nueva, así nunca crece más allá de las FAQs vigentes
+        self._source: Optional[List[dict]] = None
+        self._normalized: Dict[str, str] = {}
+
+    def _normalized_questions(self, faqs: List[dict]) -> Dict[str, str]:
+        if faqs is not self._source:
+            self._normalized = {faq["question"]: normalize_question(faq["question"]) for faq in faqs}
+            self._source = faqs
+        return self._normalized
+
+    def rank(self, user_question: str, faqs: List[dict]) -> List[Tuple[float, dict]]:
+        query = normalize_question(user_question)
+        normalized = self._normalized_questions(faqs)
+        scored = [(similarity(query, normalized[faq["question"]]), faq) for faq in faqs]
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored
+
+    def match(self, user_question: str, faqs: List[dict]) -> Optional[Tuple[dict, float]]:
+        """
+        Devuelve ``(faq, puntuación)`` si hay una coincidencia clara, o ``None`` si la
+        pregunta no supera el umbral o es ambigua entre varias FAQs.
+        """
+        ranked = self.rank(user_question, faqs)
+        if not ranked:
+            return None
+        best_score, best = ranked[0]
+        if best_score < self.threshold:
+            return None
+        if len(ranked) > 1 and best_score < 1.0 and best_score - ranked[1][0] < self.margin:
+            return None
+        return best, best_score
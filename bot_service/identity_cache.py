@@ -0,0 +1,86 @@
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional
+
+from metrics import METRICS
+
+IDENTITY_CACHE_MAX_ENTRIES = int(os.environ.get("IDENTITY_CACHE_MAX_ENTRIES", "10000"))
+
+
+@dataclass(frozen=True)
+class Identity:
+    """Claves de la API para un usuario de Telegram."""
+    user_pk: int
+    conversation_pk: Optional[int] = None
+
+
+class IdentityCache:
+    """
+    Mapa LRU acotado ``telegram_id -> Identity``.
+
+    Se rellena cuando la API crea registros o en la primera búsqueda, y se olvida
+    la conversación cuando ``/start`` abre una nueva o la API la rechaza por no
+    existir. En régimen estable identificar a un usuario no cuesta ninguna llamada
+    de red.
+    """
+
+    def __init__(self, max_entries: int = IDENTITY_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Identity]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, telegram_id) -> Optional[Identity]:
+        key = str(telegram_id)
+        with self._lock:
+            identity = self._entries.get(key)
+            if identity is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+        METRICS.incr("identity_cache.misses" if identity is None else "identity_cache.hits")
+        return identity
+
+    def remember(self, telegram_id, user_pk: int, conversation_pk: Optional[int] = None):
+        """Guarda la identidad; si no se indica conversación se conserva la conocida."""
+        key = str(telegram_id)
+        with self._lock:
+            current = self._entries.get(key)
+            if conversation_pk is None and current is not None and current.user_pk == user_pk:
+                conversation_pk = current.conversation_pk
+            self._entries[key] = Identity(user_pk, conversation_pk)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def fill(self, telegram_id, user_pk: int, conversation_pk: Optional[int]):
+        """Como ``remember`` pero sin pisar una conversación ya conocida (datos que llegan tarde)."""
+        key = str(telegram_id)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None and current.user_pk == user_pk and current.conversation_pk is not None:
+                return
+            self._entries[key] = Identity(user_pk, conversation_pk)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget_conversation(self, telegram_id):
+        """La conversación activa cambió (p. ej. ``/start``): se conserva solo el usuario."""
+        key = str(telegram_id)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is not None:
+                self._entries[key] = Identity(current.user_pk, None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,128 @@
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+from faq_matcher import normalize_question
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Archivo con las intenciones; se puede cambiar sin tocar el código. Una ruta relativa
+# se toma respecto a esta carpeta, no al directorio desde el que se arranca el bot
+INTENTS_PATH = os.environ.get("INTENTS_PATH", "intents.json")
+# "file" usa INTENTS_PATH; "api" carga las intenciones activas de la API (editables en el admin)
+INTENTS_SOURCE = os.environ.get("INTENTS_SOURCE", "file")
+INTENTS_API_PATH = "/api/intents/"
+INTENTS_FETCH_LIMIT = 100
+
+
+@dataclass
+class Intent:
+    """
+    Intención reconocible por frases clave.
+
+    Si tiene ``response`` el bot contesta con ese texto sin llamar al modelo; si tiene
+    ``action`` la atiende un handler del código. Con varias coincidencias gana la de
+    menor ``priority``.
+    """
+    name: str
+    phrases: List[str]
+    priority: int = 100
+    response: Optional[str] = None
+    action: Optional[str] = None
+
+
+@dataclass
+class IntentMatch:
+    intent: Intent
+    phrase: str
+    # Todas las intenciones encontradas en el mensaje, por prioridad
+    matched: List[str] = field(default_factory=list)
+
+    @property
+    def name(self) -> str:
+        return self.intent.name
+
+
+class IntentRouter:
+    """
+    Reconoce intenciones con una única expresión regular que reúne todas las frases.
+
+    Frases y mensajes se normalizan igual (minúsculas, sin tildes ni signos), así que
+    "qué reservé" y "QUE RESERVE" coinciden, y el mensaje se recorre una sola vez sea
+    cual sea el número de frases. Una frase tiene que empezar una palabra, pero la
+    última palabra puede seguir (plurales y flexiones): "cancelar reserva" reconoce
+    "cancelar reservas" y "razón", "razones", como hacía la búsqueda por subcadenas.
+    """
+
+    def __init__(self, intents: Iterable[Intent]):
+        self.set_intents(intents)
+
+    def set_intents(self, intents: Iterable[Intent]):
+        """Reemplaza las intenciones (p. ej. al cargarlas de la API tras arrancar)."""
+        self.intents: Dict[str, Intent] = {}
+        self._phrase_intent: Dict[str, Intent] = {}
+        for intent in sorted(intents, key=lambda i: i.priority):
+            self.intents[intent.name] = intent
+            for phrase in intent.phrases:
+                normalized = normalize_question(phrase)
+                if normalized:
+                    # Si dos intenciones comparten frase, se queda la más prioritaria
+                    self._phrase_intent.setdefault(normalized, intent)
+        # Las frases largas primero para que "que tengo reservado" gane a "reservado"
+        alternatives = sorted(self._phrase_intent, key=len, reverse=True)
+        self._pattern = (
+            re.compile(r"(?<![a-z0-9])(" + "|".join(re.escape(p) for p in alternatives) + r")[a-z0-9]*")
+            if alternatives else None
+        )
+
+    @classmethod
+    def from_records(cls, records: Iterable[dict]) -> "IntentRouter":
+        """Crea el router a partir de diccionarios (archivo JSON o respuesta de la API)."""
+        return cls(
+            Intent(
+                name=r["name"],
+                phrases=list(r.get("phrases", [])),
+                priority=int(r.get("priority", 100)),
+                # La API devuelve cadenas vacías para los campos sin valor
+                response=r.get("response") or None,
+                action=r.get("action") or None,
+            )
+            for r in records
+        )
+
+    @classmethod
+    def from_file(cls, path: str = INTENTS_PATH) -> "IntentRouter":
+        path = os.path.join(BASE_DIR, path)  # sin efecto si la ruta ya es absoluta
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        router = cls.from_records(data.get("intents", []) if isinstance(data, dict) else data)
+        logger.info(f"Cargadas {len(router.intents)} intenciones desde {path}.")
+        return router
+
+    @classmethod
+    async def from_api(cls, client, path: str = INTENTS_API_PATH) -> "IntentRouter":
+        """Crea el router con las intenciones activas de la API (``client`` es un ``APIClient``)."""
+        data = await client.get_json(path, params={"is_active": "true", "limit": INTENTS_FETCH_LIMIT})
+        router = cls.from_records(data.get("results", []) if isinstance(data, dict) else data)
+        logger.info(f"Cargadas {len(router.intents)} intenciones desde la API.")
+        return router
+
+    def route(self, text: str) -> Optional[IntentMatch]:
+        """Devuelve la intención más prioritaria presente en ``text`` o ``None``."""
+        found: Dict[str, str] = {}
+        if self._pattern is not None:
+            for m in self._pattern.finditer(normalize_question(text)):
+                intent = self._phrase_intent[m.group(1)]
+                found.setdefault(intent.name, m.group(1))
+        if not found:
+            METRICS.incr("intent.none")
+            return None
+        names = sorted(found, key=lambda name: self.intents[name].priority)
+        best = self.intents[names[0]]
+        METRICS.incr(f"intent.{best.name}")
+        return IntentMatch(best, found[best.name], names)
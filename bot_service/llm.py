@@ -0,0 +1,135 @@
+import inspect
+import logging
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from telegram.error import BadRequest
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# Telegram limita las ediciones por chat; una edición cada ~1s es lo seguro
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+# Longitud máxima de un mensaje de Telegram
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
+
+async def stream_text(model, prompt: str) -> AsyncIterator[str]:
+    """
+    Genera la respuesta del modelo en fragmentos, sin bloquear el event loop.
+
+    Funciona con ``genai.GenerativeModel`` y con cualquier objeto que implemente
+    ``generate_content_async(prompt, stream=True)`` devolviendo un iterable
+    asíncrono de fragmentos con atributo ``text`` (p. ej. un modelo falso en tests).
+    """
+    started = time.monotonic()
+    first = True
+    response = await model.generate_content_async(prompt, stream=True)
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            # Fragmento sin texto (bloqueado por seguridad o vacío)
+            continue
+        if not text:
+            continue
+        if first:
+            METRICS.observe("llm.time_to_first_token", time.monotonic() - started)
+            first = False
+        yield text
+    METRICS.observe("llm.generation_seconds", time.monotonic() - started)
+
+
+async def generate_text(model, prompt: str) -> str:
+    """Genera la respuesta completa del modelo de forma asíncrona."""
+    return "".join([part async for part in stream_text(model, prompt)])
+
+
+async def stream_reply(
+    bot,
+    chat_id: int,
+    chunks: AsyncIterator[str],
+    *,
+    started_at: Optional[float] = None,
+    edit_interval: float = STREAM_EDIT_INTERVAL,
+    clock: Callable[[], float] = time.monotonic,
+    on_complete: Optional[Callable[[str], Optional[Awaitable[None]]]] = None,
+) -> str:
+    """
+    Envía la respuesta a Telegram a medida que llega.
+
+    El primer fragmento se envía como mensaje nuevo y el resto se va añadiendo
+    editando ese mensaje, como mucho una vez cada ``edit_interval`` segundos. Si el
+    texto supera el límite de Telegram se continúa en un mensaje nuevo.
+    Devuelve el texto completo enviado.
+
+    Si la generación falla antes de mostrar nada, la excepción se propaga para que
+    el handler envíe su mensaje de error; si ya se mostró texto, se conserva lo enviado.
+    ``on_complete`` solo se llama con el texto si la generación terminó sin errores;
+    si devuelve un awaitable se espera.
+    """
+    started_at = clock() if started_at is None else started_at
+    full_text = ""
+    message = None
+    message_offset = 0  # Posición en full_text donde empieza el mensaje actual
+    shown_text = ""
+    last_edit = 0.0
+
+    async def _show(final: bool = False):
+        nonlocal message, message_offset, shown_text, last_edit
+        while True:
+            pending = full_text[message_offset:]
+            if message is not None and len(pending) > TELEGRAM_MAX_MESSAGE_LENGTH:
+                # Cerramos el mensaje actual y seguimos en uno nuevo
+                head = pending[:TELEGRAM_MAX_MESSAGE_LENGTH]
+                if head != shown_text:
+                    await _edit(head)
+                message_offset += len(head)
+                message = None
+                shown_text = ""
+                continue
+            pending = pending[:TELEGRAM_MAX_MESSAGE_LENGTH]
+            if not pending.strip() or pending == shown_text:
+                return
+            if message is None:
+                message = await bot.send_message(chat_id=chat_id, text=pending, parse_mode=None)
+                if message_offset == 0:
+                    METRICS.observe("reply.time_to_first_visible", clock() - started_at)
+            elif final or clock() - last_edit >= edit_interval:
+                await _edit(pending)
+            else:
+                return
+            shown_text = pending
+            last_edit = clock()
+            if message_offset + len(pending) >= len(full_text):
+                return
+
+    async def _edit(text: str):
+        try:
+            await bot.edit_message_text(chat_id=chat_id, message_id=message.message_id, text=text, parse_mode=None)
+            METRICS.incr("reply.edits")
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    completed = False
+    try:
+        async for part in chunks:
+            full_text += part
+            await _show()
+        completed = True
+    except Exception as e:
+        if message is None and message_offset == 0:
+            raise
+        logger.error(f"La generación se interrumpió tras mostrar texto parcial: {e}")
+    await _show(final=True)
+    if message is None and message_offset == 0:
+        raise ValueError("El modelo no devolvió texto.")
+    METRICS.observe("reply.total_seconds", clock() - started_at)
+    if completed and on_complete is not None:
+        result = on_complete(full_text)
+        if inspect.isawaitable(result):
+            await result
+    return full_text
@@ -0,0 +1,215 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from typing import Callable, Dict, List, Optional
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del planificador de llamadas al modelo ---
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", "4"))
+LLM_REQUESTS_PER_MINUTE = float(os.environ.get("LLM_REQUESTS_PER_MINUTE", "15"))
+LLM_TOKENS_PER_MINUTE = float(os.environ.get("LLM_TOKENS_PER_MINUTE", "1000000"))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", "50"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "20"))
+# Tokens de salida que se reservan por llamada además de los del prompt
+LLM_EXPECTED_OUTPUT_TOKENS = int(os.environ.get("LLM_EXPECTED_OUTPUT_TOKENS", "400"))
+
+
+class Priority(IntEnum):
+    """Clases de prioridad; un valor menor se atiende antes."""
+    HIGH = 0     # /ayuda
+    NORMAL = 1   # texto libre
+    LOW = 2      # /recomendar
+
+
+class ModelOverloaded(Exception):
+    """La llamada se descartó (cola llena o demasiada espera) para proteger la cuota del modelo."""
+
+
+class TokenBucket:
+    """
+    Cubo de fichas que se rellena a ``rate_per_minute`` por minuto hasta ``capacity``.
+
+    ``wait_time(amount)`` dice cuánto falta para poder gastar ``amount`` fichas y
+    ``consume(amount)`` las gasta. Una petición mayor que la capacidad se limita a la
+    capacidad, para que no quede bloqueada para siempre.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated_at = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        missing = min(amount, self.capacity) - self._tokens
+        if missing <= 0:
+            return 0.0
+        return missing / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self, amount: float):
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+
+    @property
+    def available(self) -> float:
+        self._refill()
+        return self._tokens
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "future", "queued_at")
+
+    def __init__(self, priority: Priority, seq: int, tokens: int, future: asyncio.Future, queued_at: float):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.future = future
+        self.queued_at = queued_at
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class LLMScheduler:
+    """
+    Regula las llamadas al modelo: como mucho ``max_concurrent`` en curso y sin
+    pasar de ``requests_per_minute`` ni de ``tokens_per_minute``.
+
+    Las llamadas que no pueden empezar esperan en una cola por prioridad (dentro de
+    la misma prioridad, por orden de llegada). Con la cola llena se descarta primero
+    el trabajo de menor prioridad, y nadie espera más de ``queue_timeout`` segundos:
+    en ambos casos la llamada recibe ``ModelOverloaded`` y el handler responde sin modelo.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrent: int = LLM_MAX_CONCURRENT,
+        requests_per_minute: float = LLM_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = LLM_TOKENS_PER_MINUTE,
+        max_queue: int = LLM_MAX_QUEUE,
+        queue_timeout: float = LLM_QUEUE_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._clock = clock
+        self._requests = TokenBucket(requests_per_minute, clock=clock)
+        self._tokens = TokenBucket(tokens_per_minute, clock=clock)
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._wakeup: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    def queued(self) -> Dict[str, int]:
+        counts = {p.name.lower(): 0 for p in Priority}
+        for waiter in self._queue:
+            if not waiter.future.done():
+                counts[waiter.priority.name.lower()] += 1
+        return counts
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.NORMAL, tokens: int = 0):
+        """Espera turno para una llamada de ``tokens`` fichas estimadas y lo libera al salir."""
+        await self.acquire(priority, tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority: Priority = Priority.NORMAL, tokens: int = 0):
+        loop = asyncio.get_running_loop()
+        label = priority.name.lower()
+        waiter = _Waiter(priority, next(self._seq), tokens, loop.create_future(), self._clock())
+        self._discard_done()
+        if len(self._queue) >= self.max_queue:
+            self._shed_for(waiter)
+        heapq.heappush(self._queue, waiter)
+        self._pump()
+
+        timeout = loop.call_later(self.queue_timeout, self._expire, waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                # Se concedió el turno justo cuando el handler fue cancelado
+                self.release()
+            raise
+        finally:
+            timeout.cancel()
+        METRICS.observe(f"llm_scheduler.queue_seconds.{label}", self._clock() - waiter.queued_at)
+
+    def release(self):
+        self._in_flight -= 1
+        self._pump()
+
+    # --- Internos ---
+
+    def _discard_done(self):
+        if any(w.future.done() for w in self._queue):
+            self._queue = [w for w in self._queue if not w.future.done()]
+            heapq.heapify(self._queue)
+
+    def _shed_for(self, newcomer: _Waiter):
+        """Cola llena: se descarta el último en llegar de la peor prioridad (puede ser el recién llegado)."""
+        worst = max(self._queue, key=lambda w: (w.priority, w.seq))
+        if newcomer.priority >= worst.priority:
+            METRICS.incr(f"llm_scheduler.shed.{newcomer.priority.name.lower()}")
+            raise ModelOverloaded("Hay demasiadas consultas al modelo en cola.")
+        self._reject(worst, "desplazada por una consulta más prioritaria")
+        self._queue.remove(worst)
+        heapq.heapify(self._queue)
+
+    def _reject(self, waiter: _Waiter, reason: str):
+        METRICS.incr(f"llm_scheduler.shed.{waiter.priority.name.lower()}")
+        logger.warning(f"Llamada al modelo descartada ({waiter.priority.name.lower()}): {reason}.")
+        if not waiter.future.done():
+            waiter.future.set_exception(ModelOverloaded("El modelo está saturado en este momento."))
+
+    def _expire(self, waiter: _Waiter):
+        if not waiter.future.done():
+            self._reject(waiter, f"más de {self.queue_timeout:.0f}s en cola")
+            self._pump()
+
+    def _pump(self):
+        """Da turno a los primeros de la cola mientras haya hueco y cuota."""
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        while self._queue and self._in_flight < self.max_concurrent:
+            head = self._queue[0]
+            if head.future.done():
+                heapq.heappop(self._queue)
+                continue
+            wait = max(self._requests.wait_time(1), self._tokens.wait_time(head.tokens))
+            if wait > 0:
+                # Sin cuota: se vuelve a intentar cuando el cubo se haya rellenado
+                self._wakeup = asyncio.get_running_loop().call_later(wait, self._pump)
+                return
+            heapq.heappop(self._queue)
+            self._requests.consume(1)
+            self._tokens.consume(head.tokens)
+            self._in_flight += 1
+            head.future.set_result(None)
+        METRICS.observe("llm_scheduler.in_flight", self._in_flight)
@@ -1,6 +1,10 @@
 import logging
 import os
-import requests
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+import httpx
 import google.generativeai as genai
 
 from telegram import Update
@@ -15,6 +19,23 @@ from telegram.ext import (
     Defaults,
 )
 
+from api_client import APIClient
+from catalog_cache import CachedResource
+from context_fanout import ContextSource, gather_context
+from llm import TELEGRAM_MAX_MESSAGE_LENGTH, stream_reply, stream_text
+from llm_scheduler import LLM_EXPECTED_OUTPUT_TOKENS, LLMScheduler, ModelOverloaded, Priority
+from retrieval import KnowledgeRetriever, estimate_tokens
+from faq_matcher import FAQMatcher, normalize_question
+from metrics import METRICS, MetricsReporter
+from prompt_builder import DROP, KEEP_HEAD, KEEP_TAIL, PromptBuilder
+from response_cache import build_response_cache, make_key
+from conversation_logger import ConversationLogger
+from conversation_memory import HISTORY_TAIL_MESSAGES, NO_HISTORY_TEXT, ConversationMemory
+from identity_cache import IdentityCache
+from intent_router import INTENTS_SOURCE, IntentRouter
+from state_store import BotState, build_state_store
+from update_processor import PerChatUpdateProcessor
+
 # --- Configuración de Logging ---
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
@@ -25,6 +46,23 @@ logger = logging.getLogger(__name__)
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 API_BASE_URL = os.environ.get("API_BASE_URL")  # La URL de tu API en Render
+CATALOG_FETCH_LIMIT = int(os.environ.get("CATALOG_FETCH_LIMIT", "100"))
+
+# Recuperación local: cuántos productos/FAQs entran en el prompt y su presupuesto en tokens
+RETRIEVAL_TOP_K_PRODUCTS = int(os.environ.get("RETRIEVAL_TOP_K_PRODUCTS", "8"))
+RETRIEVAL_TOP_K_FAQS = int(os.environ.get("RETRIEVAL_TOP_K_FAQS", "4"))
+RETRIEVAL_BUDGET_PRODUCTS = int(os.environ.get("RETRIEVAL_BUDGET_PRODUCTS", "400"))
+RETRIEVAL_BUDGET_FAQS = int(os.environ.get("RETRIEVAL_BUDGET_FAQS", "500"))
+# Vigencia (s) de la lista numerada de /cancelar
+CANCEL_MAP_TTL = float(os.environ.get("CANCEL_MAP_TTL", "900"))
+
+# Plazo máximo (segundos) de cada fuente de contexto del prompt de texto libre
+CONTEXT_DEADLINES = {
+    "faqs": float(os.environ.get("CONTEXT_DEADLINE_FAQS", "3")),
+    "products": float(os.environ.get("CONTEXT_DEADLINE_PRODUCTS", "3")),
+    "history": float(os.environ.get("CONTEXT_DEADLINE_HISTORY", "4")),
+    "orders": float(os.environ.get("CONTEXT_DEADLINE_ORDERS", "2")),
+}
 
 # --- Configuración de APIs ---
 if GEMINI_API_KEY:
@@ -34,43 +72,118 @@ else:
     GEMINI_MODEL = None
     logger.warning("GEMINI_API_KEY no encontrada. Las funciones de IA estarán deshabilitadas.")
 
+# Cliente HTTP compartido (pool keep-alive) para todas las llamadas a la API de Django
+API_CLIENT = APIClient(API_BASE_URL)
+
 # --- Funciones de Ayuda (interactúan con la API de Render) ---
 
-def get_products_from_api(limit: int = 50) -> str:
-    """Obtiene la lista de productos desde la API de Render."""
+async def _load_products() -> list:
+    """Descarga el catálogo completo desde la API (lo usa la caché)."""
+    # Si el catálogo no cambió, la API responde 304 y se reutiliza la descarga anterior
+    data = await API_CLIENT.get_json("/api/products/", params={"limit": CATALOG_FETCH_LIMIT})
+    # La API de Django REST Framework con paginación devuelve los datos en la clave 'results'
+    return data.get('results', [])
+
+async def _load_faqs() -> list:
+    """Descarga todas las FAQs desde la API (lo usa la caché)."""
+    # Usamos un límite alto para traer todas las FAQs, asumiendo que no serán miles.
+    data = await API_CLIENT.get_json("/api/faqs/", params={"limit": CATALOG_FETCH_LIMIT})
+    return data.get('results', [])
+
+# Catálogo y FAQs se sirven desde memoria y se refrescan como mucho una vez por TTL
+PRODUCTS_CACHE = CachedResource("products", _load_products)
+FAQS_CACHE = CachedResource("faqs", _load_faqs)
+
+# Índices de búsqueda locales sobre las cachés: el prompt solo lleva lo relevante
+KNOWLEDGE = KnowledgeRetriever(PRODUCTS_CACHE, FAQS_CACHE)
+FAQ_MATCHER = FAQMatcher()
+INTENT_ROUTER = IntentRouter.from_file()
+
+# Caché de respuestas del modelo. Sube la versión de una plantilla al cambiar su prompt.
+RESPONSE_CACHE = build_response_cache()
+PROMPT_VERSIONS = {"ayuda": 1, "recomendar": 1, "texto": 1}
+
+# Limita concurrencia y cuota de Gemini; ante saturación se descarta antes lo menos prioritario
+MODEL_SCHEDULER = LLMScheduler()
+MODEL_BUSY_TEXT = "⏳ Estoy atendiendo muchas consultas en este momento. Por favor, intenta de nuevo en unos minutos."
+
+# telegram_id -> (pk de usuario, pk de conversación activa) para no preguntarlo en cada mensaje
+IDENTITIES = IdentityCache()
+
+# Últimas versiones de catálogo/FAQs informadas por la API (para invalidar las cachés al instante)
+DATA_VERSIONS: Dict[str, int] = {}
+
+# Historial con tamaño acotado: resumen acumulado (hecho por el modelo) + últimos mensajes
+CONVERSATION_MEMORY = ConversationMemory(API_CLIENT, GEMINI_MODEL, scheduler=MODEL_SCHEDULER)
+
+# Estado de los flujos en curso (p. ej. /cancelar) compartido entre workers y reinicios
+BOT_STATE = BotState(build_state_store(API_CLIENT))
+
+# Registro diferido de mensajes: se envían a la API en lotes desde segundo plano
+CONVERSATION_LOGGER = ConversationLogger(API_CLIENT, identities=IDENTITIES)
+
+# Vuelca periódicamente las métricas al log (en webhook también están en GET /metrics)
+METRICS_REPORTER = MetricsReporter()
+
+def _format_product(p: dict) -> str:
+    return f"📦 ID: {p['id']} - {p['name']} - ${p['price']} (Stock: {p['stock']})"
+
+def _format_faq(faq: dict) -> str:
+    return f"- Pregunta: {faq['question']}\n  Respuesta: {faq['answer']}"
+
+async def get_relevant_products(query: str) -> str:
+    """Productos del catálogo relevantes para el mensaje, dentro del presupuesto de tokens."""
     if not API_BASE_URL:
         return "Error: La URL de la API no está configurada."
     try:
-        response = requests.get(f"{API_BASE_URL}/api/products/?limit={limit}")
-        response.raise_for_status()
-        
-        data = response.json()
-        # La API de Django REST Framework con paginación devuelve los datos en la clave 'results'
-        products = data.get('results', [])
+        lines = await KNOWLEDGE.products_for(
+            query, k=RETRIEVAL_TOP_K_PRODUCTS, budget_tokens=RETRIEVAL_BUDGET_PRODUCTS, render=_format_product
+        )
+    except httpx.HTTPError as e:
+        logger.error(f"Error al contactar la API de productos: {e}")
+        return "La información de productos no está disponible en este momento."
+    return "\n".join(lines) or "No hay productos en el catálogo en este momento."
+
+NO_RELATED_FAQS_TEXT = "No hay preguntas frecuentes relacionadas con este mensaje."
+
+async def get_relevant_faqs(query: str) -> str:
+    """FAQs relevantes para el mensaje, dentro del presupuesto de tokens."""
+    if not API_BASE_URL:
+        return "Error: La URL de la API no está configurada."
+    try:
+        lines = await KNOWLEDGE.faqs_for(
+            query, k=RETRIEVAL_TOP_K_FAQS, budget_tokens=RETRIEVAL_BUDGET_FAQS, render=_format_faq
+        )
+    except httpx.HTTPError as e:
+        logger.error(f"Error al contactar la API de FAQs: {e}")
+        return "La información de preguntas frecuentes no está disponible en este momento."
+    return "\n".join(lines) or NO_RELATED_FAQS_TEXT
+
+async def get_products_from_api(limit: int = 50) -> str:
+    """Obtiene la lista de productos (desde la caché del catálogo)."""
+    if not API_BASE_URL:
+        return "Error: La URL de la API no está configurada."
+    try:
+        products = (await PRODUCTS_CACHE.get())[:limit]
         
         if not products:
             return "No hay productos en el catálogo en este momento."
             
-        lines = [f"📦 ID: {p['id']} - {p['name']} - ${p['price']} (Stock: {p['stock']})" for p in products]
+        lines = [_format_product(p) for p in products]
         return "\n".join(lines)
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error al contactar la API de productos: {e}")
         return "La información de productos no está disponible en este momento."
 
-def get_faqs_from_api(only_questions: bool = False) -> str:
+async def get_faqs_from_api(only_questions: bool = False) -> str:
     """
-    Obtiene la lista de FAQs desde la API de Render.
+    Obtiene la lista de FAQs (desde la caché de FAQs).
     Si only_questions es True, devuelve solo la lista de preguntas.
     """
     if not API_BASE_URL:
         return "Error: La URL de la API no está configurada."
     try:
-        # Usamos un límite alto para traer todas las FAQs, asumiendo que no serán miles.
-        response = requests.get(f"{API_BASE_URL}/api/faqs/?limit=100")
-        response.raise_for_status()
-        
-        data = response.json()
-        faqs = data.get('results', [])
+        faqs = await FAQS_CACHE.get()
         
         if not faqs:
             return "La información de preguntas frecuentes no está disponible en este momento."
@@ -78,115 +191,94 @@ def get_faqs_from_api(only_questions: bool = False) -> str:
         if only_questions:
             lines = [f"❓ {faq['question']}" for faq in faqs]
         else:
-            lines = [f"- Pregunta: {faq['question']}\n  Respuesta: {faq['answer']}" for faq in faqs]
+            lines = [_format_faq(faq) for faq in faqs]
             
         return "\n".join(lines)
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error al contactar la API de FAQs: {e}")
         return "La información de preguntas frecuentes no está disponible en este momento."
 
-async def get_history_from_api(user_id: int) -> str:
-    """Obtiene el historial de conversación reciente para un usuario desde la API."""
+def _note_data_versions(versions: dict):
+    """Invalida la caché del catálogo o de las FAQs en cuanto la API informa de un cambio."""
+    for name, cache in (("catalog", PRODUCTS_CACHE), ("faqs", FAQS_CACHE)):
+        version = versions.get(name)
+        previous = DATA_VERSIONS.get(name)
+        DATA_VERSIONS[name] = version
+        if previous is not None and version != previous:
+            logger.info(f"Versión de '{name}' cambió ({previous} -> {version}); se invalida la caché.")
+            cache.invalidate()
+
+async def get_history_from_api(user) -> str:
+    """
+    Obtiene el historial de conversación reciente para un usuario desde la API.
+
+    Una sola llamada a ``/api/bot-context/`` trae el usuario, la conversación activa,
+    su memoria (resumen + últimos mensajes) y las versiones del catálogo y las FAQs.
+    """
     if not API_BASE_URL:
         return ""
     try:
-        # Pide la última conversación para el contexto más reciente
-        conv_response = requests.get(f"{API_BASE_URL}/api/conversations/?user__telegram_id={user_id}&ordering=-start_time&limit=1")
-        conv_response.raise_for_status()
-        conversations = conv_response.json().get('results', [])
-        
-        if not conversations:
-            return "No hay historial previo."
-
-        # Pide los últimos 6 mensajes de esa conversación, pero ORDENADOS CRONOLÓGICAMENTE
-        # Esto es crucial para que el contexto tenga sentido
-        conv_id = conversations[0]['id']
-        # Nota: cambiamos el ordering a 'timestamp' (sin el -) para obtener del más antiguo al más reciente
-        msg_response = requests.get(f"{API_BASE_URL}/api/messages/?conversation={conv_id}&ordering=timestamp&limit=6")
-        msg_response.raise_for_status()
-        messages = msg_response.json().get('results', [])
-        
-        # Como ya están ordenados cronológicamente, no necesitamos revertirlos
-        history_lines = []
-        for msg in messages:
-            sender = "Usuario" if msg['sender'] == 'user' else "Asistente"
-            # Limpiamos el texto para evitar problemas con markdown o caracteres especiales
-            content = msg['content'].strip()
-            history_lines.append(f"{sender}: {content}")
-        
-        return "\n".join(history_lines)
-    except requests.RequestException as e:
+        response = await API_CLIENT.get(f"/api/bot-context/{user.id}/", params={"messages": HISTORY_TAIL_MESSAGES})
+        response.raise_for_status()
+        bundle = response.json()
+        _note_data_versions(bundle.get("versions", {}))
+        if bundle["user"] is None:
+            return NO_HISTORY_TEXT
+        IDENTITIES.remember(user.id, bundle["user"], bundle["conversation"])
+        if bundle["memory"] is None:
+            return NO_HISTORY_TEXT
+
+        # Resumen acumulado + últimos mensajes, en orden cronológico
+        return CONVERSATION_MEMORY.render(bundle["conversation"], bundle["memory"])
+    except httpx.HTTPError as e:
         logger.error(f"Error al obtener historial desde la API: {e}")
         return "No se pudo recuperar el historial."
 
-async def log_conversation(user: dict, user_text: str, bot_text: str):
-    """Guarda la conversación completa (usuario, conversación, mensajes) en la API."""
-    if not API_BASE_URL:
-        logger.error("No se puede registrar la conversación: API_BASE_URL no está configurada.")
-        return
+async def log_conversation(user: dict, user_text: str, bot_text: str, received_at: Optional[datetime] = None):
+    """
+    Registra la conversación (usuario, conversación, mensajes) en la API.
 
-    # 1. Obtener o crear el usuario
-    user_id = None
-    try:
-        # Primero intenta obtener el usuario por telegram_id
-        response = requests.get(f"{API_BASE_URL}/api/users/?telegram_id={user.id}")
-        response.raise_for_status()
-        results = response.json().get('results', [])
-        
-        if results:
-            user_id = results[0]['id']
-        else:
-            # Si no existe, créalo
-            user_payload = {
-                "telegram_id": str(user.id),
-                "username": user.username,
-                "first_name": user.first_name,
-                "last_name": user.last_name,
-            }
-            response = requests.post(f"{API_BASE_URL}/api/users/", json=user_payload)
-            response.raise_for_status()
-            user_id = response.json()['id']
-    except requests.RequestException as e:
-        logger.error(f"Error al obtener/crear usuario en la API: {e}")
-        return
+    ``received_at`` es la hora del mensaje del usuario (la de Telegram); la respuesta
+    del bot lleva la hora en que se registra.
 
-    if not user_id:
-        logger.error("No se pudo obtener un user_id para registrar la conversación.")
+    Solo encola los mensajes: el envío a la API se hace en lotes en segundo plano,
+    así el handler termina en cuanto responde al usuario.
+    """
+    if not API_BASE_URL:
+        logger.error("No se puede registrar la conversación: API_BASE_URL no está configurada.")
         return
+    await CONVERSATION_LOGGER.log_exchange(user, user_text, bot_text, received_at=received_at)
 
-    # 2. Obtener la conversación más reciente o crear una nueva si no existe
-    conv_id = None
-    try:
-        # Reutilizamos la última conversación del usuario (si existe)
-        conv_resp = requests.get(
-            f"{API_BASE_URL}/api/conversations/?user={user_id}&ordering=-start_time&limit=1"
-        )
-        conv_resp.raise_for_status()
-        conv_results = conv_resp.json().get('results', [])
-        if conv_results:
-            conv_id = conv_results[0]['id']
-        else:
-            conv_payload = {"user": user_id}
-            response = requests.post(f"{API_BASE_URL}/api/conversations/", json=conv_payload)
-            response.raise_for_status()
-            conv_id = response.json()['id']
-    except requests.RequestException as e:
-        logger.error(f"Error al obtener/crear la conversación en la API: {e}")
-        return
+async def reply_with_model(
+    bot, chat_id: int, prompt: str, started_at: float, cache_key: str = None,
+    priority: Priority = Priority.NORMAL,
+) -> str:
+    """
+    Responde con el modelo transmitiendo la salida. Si ``cache_key`` tiene una respuesta
+    guardada se envía directamente; si no, la respuesta completa se guarda para la próxima vez.
 
-    # 3. Registrar ambos mensajes
+    La llamada al modelo espera turno en ``MODEL_SCHEDULER`` según ``priority``; si se
+    descarta por saturación se responde con ``MODEL_BUSY_TEXT``.
+    """
+    if cache_key:
+        cached = await RESPONSE_CACHE.get(cache_key)
+        if cached is not None:
+            for start in range(0, len(cached), TELEGRAM_MAX_MESSAGE_LENGTH):
+                await bot.send_message(
+                    chat_id=chat_id, text=cached[start:start + TELEGRAM_MAX_MESSAGE_LENGTH], parse_mode=None
+                )
+            METRICS.observe("reply.time_to_first_visible", time.monotonic() - started_at)
+            return cached
     try:
-        # Mensaje del usuario
-        msg_user_payload = {"conversation": conv_id, "sender": "user", "content": user_text}
-        requests.post(f"{API_BASE_URL}/api/messages/", json=msg_user_payload).raise_for_status()
-        
-        # Mensaje del bot
-        msg_bot_payload = {"conversation": conv_id, "sender": "bot", "content": bot_text}
-        requests.post(f"{API_BASE_URL}/api/messages/", json=msg_bot_payload).raise_for_status()
-        
-        logger.info(f"Conversación {conv_id} registrada con éxito.")
-    except requests.RequestException as e:
-        logger.error(f"Error al registrar mensajes en la API: {e}")
+        async with MODEL_SCHEDULER.slot(priority, estimate_tokens(prompt) + LLM_EXPECTED_OUTPUT_TOKENS):
+            return await stream_reply(
+                bot, chat_id, stream_text(GEMINI_MODEL, prompt), started_at=started_at,
+                on_complete=(lambda text: RESPONSE_CACHE.set(cache_key, text)) if cache_key else None,
+            )
+    except ModelOverloaded as e:
+        logger.warning(f"Consulta al modelo descartada por saturación: {e}")
+        await bot.send_message(chat_id=chat_id, text=MODEL_BUSY_TEXT, parse_mode=None)
+        return MODEL_BUSY_TEXT
 
 # --- Handlers de Telegram ---
 
@@ -196,19 +288,27 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Limpia datos de usuario al iniciar
     context.user_data.clear()
+    await BOT_STATE.delete("cancel_map", user.id)
     
     # También intentamos crear una nueva conversación en la API
     try:
         if API_BASE_URL:
-            # Primero obtener el user_id
-            user_response = requests.get(f"{API_BASE_URL}/api/users/?telegram_id={user.id}")
-            if user_response.status_code == 200:
-                users = user_response.json().get('results', [])
-                if users:
-                    user_id = users[0]['id']
-                    # Crear nueva conversación
-                    conv_payload = {"user": user_id}
-                    requests.post(f"{API_BASE_URL}/api/conversations/", json=conv_payload)
+            # La conversación activa cambia: la caché solo conserva el pk del usuario
+            IDENTITIES.forget_conversation(user.id)
+            identity = IDENTITIES.get(user.id)
+            user_id = identity.user_pk if identity else None
+            if user_id is None:
+                user_response = await API_CLIENT.get("/api/users/", params={"telegram_id": user.id})
+                if user_response.status_code == 200:
+                    users = user_response.json().get('results', [])
+                    if users:
+                        user_id = users[0]['id']
+            if user_id is not None:
+                # Crear nueva conversación
+                conv_payload = {"user": user_id}
+                conv_response = await API_CLIENT.post("/api/conversations/", json=conv_payload)
+                conv_response.raise_for_status()
+                IDENTITIES.remember(user.id, user_id, conv_response.json()['id'])
     except Exception as e:
         logger.error(f"Error al crear nueva conversación en /start: {e}")
         
@@ -230,20 +330,28 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def productos_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para el comando /productos."""
-    product_list = get_products_from_api()
+    product_list = await get_products_from_api()
     await update.message.reply_text(product_list)
 
+def _record_ayuda_path(path: str, started_at: float, detail: str = ""):
+    """Registra qué camino respondió /ayuda (local, llm, busy o error) para medir cuánto evitamos la IA."""
+    METRICS.incr(f"ayuda.served_by.{path}")
+    METRICS.observe(f"ayuda.latency.{path}", time.monotonic() - started_at)
+    logger.info(f"/ayuda respondida por el camino '{path}'{f' ({detail})' if detail else ''}.")
+
 async def ayuda_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Maneja el comando de ayuda.
     - Si se usa solo `/ayuda`, muestra la lista de FAQs.
-    - Si se usa `/ayuda <pregunta>`, intenta responderla usando la IA.
+    - Si se usa `/ayuda <pregunta>` y coincide claramente con una FAQ, responde con ella.
+    - Si no, intenta responderla usando la IA.
     """
+    started_at = time.monotonic()
     user_question = " ".join(context.args)
     
     # Caso 1: El usuario solo escribe /ayuda para ver las opciones
     if not user_question:
-        faq_questions = get_faqs_from_api(only_questions=True)
+        faq_questions = await get_faqs_from_api(only_questions=True)
         if not faq_questions:
             response_text = "Actualmente no tenemos una sección de preguntas frecuentes, pero puedes consultarme lo que necesites."
         else:
@@ -256,7 +364,30 @@ async def ayuda_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Caso 2: El usuario hace una pregunta específica con /ayuda
-    faqs_context = get_faqs_from_api(only_questions=False) # Obtenemos Q&A
+    # Camino rápido: si la pregunta coincide claramente con una FAQ, respondemos sin IA
+    try:
+        faq_match = FAQ_MATCHER.match(user_question, await FAQS_CACHE.get())
+    except httpx.HTTPError as e:
+        logger.error(f"Error al contactar la API de FAQs: {e}")
+        faq_match = None
+    if faq_match:
+        faq, score = faq_match
+        bot_response_text = faq['answer']
+        await update.message.reply_text(bot_response_text, parse_mode=None)
+        _record_ayuda_path("local", started_at, f"FAQ {faq['id']}, puntuación {score:.2f}")
+        await log_conversation(
+            user=update.effective_user,
+            user_text=f"/ayuda {user_question}",
+            bot_text=bot_response_text,
+            received_at=update.message.date,
+        )
+        return
+
+    if not GEMINI_MODEL:
+        await update.message.reply_text("Lo siento, la función de IA no está disponible ahora mismo.")
+        return
+
+    faqs_context = await get_faqs_from_api(only_questions=False) # Obtenemos Q&A
     prompt = (
         "Eres un asistente de soporte al cliente muy amable. Tu única fuente de verdad es la siguiente lista de Preguntas y Respuestas (FAQs). "
         "Tu tarea es responder a la pregunta del usuario basándote únicamente en este contexto. Sé conciso y directo.\n\n"
@@ -269,44 +400,54 @@ async def ayuda_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     bot_response_text = ""
+    cache_key = make_key(
+        "ayuda", normalize_question(user_question), PROMPT_VERSIONS["ayuda"], (FAQS_CACHE.fingerprint,)
+    )
     try:
-        response = GEMINI_MODEL.generate_content(prompt)
-        bot_response_text = response.text
-        await update.message.reply_text(bot_response_text, parse_mode=None)
+        bot_response_text = await reply_with_model(
+            context.bot, update.effective_chat.id, prompt, started_at, cache_key, priority=Priority.HIGH
+        )
+        _record_ayuda_path("busy" if bot_response_text == MODEL_BUSY_TEXT else "llm", started_at)
     except Exception as e:
         logger.error(f"Error en la API de Gemini (ayuda): {e}")
         bot_response_text = "⚙️ Tuve un problema al procesar tu consulta. Por favor, intenta más tarde."
         await update.message.reply_text(bot_response_text, parse_mode=None)
+        _record_ayuda_path("error", started_at)
 
     # Registrar la interacción de ayuda
     await log_conversation(
         user=update.effective_user,
         user_text=f"/ayuda {user_question}",
-        bot_text=bot_response_text
+        bot_text=bot_response_text,
+        received_at=update.message.date,
     )
 
 async def recomendar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Usa Gemini para recomendar productos basándose en la lista de la API."""
+    started_at = time.monotonic()
     if not GEMINI_MODEL:
         await update.message.reply_text("Lo siento, la función de recomendación no está disponible ahora mismo.")
         return
         
-    product_list = get_products_from_api(limit=100)
+    product_list = await get_products_from_api(limit=100)
     prompt = (
-        "Eres un asistente de ventas experto y muy conciso. Basado en la siguiente lista de productos, "
-        "recomienda los 3 mejores artículos para un cliente. "
-        "Usa un salto de línea para separar cada recomendación. No uses negritas, asteriscos ni otro formato especial. Sé breve.\n\n"
-        f"Lista de productos:\n{product_list}"
+        PromptBuilder("recomendar")
+        .add("instrucciones", (
+            "Eres un asistente de ventas experto y muy conciso. Basado en la siguiente lista de productos, "
+            "recomienda los 3 mejores artículos para un cliente. "
+            "Usa un salto de línea para separar cada recomendación. No uses negritas, asteriscos ni otro formato especial. Sé breve.\n\n"
+        ))
+        .add("productos", product_list, policy=KEEP_HEAD, header="Lista de productos:\n")
+        .build()
+        .text
     )
     
     bot_response_text = ""
+    # Todos los usuarios reciben el mismo prompt hasta que cambie el catálogo
+    cache_key = make_key("recomendar", "", PROMPT_VERSIONS["recomendar"], (PRODUCTS_CACHE.fingerprint,))
     try:
-        response = GEMINI_MODEL.generate_content(prompt)
-        bot_response_text = response.text
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=bot_response_text,
-            parse_mode=None  # Evitamos problemas de formato con Markdown
+        bot_response_text = await reply_with_model(
+            context.bot, update.effective_chat.id, prompt, started_at, cache_key, priority=Priority.LOW
         )
     except Exception as e:
         logger.error(f"Error en la API de Gemini: {e}")
@@ -317,7 +458,8 @@ async def recomendar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await log_conversation(
         user=update.effective_user,
         user_text=update.message.text,
-        bot_text=bot_response_text
+        bot_text=bot_response_text,
+        received_at=update.message.date,
     )
 
 async def reservar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -348,16 +490,19 @@ async def reservar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
 
     try:
-        response = requests.post(f"{API_BASE_URL}/api/products/{product_id}/reserve/", json=payload)
+        response = await API_CLIENT.post(f"/api/products/{product_id}/reserve/", json=payload)
         response.raise_for_status()
         
+        # El stock cambió: la próxima lectura del catálogo debe ir a la API
+        PRODUCTS_CACHE.invalidate()
+
         order_data = response.json()
         total = float(order_data['total_amount'])
         await update.message.reply_text(
             f"¡Reserva exitosa! ✅\nTu pedido (ID: {order_data['id']}) ha sido actualizado.\n"
             f"El nuevo total es: **${total:.2f}**"
         )
-    except requests.exceptions.HTTPError as e:
+    except httpx.HTTPStatusError as e:
         if e.response.status_code == 404:
             await update.message.reply_text("❌ No se encontró un producto con ese ID.")
         elif e.response.status_code == 400:
@@ -366,38 +511,64 @@ async def reservar_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             logger.error(f"Error HTTP no manejado al reservar: {e}")
             await update.message.reply_text("Ocurrió un error inesperado al procesar tu reserva.")
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error de conexión al reservar: {e}")
         await update.message.reply_text("No pude conectarme al sistema de pedidos. Inténtalo más tarde.")
 
+def text_cache_key(
+    telegram_id: int, user_text: str, faqs_context: str, history_context: str, orders_context: str, follow_up: bool
+) -> Optional[str]:
+    """
+    Clave de caché de una respuesta de texto libre, o None si no se puede cachear.
+
+    Solo las preguntas tipo FAQ (sin seguimiento de la charla) se cachean. El prompt
+    incluye el historial y las reservas del usuario, así que la clave queda limitada a
+    ese usuario y a ese contexto: nunca se sirve a otro usuario una respuesta personalizada.
+    """
+    if follow_up or faqs_context == NO_RELATED_FAQS_TEXT:
+        return None
+    return make_key(
+        "texto", normalize_question(user_text), PROMPT_VERSIONS["texto"],
+        (FAQS_CACHE.fingerprint, PRODUCTS_CACHE.fingerprint, str(telegram_id), history_context, orders_context),
+    )
+
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja cualquier mensaje de texto que no sea un comando."""
-    if not GEMINI_MODEL:
-        await update.message.reply_text("Lo siento, la función de IA no está disponible ahora mismo.")
-        return
-
+    started_at = time.monotonic()
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
     
     user_text = update.message.text
     user = update.effective_user
     logger.info(f"Usuario '{user.username}' envió un mensaje de texto para procesar con IA.")
 
-    # Obtener contextos
-    faqs_context = get_faqs_from_api(only_questions=False)
-    products_context = get_products_from_api(limit=100)
-    history_context = await get_history_from_api(user.id)
-    
+    # Una sola pasada sobre el mensaje para reconocer intenciones conocidas
+    intent_match = INTENT_ROUTER.route(user_text)
+    intent = intent_match.intent if intent_match else None
+    logger.info(
+        f"Intención detectada: {intent.name} (frase '{intent_match.phrase}')" if intent else "Intención detectada: ninguna"
+    )
+
+    # --- Detectar solicitudes de pedidos/reservas ---
+    if intent and intent.action == "orders":
+        orders_text, _ = await _fetch_orders_with_map(user.id)
+        # Si el usuario no tiene reservas, orientar al comando explícito
+        if "No tienes pedidos" in orders_text or "No pude recuperar" in orders_text:
+            orders_text = "No tengo información sobre tus reservas en este momento. Usa el comando /reservas para consultarlas."
+
+        await update.message.reply_text(orders_text, parse_mode=None)
+        await log_conversation(user=user, user_text=user_text, bot_text=orders_text, received_at=update.message.date)
+        return  # No pasamos a IA
+
+    # Intenciones con respuesta fija (p. ej. cómo cancelar): sin IA
+    if intent and intent.response:
+        await update.message.reply_text(intent.response, parse_mode=None)
+        await log_conversation(user=user, user_text=user_text, bot_text=intent.response, received_at=update.message.date)
+        return
+
     # Detectar preguntas de seguimiento sobre recomendaciones
-    follow_up_about_products = False
+    follow_up_about_products = bool(intent and intent.action == "product_follow_up")
     follow_up_context = ""
-    
-    # Lista de palabras clave que indican preguntas sobre recomendaciones
-    product_question_keywords = ["por que", "por qué", "porqué", "porque", "razón", "esos productos", "esa recomendación"]
-    
-    # Verificar si es una pregunta de seguimiento sobre productos
-    lower_text = user_text.lower()
-    if any(keyword in lower_text for keyword in product_question_keywords):
-        follow_up_about_products = True
+    if follow_up_about_products:
         follow_up_context = (
             "NOTA IMPORTANTE: El usuario está preguntando sobre recomendaciones de productos previas. "
             "Aunque no puedas ver la recomendación exacta en el historial, debes asumir que recomendaste "
@@ -407,97 +578,94 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         logger.info("Detectada pregunta de seguimiento sobre productos. Añadiendo contexto adicional.")
 
-    # --- Detectar solicitudes de pedidos/reservas ---
-    orders_keywords = [
-        "mis reservas",
-        "mis pedidos",
-        "que reservé",
-        "qué reservé",
-        "que reserve",
-        "que tengo reservado",
-        "qué tengo reservado",
-        "reservado",
-        "reservados",
-        "que reservas tengo",
-        "qué reservas tengo",
-        "mis ordenes",
-        "mis órdenes",
-    ]
-    if any(k in lower_text for k in orders_keywords):
-        orders_text, _ = _fetch_orders_with_map(user.id)
-        # Si el usuario no tiene reservas, orientar al comando explícito
-        if "No tienes pedidos" in orders_text or "No pude recuperar" in orders_text:
-            orders_text = "No tengo información sobre tus reservas en este momento. Usa el comando /reservas para consultarlas."
-
-        await update.message.reply_text(orders_text, parse_mode=None)
-        await log_conversation(user=user, user_text=user_text, bot_text=orders_text)
-        return  # No pasamos a IA
-
-    # Si el usuario pregunta cómo cancelar
-    cancel_keywords = ["cómo cancelo", "como cancelo", "cancelar reserva", "cancelar pedido", "como cancelo una reserva", "cómo cancelo una reserva"]
-    if any(k in lower_text for k in cancel_keywords):
-        cancel_text = (
-            "Para eliminar un pedido completo, escribe /cancelar para ver la lista numerada y luego /cancelar <número>.\n\n"
-            "Por ejemplo:\n"
-            "1. /cancelar (para ver tus pedidos)\n"
-            "2. /cancelar 2 (para eliminar el pedido número 2)"
-        )
-        await update.message.reply_text(cancel_text, parse_mode=None)
-        await log_conversation(user=user, user_text=user_text, bot_text="Instrucciones de eliminación enviadas.")
+    if not GEMINI_MODEL:
+        await update.message.reply_text("Lo siento, la función de IA no está disponible ahora mismo.")
         return
 
+    # Obtener contextos en paralelo, cada fuente con su propio plazo y valor degradado
+    context_parts = await gather_context([
+        ContextSource(
+            "faqs", lambda: get_relevant_faqs(user_text),
+            deadline=CONTEXT_DEADLINES["faqs"],
+            fallback="La información de preguntas frecuentes no está disponible en este momento.",
+        ),
+        ContextSource(
+            "products", lambda: get_relevant_products(user_text),
+            deadline=CONTEXT_DEADLINES["products"],
+            fallback="La información de productos no está disponible en este momento.",
+        ),
+        ContextSource(
+            "history", lambda: get_history_from_api(user),
+            deadline=CONTEXT_DEADLINES["history"],
+            fallback="No se pudo recuperar el historial.",
+        ),
+        ContextSource(
+            "orders", lambda: get_orders_from_api(user.id),
+            deadline=CONTEXT_DEADLINES["orders"],
+            fallback="",
+            required=False,
+        ),
+    ])
+    faqs_context = context_parts["faqs"]
+    products_context = context_parts["products"]
+    history_context = context_parts["history"]
+    orders_context = context_parts["orders"]
+    if "No pude recuperar" in orders_context:
+        orders_context = ""
+
     # Prompt Final y Balanceado: Conversacional, conciso y con memoria.
+    # Si no cabe en el presupuesto se recortan primero las reservas, luego el historial antiguo,
+    # los productos y las FAQs menos relevantes; instrucciones y mensaje del usuario se mantienen.
     prompt = (
-        "Eres un asistente de compras virtual para TechRetail. Tu personalidad es amigable y eficiente. Tu objetivo es dar respuestas claras, breves y útiles.\n\n"
-        f"{follow_up_context if follow_up_about_products else ''}"
-        "**Reglas de oro para tus respuestas:**\n"
-        "1.  **SÉ CONCISO:** Mantén tus respuestas cortas, idealmente menos de 40 palabras.\n"
-        "2.  **USA SALTOS DE LÍNEA:** Para cualquier lista (especialmente productos), usa un salto de línea por cada ítem. No uses guiones.\n"
-        "3.  **ANALIZA EL HISTORIAL CUIDADOSAMENTE:** Revisa el 'Historial Reciente' para entender el contexto completo.\n"
-        "4.  **RESPONDE A PREGUNTAS DE SEGUIMIENTO:** Si el usuario pregunta 'por qué', 'por qué esos productos' o similar, SIEMPRE responde basándote en tus recomendaciones previas, no en otros temas.\n"
-        "5.  **RECOMIENDA CON DATOS:** Si te piden una 'recomendación', sugiere 1 o 2 productos del catálogo y siempre incluye su ID. Ejemplo: 'Te sugiero el iPhone 15 (ID: 1)'.\n"
-        "6.  **EXPLICA TUS RECOMENDACIONES:** Cuando recomiendas productos, prepárate para explicar por qué los elegiste si el usuario pregunta después.\n"
-        "7.  **SI NO SABES:** Si la respuesta no está en tu conocimiento, di amablemente: 'No tengo información sobre eso, pero puedo ayudarte con nuestros productos o FAQs'.\n\n"
-        "--- **Historial Reciente** ---\n"
-        f"{history_context}\n"
-        "--- **Fin del Historial** ---\n\n"
-        "--- **Base de Conocimiento** ---\n"
-        "**Preguntas Frecuentes (FAQs):**\n"
-        f"{faqs_context}\n\n"
-        "**Catálogo de Productos:**\n"
-        f"{products_context}\n"
-        "--- **Fin Base de Conocimiento** ---\n\n"
-        f"**Usuario:** \"{user_text}\""
+        PromptBuilder("texto")
+        .add("instrucciones", (
+            "Eres un asistente de compras virtual para TechRetail. Tu personalidad es amigable y eficiente. Tu objetivo es dar respuestas claras, breves y útiles.\n\n"
+            f"{follow_up_context if follow_up_about_products else ''}"
+            "**Reglas de oro para tus respuestas:**\n"
+            "1.  **SÉ CONCISO:** Mantén tus respuestas cortas, idealmente menos de 40 palabras.\n"
+            "2.  **USA SALTOS DE LÍNEA:** Para cualquier lista (especialmente productos), usa un salto de línea por cada ítem. No uses guiones.\n"
+            "3.  **ANALIZA EL HISTORIAL CUIDADOSAMENTE:** Revisa el 'Historial Reciente' para entender el contexto completo.\n"
+            "4.  **RESPONDE A PREGUNTAS DE SEGUIMIENTO:** Si el usuario pregunta 'por qué', 'por qué esos productos' o similar, SIEMPRE responde basándote en tus recomendaciones previas, no en otros temas.\n"
+            "5.  **RECOMIENDA CON DATOS:** Si te piden una 'recomendación', sugiere 1 o 2 productos del catálogo y siempre incluye su ID. Ejemplo: 'Te sugiero el iPhone 15 (ID: 1)'.\n"
+            "6.  **EXPLICA TUS RECOMENDACIONES:** Cuando recomiendas productos, prepárate para explicar por qué los elegiste si el usuario pregunta después.\n"
+            "7.  **SI NO SABES:** Si la respuesta no está en tu conocimiento, di amablemente: 'No tengo información sobre eso, pero puedo ayudarte con nuestros productos o FAQs'.\n\n"
+        ))
+        .add(
+            "historial", history_context, policy=KEEP_TAIL, cut_order=3,
+            header="--- **Historial Reciente** ---\n", footer="\n--- **Fin del Historial** ---\n\n",
+        )
+        .add("inicio_conocimiento", "--- **Base de Conocimiento** ---\n")
+        .add(
+            "faqs", faqs_context, policy=KEEP_HEAD, cut_order=1,
+            header="**Preguntas Frecuentes (FAQs) relacionadas:**\n", footer="\n\n",
+        )
+        .add(
+            "productos", products_context, policy=KEEP_HEAD, cut_order=2,
+            header="**Productos relevantes del catálogo:**\n", footer="\n",
+        )
+        .add("reservas", orders_context, policy=DROP, cut_order=4, header="**Reservas del Usuario:**\n", footer="\n")
+        .add("fin_conocimiento", "--- **Fin Base de Conocimiento** ---\n\n")
+        .add("usuario", f"**Usuario:** \"{user_text}\"")
+        .build()
+        .text
     )
     
+    cache_key = text_cache_key(
+        user.id, user_text, faqs_context, history_context, orders_context, follow_up_about_products
+    )
+
     # Logueamos el prompt completo para facilitar la depuración
     logger.info(f"--- PROMPT ENVIADO A GEMINI ---\n{prompt}\n---------------------------")
     
     bot_response_text = "Tuve un problema para procesar tu solicitud. Por favor, intenta de nuevo."
     try:
-        response = GEMINI_MODEL.generate_content(prompt)
-        bot_response_text = response.text
-        # Intenta enviar con el formato por defecto (Markdown)
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text=bot_response_text,
-            parse_mode=None  # Evitamos problemas de formato con Markdown
-        )
+        # La respuesta se muestra en cuanto llega el primer fragmento y se va completando
+        bot_response_text = await reply_with_model(context.bot, update.effective_chat.id, prompt, started_at, cache_key)
     except BadRequest as e:
-        if "Can't parse entities" in str(e):
-            # El formato de Markdown de Gemini es inválido para Telegram.
-            logger.warning(f"Error de formato Markdown de Gemini. Reenviando como texto plano. Error: {e}")
-            # Reintentar enviar como texto plano
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id, text=bot_response_text, parse_mode=None
-            )
-        else:
-            # Otro tipo de BadRequest que no es por formato
-            logger.error(f"Error de Telegram (BadRequest) no relacionado con formato: {e}")
-            bot_response_text_fallback = "⚙️ Tuve un problema al enviar la respuesta. Por favor, intenta de nuevo."
-            await update.message.reply_text(bot_response_text_fallback, parse_mode=None)
-            # Actualizamos el texto del bot al de fallback para el log
-            bot_response_text = bot_response_text_fallback
+        # Error de Telegram al enviar/editar (la respuesta se envía sin parse_mode)
+        logger.error(f"Error de Telegram (BadRequest) al enviar la respuesta: {e}")
+        bot_response_text = "⚙️ Tuve un problema al enviar la respuesta. Por favor, intenta de nuevo."
+        await update.message.reply_text(bot_response_text, parse_mode=None)
 
     except Exception as e:
         # Captura cualquier otro error (ej. de la API de Gemini)
@@ -508,28 +676,27 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await log_conversation(
         user=update.effective_user,
         user_text=user_text,
-        bot_text=bot_response_text
+        bot_text=bot_response_text,
+        received_at=update.message.date,
     )
 
 # --- Nuevo helper para pedidos/reservas ---
 
-from typing import Tuple, Dict
-
-def get_orders_from_api(telegram_id: int, limit: int = 10) -> str:
+async def get_orders_from_api(telegram_id: int, limit: int = 10) -> str:
     """Devuelve un resumen de los pedidos/reservas de un usuario (solo texto)."""
-    text, _ = _fetch_orders_with_map(telegram_id, limit)
+    text, _ = await _fetch_orders_with_map(telegram_id, limit)
     return text
 
-def _fetch_orders_with_map(telegram_id: int, limit: int = 10) -> Tuple[str, Dict[int, int]]:
+async def _fetch_orders_with_map(telegram_id: int, limit: int = 10) -> Tuple[str, Dict[int, int]]:
     """Devuelve (texto_resumen, map_index_a_orderID)."""
     if not API_BASE_URL:
         return "Error: La URL de la API no está configurada.", {}
 
     try:
-        url = (
-            f"{API_BASE_URL}/api/orders/?user__telegram_id={telegram_id}&ordering=-created_at&limit={limit}"
+        response = await API_CLIENT.get(
+            "/api/orders/",
+            params={"user__telegram_id": telegram_id, "ordering": "-created_at", "limit": limit},
         )
-        response = requests.get(url)
         response.raise_for_status()
         data = response.json()
         orders = data.get("results", data)  # soporta paginación y sin paginación
@@ -557,11 +724,11 @@ def _fetch_orders_with_map(telegram_id: int, limit: int = 10) -> Tuple[str, Dict
                 lines.append(f"   • {qty} x {name} (${price:.2f} c/u)")
             lines.append("")  # blank line between orders
         return "\n".join(lines).strip(), index_map
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error al obtener pedidos del usuario: {e}")
         return "No pude recuperar tus pedidos en este momento.", {}
 
-def delete_order_item_api(item_id: int) -> str:
+async def delete_order_item_api(item_id: int) -> str:
     """Intenta eliminar un OrderItem por ID."""
     if not API_BASE_URL:
         return "Error: La URL de la API no está configurada."
@@ -569,7 +736,7 @@ def delete_order_item_api(item_id: int) -> str:
     try:
         # Usar el endpoint de order-items
         logger.info(f"Intentando eliminar item {item_id} mediante DELETE")
-        resp = requests.delete(f"{API_BASE_URL}/api/order-items/{item_id}/")
+        resp = await API_CLIENT.delete(f"/api/order-items/{item_id}/")
         
         if resp.status_code == 204:
             logger.info(f"Item {item_id} eliminado exitosamente")
@@ -579,7 +746,7 @@ def delete_order_item_api(item_id: int) -> str:
             
             # Intentar con el endpoint alternativo
             logger.info(f"Intentando con endpoint alternativo para item {item_id}")
-            alt_resp = requests.delete(f"{API_BASE_URL}/api/orderitems/{item_id}/")
+            alt_resp = await API_CLIENT.delete(f"/api/orderitems/{item_id}/")
             
             if alt_resp.status_code == 204:
                 logger.info(f"Item {item_id} eliminado exitosamente mediante endpoint alternativo")
@@ -591,25 +758,25 @@ def delete_order_item_api(item_id: int) -> str:
             
             # Intentar obtener el item para saber su orden
             try:
-                item_resp = requests.get(f"{API_BASE_URL}/api/order-items/{item_id}/")
+                item_resp = await API_CLIENT.get(f"/api/order-items/{item_id}/")
                 if item_resp.status_code == 200:
                     order_id = item_resp.json().get("order")
                     if order_id:
                         # Verificar si es el único item en el pedido
-                        order_resp = requests.get(f"{API_BASE_URL}/api/orders/{order_id}/")
+                        order_resp = await API_CLIENT.get(f"/api/orders/{order_id}/")
                         if order_resp.status_code == 200:
                             items = order_resp.json().get('items', [])
                             if len(items) <= 1:
                                 # Si es el único item, eliminar todo el pedido
                                 logger.info(f"Item {item_id} es el único en el pedido {order_id}, eliminando pedido completo")
-                                cancel_resp = requests.delete(f"{API_BASE_URL}/api/orders/{order_id}/cancel/")
+                                cancel_resp = await API_CLIENT.delete(f"/api/orders/{order_id}/cancel/")
                                 if cancel_resp.status_code in (200, 202, 204):
                                     return "✅ Tu pedido ha sido eliminado completamente."
             except Exception as e:
                 logger.error(f"Error al verificar pedido del item: {e}")
                 
             return "⚙️ No pude eliminar el artículo. Intenta de nuevo más tarde."
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error al eliminar OrderItem {item_id}: {e}")
         return "⚙️ No pude eliminar el artículo."
 
@@ -618,7 +785,7 @@ def delete_order_item_api(item_id: int) -> str:
 async def reservas_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Muestra los pedidos/reservas del usuario."""
     user = update.effective_user
-    orders_text, _ = _fetch_orders_with_map(user.id)
+    orders_text, _ = await _fetch_orders_with_map(user.id)
     await update.message.reply_text(orders_text, parse_mode=None)
 
     # Registrar conversación
@@ -626,11 +793,12 @@ async def reservas_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user=user,
         user_text=update.message.text,
         bot_text=orders_text,
+        received_at=update.message.date,
     )
 
 # --- Cancelar reserva ---
 
-def cancel_order_api(order_id: int) -> str:
+async def cancel_order_api(order_id: int) -> str:
     """Intenta eliminar completamente un pedido."""
     if not API_BASE_URL:
         return "Error: La URL de la API no está configurada."
@@ -638,7 +806,7 @@ def cancel_order_api(order_id: int) -> str:
     try:
         # Intentamos eliminar directamente el pedido con DELETE
         logger.info(f"Intentando eliminar pedido {order_id} mediante DELETE")
-        del_resp = requests.delete(f"{API_BASE_URL}/api/orders/{order_id}/")
+        del_resp = await API_CLIENT.delete(f"/api/orders/{order_id}/")
         
         if del_resp.status_code == 204:
             logger.info(f"Pedido {order_id} eliminado correctamente")
@@ -646,7 +814,7 @@ def cancel_order_api(order_id: int) -> str:
             
         # Si DELETE directo falla, intentamos con el endpoint específico de cancelación
         logger.warning(f"DELETE directo falló con código {del_resp.status_code}, intentando endpoint cancel")
-        cancel_resp = requests.delete(f"{API_BASE_URL}/api/orders/{order_id}/cancel/")
+        cancel_resp = await API_CLIENT.delete(f"/api/orders/{order_id}/cancel/")
         
         if cancel_resp.status_code in (200, 202, 204):
             logger.info(f"Pedido {order_id} eliminado mediante endpoint cancel")
@@ -656,7 +824,7 @@ def cancel_order_api(order_id: int) -> str:
         logger.warning(f"Endpoint cancel falló con código {cancel_resp.status_code}, intentando eliminar items individualmente")
         
         # Obtener detalles del pedido para acceder a sus items
-        order_resp = requests.get(f"{API_BASE_URL}/api/orders/{order_id}/")
+        order_resp = await API_CLIENT.get(f"/api/orders/{order_id}/")
         if order_resp.status_code == 200:
             order_data = order_resp.json()
             items = order_data.get('items', [])
@@ -667,12 +835,12 @@ def cancel_order_api(order_id: int) -> str:
                     if item_id:
                         logger.info(f"Intentando eliminar item {item_id} del pedido {order_id}")
                         try:
-                            requests.delete(f"{API_BASE_URL}/api/order-items/{item_id}/")
+                            await API_CLIENT.delete(f"/api/order-items/{item_id}/")
                         except Exception as e:
                             logger.error(f"Error al eliminar item {item_id}: {e}")
                 
                 # Después de eliminar todos los items, intentamos eliminar el pedido vacío
-                final_del = requests.delete(f"{API_BASE_URL}/api/orders/{order_id}/")
+                final_del = await API_CLIENT.delete(f"/api/orders/{order_id}/")
                 
                 if final_del.status_code == 204:
                     logger.info(f"Pedido {order_id} eliminado después de vaciar sus items")
@@ -681,7 +849,7 @@ def cancel_order_api(order_id: int) -> str:
         logger.error(f"Todos los intentos de eliminación para el pedido {order_id} fallaron")
         return "❌ No se pudo eliminar la reserva. Por favor, intenta más tarde."
 
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Error al eliminar reserva {order_id}: {e}")
         return "⚙️ No pude eliminar la reserva en este momento."
 
@@ -696,37 +864,45 @@ async def cancelar_reserva_handler(update: Update, context: ContextTypes.DEFAULT
 
     # Paso 1: sin número -> mostrar lista de pedidos
     if not args:
-        orders_text, index_map = _fetch_orders_with_map(user.id)
+        orders_text, index_map = await _fetch_orders_with_map(user.id)
         if index_map:
-            context.user_data['cancel_map'] = index_map
+            # Claves como texto: el estado se guarda en JSON
+            await BOT_STATE.set(
+                "cancel_map", user.id, {str(idx): order_id for idx, order_id in index_map.items()},
+                ttl=CANCEL_MAP_TTL,
+            )
             orders_text += "\n\nResponde con /cancelar <número> para eliminar el pedido completo."
         await update.message.reply_text(orders_text, parse_mode=None)
         return
 
     # Paso 2: con número provisto - eliminar pedido completo
     if len(args) == 1 and args[0].isdigit():
-        if 'cancel_map' not in context.user_data:
+        cancel_map = await BOT_STATE.get("cancel_map", user.id)
+        if cancel_map is None:
             await update.message.reply_text("Primero usa /cancelar sin argumentos para listar tus pedidos y obtener sus números.")
             return
 
         idx = int(args[0])
-        order_id = context.user_data['cancel_map'].get(idx)
+        order_id = cancel_map.get(str(idx))
         if not order_id:
             await update.message.reply_text("Número inválido. Prueba de nuevo con /cancelar.")
             return
 
         logger.info(f"Usuario {user.id} solicitó eliminar pedido #{idx} (ID: {order_id})")
-        result_text = cancel_order_api(order_id)
+        result_text = await cancel_order_api(order_id)
+        # La cancelación devuelve stock al catálogo
+        PRODUCTS_CACHE.invalidate()
         await update.message.reply_text(result_text, parse_mode=None)
 
         # Limpiar cache
-        context.user_data.pop('cancel_map', None)
+        await BOT_STATE.delete("cancel_map", user.id)
 
         # Registrar interacción
         await log_conversation(
             user=user,
             user_text=update.message.text,
             bot_text=result_text,
+            received_at=update.message.date,
         )
         return
 
@@ -735,16 +911,48 @@ async def cancelar_reserva_handler(update: Update, context: ContextTypes.DEFAULT
 
 # --- Función Principal ---
 
-def main():
-    """Inicia el bot de Telegram."""
-    if not all([TELEGRAM_BOT_TOKEN, API_BASE_URL]):
-        logger.critical("Faltan variables de entorno críticas (TELEGRAM_BOT_TOKEN o API_BASE_URL). El bot no puede iniciar.")
+async def load_intents_from_api():
+    """Con ``INTENTS_SOURCE=api`` reemplaza las intenciones del archivo por las de la API."""
+    if INTENTS_SOURCE != "api" or not API_BASE_URL:
         return
-
-    logger.info("Iniciando el bot...")
-    
+    try:
+        loaded = await IntentRouter.from_api(API_CLIENT)
+    except httpx.HTTPError as e:
+        logger.error(f"No se pudieron cargar las intenciones desde la API; se usan las del archivo: {e}")
+        return
+    if loaded.intents:
+        INTENT_ROUTER.set_intents(loaded.intents.values())
+    else:
+        logger.warning("La API no tiene intenciones activas; se usan las del archivo.")
+
+async def on_startup(app):
+    """Arranca las tareas de segundo plano del bot."""
+    await load_intents_from_api()
+    CONVERSATION_LOGGER.start()
+    BOT_STATE.start()
+    METRICS_REPORTER.start()
+
+async def on_shutdown(app):
+    """Envía los mensajes y el estado pendientes y libera el pool de conexiones HTTP al detener el bot."""
+    await METRICS_REPORTER.stop()
+    await CONVERSATION_LOGGER.stop()
+    await CONVERSATION_MEMORY.wait_idle()
+    await BOT_STATE.stop()
+    await API_CLIENT.aclose()
+
+def build_application():
+    """Crea la aplicación de Telegram con todos los handlers; sirve para polling y para webhook."""
     defaults = Defaults(parse_mode=ParseMode.MARKDOWN)
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).defaults(defaults).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .defaults(defaults)
+        # Chats distintos en paralelo, cada chat en orden
+        .concurrent_updates(PerChatUpdateProcessor())
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Handlers
     app.add_handler(CommandHandler("start", start))
@@ -755,6 +963,16 @@ def main():
     app.add_handler(CommandHandler("reservas", reservas_handler))
     app.add_handler(CommandHandler("cancelar", cancelar_reserva_handler))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
+    return app
+
+def main():
+    """Inicia el bot de Telegram en modo polling (para webhook, ver ``asgi.py``)."""
+    if not all([TELEGRAM_BOT_TOKEN, API_BASE_URL]):
+        logger.critical("Faltan variables de entorno críticas (TELEGRAM_BOT_TOKEN o API_BASE_URL). El bot no puede iniciar.")
+        return
+
+    logger.info("Iniciando el bot...")
+    app = build_application()
     
     logger.info("Bot configurado y listo. Iniciando polling...")
     print("-------> BOT INICIADO Y ESCUCHANDO <-------")
@@ -762,4 +980,4 @@ def main():
     logger.info("El bot se ha detenido.")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Cada cuántos segundos se vuelca el snapshot de métricas al log (0 lo desactiva)
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", "300"))
+
+
+class Metrics:
+    """
+    Registro de métricas en proceso: contadores y observaciones (latencias, tamaños...).
+
+    Las observaciones guardan count/sum/min/max/last, suficiente para calcular medias
+    y detectar picos sin dependencias externas. ``snapshot()`` devuelve una copia
+    lista para loguear o exponer.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._observations: Dict[str, Dict[str, float]] = {}
+
+    def incr(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            obs = self._observations.get(name)
+            if obs is None:
+                self._observations[name] = {"count": 1, "sum": value, "min": value, "max": value, "last": value}
+                return
+            obs["count"] += 1
+            obs["sum"] += value
+            obs["min"] = min(obs["min"], value)
+            obs["max"] = max(obs["max"], value)
+            obs["last"] = value
+
+    def counter(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def observation(self, name: str) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._observations.get(name, {}))
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            observations = {
+                name: {**obs, "avg": obs["sum"] / obs["count"]}
+                for name, obs in self._observations.items()
+            }
+            return {"counters": dict(self._counters), "observations": observations}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._observations.clear()
+
+
+# Registro global compartido por todos los módulos del bot
+METRICS = Metrics()
+
+
+class MetricsReporter:
+    """
+    Tarea de segundo plano que escribe ``snapshot()`` en el log cada ``interval``
+    segundos, para poder seguir las métricas en modo polling, donde no hay servidor
+    HTTP que exponga ``/metrics``.
+    """
+
+    def __init__(self, metrics: Metrics = METRICS, interval: float = METRICS_LOG_INTERVAL):
+        self.metrics = metrics
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detiene la tarea y deja un último snapshot en el log."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self.log_snapshot()
+
+    def log_snapshot(self):
+        logger.info(f"Métricas: {json.dumps(self.metrics.snapshot(), sort_keys=True)}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.log_snapshot()
@@ -0,0 +1,133 @@
+import logging
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from metrics import METRICS
+from retrieval import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Presupuesto total (tokens estimados) de un prompt
+PROMPT_BUDGET_TOKENS = int(os.environ.get("PROMPT_BUDGET_TOKENS", "2500"))
+
+# Políticas de recorte por sección
+FIXED = "fixed"          # Nunca se recorta (instrucciones, mensaje del usuario)
+KEEP_HEAD = "keep_head"  # Se conservan las primeras líneas (listas ordenadas por relevancia)
+KEEP_TAIL = "keep_tail"  # Se conservan las últimas líneas (historial: lo más reciente)
+DROP = "drop"            # Entera o nada
+
+TRUNCATION_MARK = "[...]"
+
+
+@dataclass
+class Section:
+    name: str
+    body: str
+    policy: str = FIXED
+    # Orden de recorte: se recortan antes las secciones con número mayor
+    cut_order: int = 0
+    header: str = ""
+    footer: str = ""
+
+
+@dataclass
+class BuiltPrompt:
+    text: str
+    total_tokens: int
+    sizes: Dict[str, int]
+    truncated: List[str]
+
+
+def _fit_lines(lines: List[str], budget: int, estimator, from_end: bool) -> List[str]:
+    """Toma líneas por el principio (o por el final) mientras quepan en ``budget`` tokens."""
+    kept, used = [], 0
+    for line in (reversed(lines) if from_end else lines):
+        cost = estimator(line + "\n")
+        if used + cost > budget:
+            if not kept and budget > 0:
+                # Ni siquiera cabe una línea entera: se corta por caracteres
+                chars = budget * 4
+                kept.append(line[-chars:] if from_end else line[:chars])
+            break
+        kept.append(line)
+        used += cost
+    return list(reversed(kept)) if from_end else kept
+
+
+class PromptBuilder:
+    """
+    Arma un prompt a partir de secciones con nombre sin pasar de ``budget_tokens``.
+
+    Si el total estimado supera el presupuesto se recortan secciones según su
+    política, empezando por la de mayor ``cut_order``, solo lo necesario. Una sección
+    que queda vacía se omite con su encabezado. ``build()`` registra en las métricas
+    el tamaño de cada sección (``prompt.<tipo>.tokens.<sección>``) y los recortes.
+    """
+
+    def __init__(self, kind: str, budget_tokens: int = PROMPT_BUDGET_TOKENS,
+                 estimator: Callable[[str], int] = estimate_tokens):
+        self.kind = kind
+        self.budget_tokens = budget_tokens
+        self.estimator = estimator
+        self.sections: List[Section] = []
+
+    def add(self, name: str, body: str, *, policy: str = FIXED, cut_order: int = 0,
+            header: str = "", footer: str = "") -> "PromptBuilder":
+        self.sections.append(Section(name, body or "", policy, cut_order, header, footer))
+        return self
+
+    def _render(self, section: Section) -> str:
+        return f"{section.header}{section.body}{section.footer}" if section.body.strip() else ""
+
+    def _size(self, section: Section) -> int:
+        return self.estimator(self._render(section))
+
+    def _truncate(self, section: Section, budget: int):
+        """Deja ``section`` en como mucho ``budget`` tokens según su política."""
+        if section.policy == DROP:
+            section.body = ""
+            return
+        overhead = self.estimator(section.header + section.footer + TRUNCATION_MARK + "\n")
+        if budget <= overhead:
+            section.body = ""
+            return
+        from_end = section.policy == KEEP_TAIL
+        kept = _fit_lines(section.body.splitlines(), budget - overhead, self.estimator, from_end)
+        if not kept:
+            section.body = ""
+        elif from_end:
+            section.body = "\n".join([TRUNCATION_MARK] + kept)
+        else:
+            section.body = "\n".join(kept + [TRUNCATION_MARK])
+
+    def build(self) -> BuiltPrompt:
+        sizes = {s.name: self._size(s) for s in self.sections}
+        total = sum(sizes.values())
+        truncated = []
+        if total > self.budget_tokens:
+            cuttable = [s for s in self.sections if s.policy != FIXED and sizes[s.name]]
+            for section in sorted(cuttable, key=lambda s: s.cut_order, reverse=True):
+                overflow = total - self.budget_tokens
+                if overflow <= 0:
+                    break
+                self._truncate(section, sizes[section.name] - overflow)
+                new_size = self._size(section)
+                total -= sizes[section.name] - new_size
+                sizes[section.name] = new_size
+                truncated.append(section.name)
+                METRICS.incr(f"prompt.{self.kind}.truncated.{section.name}")
+            if total > self.budget_tokens:
+                METRICS.incr(f"prompt.{self.kind}.over_budget")
+                logger.warning(
+                    f"El prompt '{self.kind}' ocupa {total} tokens estimados, por encima del presupuesto "
+                    f"de {self.budget_tokens}, aun recortando todo lo posible."
+                )
+
+        for name, size in sizes.items():
+            METRICS.observe(f"prompt.{self.kind}.tokens.{name}", size)
+        METRICS.observe(f"prompt.{self.kind}.total_tokens", total)
+        if truncated:
+            logger.info(f"Prompt '{self.kind}' recortado en: {', '.join(truncated)} ({sizes}).")
+        text = "".join(self._render(s) for s in self.sections)
+        return BuiltPrompt(text, total, sizes, truncated)
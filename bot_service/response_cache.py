@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional, Tuple
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración de la caché de respuestas del modelo ---
+RESPONSE_CACHE_BACKEND = os.environ.get("RESPONSE_CACHE_BACKEND", "memory")  # "memory" o "sqlite"
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "500"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+
+
+def make_key(kind: str, normalized_text: str, template_version: int, data_versions: Tuple = ()) -> str:
+    """
+    Clave estable para una respuesta: tipo de prompt, texto normalizado del usuario,
+    versión de la plantilla y versiones de los datos (catálogo, FAQs) usados en el prompt.
+    """
+    raw = json.dumps([kind, normalized_text, template_version, list(data_versions)], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """Backend LRU + TTL en memoria del proceso."""
+
+    def __init__(self, max_entries: int, ttl: float, clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= self._clock():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """Backend LRU + TTL en un archivo SQLite local; sobrevive a reinicios del bot."""
+
+    # Hace E/S de disco: ``ResponseCache`` lo llama desde un hilo aparte
+    blocking = True
+
+    def __init__(self, path: str, max_entries: int, ttl: float, clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS response_cache_lru ON response_cache (last_access)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = self._clock()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] <= now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE response_cache SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = self._clock()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (now,))
+            self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                " SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM response_cache")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    Caché de respuestas del modelo con contadores de aciertos y fallos.
+
+    Los backends con ``blocking = True`` (SQLite) se ejecutan con ``asyncio.to_thread``
+    para no frenar el bucle de eventos con la E/S de disco.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def _call(self, method, *args):
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get(self, key: str) -> Optional[str]:
+        try:
+            value = await self._call(self.backend.get, key)
+        except sqlite3.Error as e:
+            logger.error(f"Error al leer la caché de respuestas: {e}")
+            value = None
+        METRICS.incr("response_cache.hits" if value is not None else "response_cache.misses")
+        return value
+
+    async def set(self, key: str, value: str):
+        if not value:
+            return
+        try:
+            await self._call(self.backend.set, key, value)
+        except sqlite3.Error as e:
+            logger.error(f"Error al escribir en la caché de respuestas: {e}")
+
+    async def clear(self):
+        await self._call(self.backend.clear)
+
+
+def build_response_cache() -> ResponseCache:
+    """Crea la caché según ``RESPONSE_CACHE_BACKEND``."""
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        backend = SQLiteBackend(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    else:
+        backend = MemoryBackend(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+    logger.info(f"Caché de respuestas del modelo: backend '{RESPONSE_CACHE_BACKEND}'.")
+    return ResponseCache(backend)
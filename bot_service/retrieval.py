@@ -0,0 +1,186 @@
+import math
+import re
+import unicodedata
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Palabras vacías frecuentes en español que no aportan a la búsqueda
+STOPWORDS = {
+    "a", "al", "algo", "como", "con", "cual", "cuales", "de", "del", "el", "en", "es", "esa", "ese",
+    "eso", "esta", "este", "hay", "la", "las", "lo", "los", "me", "mi", "mis", "muy", "o", "para",
+    "pero", "por", "que", "se", "si", "sin", "son", "su", "sus", "te", "tu", "tus", "un", "una", "uno",
+    "unos", "unas", "y", "ya", "yo", "quiero", "tienen", "tienes", "puedo",
+}
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def fold_accents(text: str) -> str:
+    """Pasa a minúsculas y elimina tildes/diacríticos ("Órdenes" -> "ordenes")."""
+    decomposed = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _stem(token: str) -> str:
+    # Stemming mínimo para plurales: "celulares" -> "celular", "fundas" -> "funda"
+    if len(token) > 4 and token.endswith("es"):
+        return token[:-2]
+    if len(token) > 3 and token.endswith("s"):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    return [_stem(t) for t in _TOKEN_RE.findall(fold_accents(text)) if t not in STOPWORDS]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata de tokens del modelo (~4 caracteres por token)."""
+    return max(1, math.ceil(len(text) / 4)) if text else 0
+
+
+class BM25Index:
+    """
+    Índice BM25 en memoria que se actualiza de forma incremental.
+
+    ``sync()`` recibe el conjunto completo de documentos y solo re-indexa los que
+    cambiaron, se añadieron o desaparecieron, ajustando las frecuencias globales
+    sin reconstruir todo el índice.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs: Dict[Any, Tuple[str, Counter, int, Any]] = {}
+        self._df: Counter = Counter()
+        self._total_len = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def upsert(self, doc_id, text: str, payload: Any = None):
+        current = self._docs.get(doc_id)
+        if current is not None:
+            if current[0] == text:
+                # Mismo texto: solo refrescamos el payload (p. ej. cambió el stock)
+                self._docs[doc_id] = (text, current[1], current[2], payload)
+                return
+            self.remove(doc_id)
+        tokens = tokenize(text)
+        tf = Counter(tokens)
+        self._docs[doc_id] = (text, tf, len(tokens), payload)
+        self._df.update(tf.keys())
+        self._total_len += len(tokens)
+
+    def remove(self, doc_id):
+        current = self._docs.pop(doc_id, None)
+        if current is None:
+            return
+        _, tf, length, _ = current
+        # Solo se tocan los términos del documento; los que llegan a cero se borran
+        for term in tf:
+            if self._df[term] <= 1:
+                del self._df[term]
+            else:
+                self._df[term] -= 1
+        self._total_len -= length
+
+    def sync(self, documents: Iterable[Tuple[Any, str, Any]]) -> int:
+        """Sincroniza el índice con ``(id, texto, payload)``. Devuelve cuántos documentos cambiaron."""
+        seen = set()
+        changed = 0
+        for doc_id, text, payload in documents:
+            seen.add(doc_id)
+            current = self._docs.get(doc_id)
+            if current is None or current[0] != text:
+                changed += 1
+            self.upsert(doc_id, text, payload)
+        for doc_id in [d for d in self._docs if d not in seen]:
+            self.remove(doc_id)
+            changed += 1
+        return changed
+
+    def search(self, query: str, k: int = 5) -> List[Tuple[float, Any]]:
+        """Devuelve hasta ``k`` pares ``(puntuación, payload)`` con puntuación > 0."""
+        terms = set(tokenize(query))
+        if not terms or not self._docs:
+            return []
+        n = len(self._docs)
+        avgdl = self._total_len / n if n else 0
+        scored = []
+        for text, tf, length, payload in self._docs.values():
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if not freq:
+                    continue
+                df = self._df[term]
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                norm = freq + self.k1 * (1 - self.b + self.b * (length / avgdl if avgdl else 0))
+                score += idf * freq * (self.k1 + 1) / norm
+            if score > 0:
+                scored.append((score, payload))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored[:k]
+
+
+def select_within_budget(items: Iterable[Any], render: Callable[[Any], str], budget_tokens: int) -> List[str]:
+    """Renderiza ``items`` en orden hasta agotar el presupuesto de tokens."""
+    lines = []
+    used = 0
+    for item in items:
+        line = render(item)
+        cost = estimate_tokens(line)
+        if used + cost > budget_tokens:
+            break
+        lines.append(line)
+        used += cost
+    return lines
+
+
+class KnowledgeRetriever:
+    """
+    Elige, para cada mensaje, los productos y FAQs relevantes en lugar de enviar todo.
+
+    Los índices se sincronizan con las cachés del catálogo cuando cambia su ``version``.
+    """
+
+    def __init__(self, products_cache, faqs_cache):
+        self.products_cache = products_cache
+        self.faqs_cache = faqs_cache
+        self.products_index = BM25Index()
+        self.faqs_index = BM25Index()
+        self._products_version: Optional[int] = None
+        self._faqs_version: Optional[int] = None
+
+    async def _sync_products(self) -> List[dict]:
+        products = await self.products_cache.get()
+        if self.products_cache.version != self._products_version:
+            self.products_index.sync(
+                (p["id"], f"{p.get('name', '')} {p.get('description', '')} {p.get('category_name', '')}", p)
+                for p in products
+            )
+            self._products_version = self.products_cache.version
+        return products
+
+    async def _sync_faqs(self) -> List[dict]:
+        faqs = await self.faqs_cache.get()
+        if self.faqs_cache.version != self._faqs_version:
+            self.faqs_index.sync(
+                (f["id"], f"{f.get('question', '')} {f.get('answer', '')} {f.get('category_name', '')}", f)
+                for f in faqs
+            )
+            self._faqs_version = self.faqs_cache.version
+        return faqs
+
+    async def products_for(self, query: str, k: int, budget_tokens: int, render: Callable[[dict], str]) -> List[str]:
+        """Productos relevantes; si nada coincide, los primeros del catálogo."""
+        products = await self._sync_products()
+        hits = [p for _, p in self.products_index.search(query, k)]
+        return select_within_budget(hits or products[:k], render, budget_tokens)
+
+    async def faqs_for(self, query: str, k: int, budget_tokens: int, render: Callable[[dict], str]) -> List[str]:
+        """FAQs relevantes para la consulta (puede devolver una lista vacía)."""
+        await self._sync_faqs()
+        hits = [f for _, f in self.faqs_index.search(query, k)]
+        return select_within_budget(hits, render, budget_tokens)
@@ -0,0 +1,334 @@
+import abc
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+from urllib.parse import quote
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del estado compartido del bot ---
+BOT_STATE_BACKEND = os.environ.get("BOT_STATE_BACKEND", "sqlite")  # "sqlite", "memory" o "api"
+BOT_STATE_PATH = os.environ.get("BOT_STATE_PATH", "bot_state.sqlite3")
+BOT_STATE_MAX_ENTRIES = int(os.environ.get("BOT_STATE_MAX_ENTRIES", "10000"))
+BOT_STATE_FLUSH_INTERVAL = float(os.environ.get("BOT_STATE_FLUSH_INTERVAL", "0.5"))
+BOT_STATE_MAX_PENDING = int(os.environ.get("BOT_STATE_MAX_PENDING", "500"))
+BOT_STATE_PURGE_INTERVAL = float(os.environ.get("BOT_STATE_PURGE_INTERVAL", "300"))
+
+BOT_STATE_API_PATH = "/api/bot-state/"
+
+# (namespace, clave, valor o None para borrar, caduca_en o None)
+Write = Tuple[str, str, Any, Optional[float]]
+
+
+class StateStore(abc.ABC):
+    """
+    Interfaz de los almacenes de estado del bot.
+
+    Los valores deben ser serializables a JSON. Los métodos son asíncronos para que
+    un almacén de red (como ``APIStateStore``) pueda implementarlos sin bloquear el
+    event loop; basta con implementar estos métodos y registrarlo en
+    ``build_state_store``.
+    """
+
+    @abc.abstractmethod
+    async def get(self, namespace: str, key: str) -> Any:
+        """Devuelve el valor guardado, o ``None`` si no existe o caducó."""
+
+    @abc.abstractmethod
+    async def write_many(self, writes: List[Write]):
+        """Aplica un lote de escrituras y borrados (valor ``None``) de una vez."""
+
+    @abc.abstractmethod
+    async def purge_expired(self) -> int:
+        """Elimina las entradas caducadas y devuelve cuántas había."""
+
+    async def close(self):
+        pass
+
+
+class MemoryStateStore(StateStore):
+    """Almacén LRU acotado en memoria; no se comparte entre procesos ni sobrevive a reinicios."""
+
+    def __init__(self, max_entries: int = BOT_STATE_MAX_ENTRIES, clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Optional[float], Any]]" = OrderedDict()
+
+    async def get(self, namespace: str, key: str) -> Any:
+        entry = self._entries.get((namespace, key))
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at <= self._clock():
+            del self._entries[(namespace, key)]
+            return None
+        self._entries.move_to_end((namespace, key))
+        return value
+
+    async def write_many(self, writes: List[Write]):
+        for namespace, key, value, expires_at in writes:
+            if value is None:
+                self._entries.pop((namespace, key), None)
+                continue
+            # Copia vía JSON: mismo comportamiento que un almacén persistente
+            self._entries[(namespace, key)] = (expires_at, json.loads(json.dumps(value)))
+            self._entries.move_to_end((namespace, key))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def purge_expired(self) -> int:
+        now = self._clock()
+        expired = [k for k, (expires_at, _) in self._entries.items() if expires_at is not None and expires_at <= now]
+        for k in expired:
+            del self._entries[k]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Almacén en un archivo SQLite local: sobrevive a reinicios y lo comparten los
+    workers de la misma máquina. Cuando supera ``max_entries`` se eliminan las
+    entradas escritas hace más tiempo. Las llamadas a sqlite3 se hacen con
+    ``asyncio.to_thread`` para no bloquear el event loop.
+    """
+
+    def __init__(self, path: str = BOT_STATE_PATH, max_entries: int = BOT_STATE_MAX_ENTRIES,
+                 clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS bot_state ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " expires_at REAL, updated_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS bot_state_updated ON bot_state (updated_at)")
+
+    async def get(self, namespace: str, key: str) -> Any:
+        return await asyncio.to_thread(self._get, namespace, key)
+
+    async def write_many(self, writes: List[Write]):
+        await asyncio.to_thread(self._write_many, writes)
+
+    async def purge_expired(self) -> int:
+        return await asyncio.to_thread(self._purge_expired)
+
+    async def close(self):
+        await asyncio.to_thread(self._close)
+
+    def _get(self, namespace: str, key: str) -> Any:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM bot_state WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        if row is None or (row[1] is not None and row[1] <= self._clock()):
+            return None
+        return json.loads(row[0])
+
+    def _write_many(self, writes: List[Write]):
+        now = self._clock()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for namespace, key, value, expires_at in writes:
+                    if value is None:
+                        self._conn.execute("DELETE FROM bot_state WHERE namespace = ? AND key = ?", (namespace, key))
+                    else:
+                        self._conn.execute(
+                            "INSERT OR REPLACE INTO bot_state (namespace, key, value, expires_at, updated_at)"
+                            " VALUES (?, ?, ?, ?, ?)",
+                            (namespace, key, json.dumps(value, ensure_ascii=False), expires_at, now),
+                        )
+                self._conn.execute(
+                    "DELETE FROM bot_state WHERE rowid IN ("
+                    " SELECT rowid FROM bot_state ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _purge_expired(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM bot_state WHERE expires_at IS NOT NULL AND expires_at <= ?", (self._clock(),)
+            ).rowcount
+
+    def _close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class APIStateStore(StateStore):
+    """
+    Almacén en la API de Django (``/api/bot-state/``): lo comparten todos los workers,
+    estén en la máquina que estén. Cada volcado de ``BotState`` es una sola petición;
+    las entradas caducadas no se devuelven y la purga periódica las borra en la API.
+    El cliente HTTP es compartido y no se cierra aquí.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    async def get(self, namespace: str, key: str) -> Any:
+        response = await self.client.get(f"{BOT_STATE_API_PATH}{quote(namespace, safe='')}/{quote(key, safe='')}/")
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return response.json()["value"]
+
+    async def write_many(self, writes: List[Write]):
+        response = await self.client.post(BOT_STATE_API_PATH, json={"writes": [
+            {"namespace": namespace, "key": key, "value": value, "expires_at": expires_at}
+            for namespace, key, value, expires_at in writes
+        ]})
+        response.raise_for_status()
+
+    async def purge_expired(self) -> int:
+        response = await self.client.post(f"{BOT_STATE_API_PATH}purge/")
+        response.raise_for_status()
+        return response.json()["purged"]
+
+
+class BotState:
+    """
+    Estado por usuario/chat compartido entre workers, con escrituras agrupadas.
+
+    Las escrituras se acumulan en memoria (varias escrituras de la misma clave se
+    quedan en la última) y se envían al almacén en un solo lote cada
+    ``flush_interval`` segundos o en cuanto hay ``max_pending`` pendientes. Las
+    lecturas ven primero lo pendiente, así que cada worker lee sus propias
+    escrituras al instante y los demás tras el siguiente volcado. Las entradas con
+    ``ttl`` caducan solas y se purgan periódicamente.
+    """
+
+    _DELETED = object()
+
+    def __init__(
+        self,
+        store: StateStore,
+        *,
+        flush_interval: float = BOT_STATE_FLUSH_INTERVAL,
+        max_pending: int = BOT_STATE_MAX_PENDING,
+        purge_interval: float = BOT_STATE_PURGE_INTERVAL,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.purge_interval = purge_interval
+        self._clock = clock
+        self._pending: "OrderedDict[Tuple[str, str], Tuple[Any, Optional[float]]]" = OrderedDict()
+        self._worker: Optional[asyncio.Task] = None
+        self._flush_lock = asyncio.Lock()
+
+    async def get(self, namespace: str, key, default=None) -> Any:
+        pending = self._pending.get((namespace, str(key)))
+        if pending is not None:
+            value, expires_at = pending
+            if value is self._DELETED or (expires_at is not None and expires_at <= self._clock()):
+                return default
+            return value
+        try:
+            value = await self.store.get(namespace, str(key))
+        except Exception as e:
+            logger.error(f"Error al leer el estado del bot ({namespace}): {e}")
+            METRICS.incr("bot_state.read_errors")
+            value = None
+        return default if value is None else value
+
+    async def set(self, namespace: str, key, value: Any, ttl: Optional[float] = None):
+        expires_at = self._clock() + ttl if ttl is not None else None
+        await self._write(namespace, str(key), value, expires_at)
+
+    async def delete(self, namespace: str, key):
+        await self._write(namespace, str(key), self._DELETED, None)
+
+    async def _write(self, namespace: str, key: str, value: Any, expires_at: Optional[float]):
+        if (namespace, key) in self._pending:
+            METRICS.incr("bot_state.coalesced")
+        self._pending[(namespace, key)] = (value, expires_at)
+        self._pending.move_to_end((namespace, key))
+        if len(self._pending) >= self.max_pending:
+            await self.flush()
+
+    async def flush(self):
+        """Envía al almacén todas las escrituras pendientes en un solo lote."""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, OrderedDict()
+            writes = [
+                (namespace, key, None if value is self._DELETED else value, expires_at)
+                for (namespace, key), (value, expires_at) in batch.items()
+            ]
+            try:
+                await self.store.write_many(writes)
+            except Exception as e:
+                logger.error(f"No se pudo guardar el estado del bot ({len(writes)} claves): {e}")
+                METRICS.incr("bot_state.failed_flushes")
+                # Se reintenta en el próximo volcado sin pisar escrituras más nuevas y sin crecer sin límite
+                for item_key, item in batch.items():
+                    if item_key not in self._pending and len(self._pending) < self.max_pending:
+                        self._pending[item_key] = item
+                        self._pending.move_to_end(item_key, last=False)
+                return
+            METRICS.incr("bot_state.flushes")
+            METRICS.observe("bot_state.flush_size", len(writes))
+
+    # --- Worker ---
+
+    def start(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+        await self.store.close()
+
+    async def _run(self):
+        last_purge = self._clock()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if self._clock() - last_purge >= self.purge_interval:
+                last_purge = self._clock()
+                try:
+                    purged = await self.store.purge_expired()
+                    if purged:
+                        logger.info(f"Estado del bot: {purged} entradas caducadas eliminadas.")
+                except Exception as e:
+                    logger.error(f"Error al purgar el estado del bot: {e}")
+
+
+def build_state_store(client=None) -> StateStore:
+    """Crea el almacén según ``BOT_STATE_BACKEND``; ``api`` usa ``client`` (un ``APIClient``)."""
+    if BOT_STATE_BACKEND == "memory":
+        store = MemoryStateStore()
+    elif BOT_STATE_BACKEND == "api":
+        store = APIStateStore(client)
+    else:
+        store = SQLiteStateStore()
+    logger.info(f"Estado compartido del bot: backend '{BOT_STATE_BACKEND}'.")
+    return store
@@ -0,0 +1,1035 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+import httpx
+from telegram import Update
+
+from api_client import APIClient
+from catalog_cache import CachedResource
+from context_fanout import ContextSource, gather_context
+from conversation_logger import ConversationLogger
+from conversation_memory import ConversationMemory
+from faq_matcher import FAQMatcher, normalize_question
+from identity_cache import Identity, IdentityCache
+from intent_router import IntentRouter
+from llm import generate_text, stream_reply, stream_text
+from llm_scheduler import LLMScheduler, ModelOverloaded, Priority, TokenBucket
+from metrics import METRICS, MetricsReporter
+from prompt_builder import DROP, KEEP_HEAD, KEEP_TAIL, PromptBuilder
+from response_cache import MemoryBackend, ResponseCache, SQLiteBackend, make_key
+from retrieval import BM25Index, select_within_budget, tokenize
+from state_store import APIStateStore, BotState, MemoryStateStore, SQLiteStateStore, StateStore
+from update_processor import PerChatUpdateProcessor
+from webhook import create_webhook_app
+
+
+class FakeModel:
+    """Modelo local que imita ``genai.GenerativeModel`` devolviendo fragmentos fijos."""
+
+    def __init__(self, chunks, delay: float = 0, fail_after: int = None):
+        self.chunks = chunks
+        self.delay = delay
+        self.fail_after = fail_after
+        self.prompts = []
+
+    async def generate_content_async(self, prompt, stream=False):
+        self.prompts.append(prompt)
+
+        async def _iter():
+            for i, chunk in enumerate(self.chunks):
+                if self.fail_after is not None and i >= self.fail_after:
+                    raise RuntimeError("fallo del modelo")
+                await asyncio.sleep(self.delay)
+                yield SimpleNamespace(text=chunk)
+
+        return _iter()
+
+
+class FakeBot:
+    """Bot de Telegram falso que registra los envíos y ediciones."""
+
+    def __init__(self):
+        self.sent = []
+        self.edits = []
+
+    async def send_message(self, chat_id, text, parse_mode=None):
+        self.sent.append(text)
+        return SimpleNamespace(message_id=len(self.sent))
+
+    async def edit_message_text(self, chat_id, message_id, text, parse_mode=None):
+        self.edits.append((message_id, text))
+
+
+class StreamingTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    async def test_generate_text_joins_chunks(self):
+        model = FakeModel(["Hola", ", ", "mundo"])
+        self.assertEqual(await generate_text(model, "prompt"), "Hola, mundo")
+        self.assertEqual(model.prompts, ["prompt"])
+
+    async def test_first_chunk_is_sent_then_edited(self):
+        bot = FakeBot()
+        model = FakeModel(["Uno", " dos", " tres"])
+        text = await stream_reply(bot, 1, stream_text(model, "p"), edit_interval=0)
+        self.assertEqual(text, "Uno dos tres")
+        self.assertEqual(bot.sent, ["Uno"])
+        self.assertEqual(bot.edits[-1], (1, "Uno dos tres"))
+        self.assertEqual(METRICS.observation("reply.time_to_first_visible")["count"], 1)
+
+    async def test_edits_are_throttled(self):
+        bot = FakeBot()
+        model = FakeModel([str(i) for i in range(20)])
+        await stream_reply(bot, 1, stream_text(model, "p"), edit_interval=60)
+        # Solo el envío inicial y la edición final
+        self.assertEqual(len(bot.sent), 1)
+        self.assertEqual(len(bot.edits), 1)
+
+    async def test_long_reply_is_split(self):
+        bot = FakeBot()
+        model = FakeModel(["a" * 3000, "b" * 3000])
+        text = await stream_reply(bot, 1, stream_text(model, "p"), edit_interval=0)
+        self.assertEqual(len(text), 6000)
+        self.assertEqual(len(bot.sent), 2)
+
+    async def test_failure_before_text_propagates(self):
+        bot = FakeBot()
+        with self.assertRaises(RuntimeError):
+            await stream_reply(bot, 1, stream_text(FakeModel(["x"], fail_after=0), "p"))
+        self.assertEqual(bot.sent, [])
+
+    async def test_failure_after_text_keeps_partial(self):
+        bot = FakeBot()
+        text = await stream_reply(bot, 1, stream_text(FakeModel(["Parcial", "x"], fail_after=1), "p"))
+        self.assertEqual(text, "Parcial")
+        self.assertEqual(bot.sent, ["Parcial"])
+
+
+class RetrievalTests(unittest.TestCase):
+    def test_tokenize_folds_accents_and_plurals(self):
+        self.assertEqual(tokenize("¿Cuáles son los Envíos?"), ["envio"])
+
+    def test_search_ranks_relevant_documents(self):
+        index = BM25Index()
+        index.sync([
+            (1, "iPhone 15 celular Apple", "iphone"),
+            (2, "Funda de silicona para celulares", "funda"),
+            (3, "Audífonos inalámbricos", "audifonos"),
+        ])
+        results = [payload for _, payload in index.search("busco audifonos inalambricos")]
+        self.assertEqual(results[0], "audifonos")
+        self.assertNotIn("iphone", results)
+
+    def test_sync_is_incremental(self):
+        index = BM25Index()
+        self.assertEqual(index.sync([(1, "laptop gamer", 1), (2, "mouse", 2)]), 2)
+        self.assertEqual(index.sync([(1, "laptop gamer", 1), (2, "mouse", 2)]), 0)
+        self.assertEqual(index.sync([(1, "laptop gamer", 1), (3, "teclado", 3)]), 2)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.search("mouse"), [])
+
+    def test_remove_drops_only_exhausted_terms(self):
+        index = BM25Index()
+        index.sync([(1, "mouse gamer", 1), (2, "teclado gamer", 2)])
+        index.remove(1)
+        self.assertNotIn("mouse", index._df)
+        self.assertEqual(index._df["gamer"], 1)
+        index.remove(2)
+        self.assertEqual(len(index._df), 0)
+
+    def test_select_within_budget(self):
+        lines = select_within_budget(["a" * 40, "b" * 40, "c" * 40], str, budget_tokens=20)
+        self.assertEqual(len(lines), 2)
+
+
+class FAQMatcherTests(unittest.TestCase):
+    FAQS = [
+        {"id": 1, "question": "¿Cuáles son los métodos de pago?", "answer": "Tarjeta y transferencia."},
+        {"id": 2, "question": "¿Hacen envíos a todo el país?", "answer": "Sí, a todo el país."},
+        {"id": 3, "question": "¿Cuánto tarda el envío?", "answer": "De 2 a 5 días."},
+    ]
+
+    def test_normalize_question(self):
+        self.assertEqual(normalize_question("  ¿Cuáles son los MÉTODOS de pago? "), "cuales son los metodos de pago")
+
+    def test_near_literal_question_matches(self):
+        faq, score = FAQMatcher().match("cuales son los metodos de pago", self.FAQS)
+        self.assertEqual(faq["id"], 1)
+        self.assertGreaterEqual(score, 0.82)
+
+    def test_typo_still_matches(self):
+        faq, _ = FAQMatcher().match("cuales son los metodos d pagos?", self.FAQS)
+        self.assertEqual(faq["id"], 1)
+
+    def test_unrelated_question_goes_to_model(self):
+        self.assertIsNone(FAQMatcher().match("tienen garantía los celulares?", self.FAQS))
+
+    def test_normalized_questions_follow_the_current_faq_list(self):
+        matcher = FAQMatcher()
+        matcher.match("cuales son los metodos de pago", self.FAQS)
+        updated = [{"id": 4, "question": "¿Tienen garantía?", "answer": "Sí, 12 meses."}]
+        faq, _ = matcher.match("tienen garantia", updated)
+        self.assertEqual(faq["id"], 4)
+        self.assertEqual(list(matcher._normalized), ["¿Tienen garantía?"])
+
+
+class IntentRouterTests(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.router = IntentRouter.from_file()
+
+    def test_relative_path_is_resolved_against_the_module(self):
+        cwd = os.getcwd()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.chdir(tmp.name)
+        self.addCleanup(os.chdir, cwd)
+        self.assertIn("mis_pedidos", IntentRouter.from_file("intents.json").intents)
+
+    async def _from_api(self, results):
+        handler = lambda request: httpx.Response(200, json={"results": results})
+        return await IntentRouter.from_api(APIClient("http://api.test", transport=httpx.MockTransport(handler)))
+
+    def test_intents_from_api(self):
+        router = asyncio.run(self._from_api([
+            {"name": "garantia", "phrases": ["garantía"], "priority": 5, "response": "12 meses", "action": ""},
+        ]))
+        match = router.route("¿Tienen garantia?")
+        self.assertEqual(match.name, "garantia")
+        self.assertIsNone(match.intent.action)
+
+    def test_accent_and_case_insensitive(self):
+        self.assertEqual(self.router.route("¿QUÉ RESERVÉ ayer?").name, "mis_pedidos")
+        self.assertEqual(self.router.route("Cómo cancelo una reserva").name, "como_cancelar")
+        self.assertEqual(self.router.route("¿y por que esos?").name, "seguimiento_recomendacion")
+
+    def test_priority_and_whole_words(self):
+        match = self.router.route("por qué aparece en mis pedidos")
+        self.assertEqual(match.name, "mis_pedidos")
+        self.assertEqual(match.matched, ["mis_pedidos", "seguimiento_recomendacion"])
+        self.assertIsNone(self.router.route("quiero una funda resistente"))
+        # Una frase no puede empezar a mitad de palabra
+        self.assertIsNone(self.router.route("tengo un prerreservado"))
+
+    def test_plural_and_inflected_forms_still_match(self):
+        # Frases que la búsqueda por subcadenas original reconocía
+        for text, name in (
+            ("¿Cómo puedo cancelar reservas?", "como_cancelar"),
+            ("quiero cancelar pedidos viejos", "como_cancelar"),
+            ("Cancelar pedidos", "como_cancelar"),
+            ("enséñame mis reservas", "mis_pedidos"),
+            ("¿Qué tengo reservado?", "mis_pedidos"),
+            ("¿Cuáles son las razones?", "seguimiento_recomendacion"),
+            ("¿Por qué esas recomendaciones?", "seguimiento_recomendacion"),
+        ):
+            with self.subTest(text=text):
+                self.assertEqual(self.router.route(text).name, name)
+        self.assertEqual(self.router.route("cancelar reservas").phrase, "cancelar reserva")
+
+    def test_records_and_metrics(self):
+        router = IntentRouter.from_records([{"name": "saludo", "phrases": ["hola"], "response": "¡Hola!"}])
+        self.assertEqual(router.route("Hola, buenas").intent.response, "¡Hola!")
+        router.route("adiós")
+        self.assertEqual(METRICS.counter("intent.saludo"), 1)
+        self.assertEqual(METRICS.counter("intent.none"), 1)
+
+
+class PromptBuilderTests(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    def _builder(self, budget):
+        history = "\n".join(f"Usuario: mensaje número {i} bastante largo" for i in range(10))
+        return (
+            PromptBuilder("texto", budget_tokens=budget)
+            .add("instrucciones", "Eres un asistente.\n\n")
+            .add("historial", history, policy=KEEP_TAIL, cut_order=2, header="Historial:\n", footer="\n\n")
+            .add("faqs", "P: envío?\nR: 24h", policy=KEEP_HEAD, cut_order=1, header="FAQs:\n", footer="\n\n")
+            .add("reservas", "Pedido #1\nPedido #2", policy=DROP, cut_order=3, header="Reservas:\n", footer="\n")
+            .add("usuario", 'Usuario: "hola"')
+        )
+
+    def test_fits_without_truncation(self):
+        built = self._builder(1000).build()
+        self.assertEqual(built.truncated, [])
+        self.assertTrue(built.text.startswith("Eres un asistente.\n\nHistorial:\nUsuario: mensaje número 0"))
+        self.assertEqual(METRICS.observation("prompt.texto.tokens.historial")["count"], 1)
+
+    def test_sections_are_cut_in_order_within_budget(self):
+        built = self._builder(60).build()
+        self.assertLessEqual(built.total_tokens, 60)
+        self.assertEqual(built.truncated, ["reservas", "historial"])
+        self.assertNotIn("Reservas:", built.text)
+        self.assertIn("mensaje número 9", built.text)
+        self.assertNotIn("mensaje número 0", built.text)
+        self.assertIn("P: envío?", built.text)
+        self.assertTrue(built.text.endswith('Usuario: "hola"'))
+        self.assertEqual(METRICS.counter("prompt.texto.truncated.historial"), 1)
+
+    def test_fixed_sections_are_never_cut(self):
+        built = PromptBuilder("x", budget_tokens=2).add("usuario", "un mensaje largo " * 10).build()
+        self.assertEqual(built.text, "un mensaje largo " * 10)
+        self.assertEqual(METRICS.counter("prompt.x.over_budget"), 1)
+
+
+class ResponseCacheTests(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.now = [1000.0]
+
+    def _backends(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        clock = lambda: self.now[0]
+        return [
+            MemoryBackend(max_entries=2, ttl=60, clock=clock),
+            SQLiteBackend(os.path.join(tmp.name, "cache.sqlite3"), max_entries=2, ttl=60, clock=clock),
+        ]
+
+    def test_key_depends_on_versions(self):
+        self.assertNotEqual(make_key("ayuda", "envios", 1, ("a",)), make_key("ayuda", "envios", 1, ("b",)))
+        self.assertNotEqual(make_key("ayuda", "envios", 1, ("a",)), make_key("ayuda", "envios", 2, ("a",)))
+
+    def test_free_text_answers_are_not_shared_between_users(self):
+        import main
+
+        faqs = "P: ¿Hacen envíos?\nR: Sí."
+        ana = main.text_cache_key(1, "¿Qué reservé?", faqs, "Usuario: hola", "Pedido 7: Monitor", False)
+        luis = main.text_cache_key(2, "¿Qué reservé?", faqs, "Usuario: hola", "Pedido 9: Teclado", False)
+        self.assertNotEqual(ana, luis)
+        # Ni siquiera con el mismo contexto
+        self.assertNotEqual(ana, main.text_cache_key(2, "¿Qué reservé?", faqs, "Usuario: hola", "Pedido 7: Monitor", False))
+        self.assertEqual(ana, main.text_cache_key(1, "¿que reserve?", faqs, "Usuario: hola", "Pedido 7: Monitor", False))
+        # Con otro historial o con otras reservas, el mismo usuario tampoco recibe la respuesta anterior
+        self.assertNotEqual(ana, main.text_cache_key(1, "¿Qué reservé?", faqs, "Usuario: adiós", "Pedido 7: Monitor", False))
+        self.assertNotEqual(ana, main.text_cache_key(1, "¿Qué reservé?", faqs, "Usuario: hola", "", False))
+        self.assertIsNone(main.text_cache_key(1, "¿Qué reservé?", faqs, "Usuario: hola", "", True))
+
+    def test_lru_eviction_and_ttl(self):
+        for backend in self._backends():
+            with self.subTest(backend=type(backend).__name__):
+                backend.set("a", "1")
+                self.now[0] += 1
+                backend.set("b", "2")
+                self.now[0] += 1
+                self.assertEqual(backend.get("a"), "1")  # "a" pasa a ser el más reciente
+                self.now[0] += 1
+                backend.set("c", "3")
+                self.assertIsNone(backend.get("b"))
+                self.assertEqual(len(backend), 2)
+                self.now[0] += 120
+                self.assertIsNone(backend.get("a"))
+
+    def test_hit_and_miss_counters(self):
+        for backend in self._backends():
+            with self.subTest(backend=type(backend).__name__):
+                METRICS.reset()
+                cache = ResponseCache(backend)
+                self.assertIsNone(asyncio.run(cache.get("k")))
+                asyncio.run(cache.set("k", "respuesta"))
+                self.assertEqual(asyncio.run(cache.get("k")), "respuesta")
+                self.assertEqual(METRICS.counter("response_cache.hits"), 1)
+                self.assertEqual(METRICS.counter("response_cache.misses"), 1)
+
+
+class ConversationLoggerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.spill_path = os.path.join(tmp.name, "spill.jsonl")
+        self.requests = []
+        self.api_up = True
+
+    def _handler(self, request):
+        if not self.api_up:
+            return httpx.Response(503)
+        self.requests.append(request)
+        return httpx.Response(201, json={"results": []})
+
+    def _logger(self, **kwargs):
+        client = APIClient("http://api.test", transport=httpx.MockTransport(self._handler))
+        return ConversationLogger(client, spill_path=self.spill_path, **kwargs)
+
+    def _user(self, user_id=1):
+        return SimpleNamespace(id=user_id, username="ana", first_name="Ana", last_name=None)
+
+    async def test_exchanges_are_sent_in_one_batch(self):
+        conv_logger = self._logger(flush_interval=0.05)
+        conv_logger.start()
+        for i in range(5):
+            await conv_logger.log_exchange(self._user(i), f"hola {i}", f"respuesta {i}")
+        await conv_logger.stop()
+        self.assertEqual(len(self.requests), 1)
+        messages = json.loads(self.requests[0].content)["messages"]
+        self.assertEqual(len(messages), 10)
+        self.assertEqual([m["sender"] for m in messages[:2]], ["user", "bot"])
+
+    async def test_outage_spills_to_disk_and_recovers(self):
+        self.api_up = False
+        conv_logger = self._logger(flush_interval=0.01)
+        await conv_logger.log_exchange(self._user(), "hola", "respuesta")
+        await conv_logger.stop()
+        self.assertTrue(os.path.exists(self.spill_path))
+        self.assertEqual(METRICS.counter("conversation_log.spilled"), 2)
+
+        self.api_up = True
+        conv_logger = self._logger(flush_interval=0.01)
+        await conv_logger.log_exchange(self._user(), "otra", "vez")
+        await conv_logger.flush(conv_logger._drain_queue(10))
+        self.assertFalse(os.path.exists(self.spill_path))
+        self.assertEqual(METRICS.counter("conversation_log.sent"), 4)
+
+    async def test_full_queue_applies_backpressure_then_spills(self):
+        conv_logger = self._logger(max_queue=1, enqueue_timeout=0.01)
+        await conv_logger.log_exchange(self._user(), "hola", "respuesta")
+        self.assertEqual(METRICS.counter("conversation_log.backpressure"), 1)
+        self.assertEqual(METRICS.counter("conversation_log.spilled"), 1)
+
+    async def test_bulk_results_fill_identity_cache(self):
+        identities = IdentityCache()
+        self._handler = lambda request: httpx.Response(201, json={"results": [
+            {"index": 0, "id": 10, "conversation": 7, "user": 3},
+            {"index": 1, "id": 11, "conversation": 7, "user": 3},
+        ]})
+        conv_logger = self._logger(identities=identities)
+        await conv_logger.log_exchange(self._user(42), "hola", "respuesta")
+        await conv_logger.flush(conv_logger._drain_queue(10))
+        self.assertEqual(identities.get(42), Identity(3, 7))
+
+        await conv_logger.log_exchange(self._user(42), "otra", "vez")
+        self.assertEqual(conv_logger._drain_queue(1)[0]["conversation"], 7)
+
+    async def test_user_message_keeps_its_received_time(self):
+        conv_logger = self._logger()
+        received_at = datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc)
+        await conv_logger.log_exchange(self._user(), "hola", "respuesta", received_at=received_at)
+        user_record, bot_record = conv_logger._drain_queue(2)
+        self.assertEqual(user_record["timestamp"], received_at.isoformat())
+        self.assertGreater(bot_record["timestamp"], user_record["timestamp"])
+
+    async def test_rejected_items_are_retried_without_stale_conversation(self):
+        identities = IdentityCache()
+        identities.remember(42, 3, 7)
+        bodies = []
+
+        def handler(request):
+            messages = json.loads(request.content)["messages"]
+            bodies.append(messages)
+            if any(m.get("conversation") == 7 for m in messages):
+                return httpx.Response(400, json={"errors": [
+                    {"index": i, "errors": {}} for i, m in enumerate(messages) if m.get("conversation") == 7
+                ]})
+            return httpx.Response(201, json={"results": [
+                {"index": i, "id": i, "conversation": 8, "user": 3} for i in range(len(messages))
+            ]})
+
+        self._handler = handler
+        conv_logger = self._logger(identities=identities)
+        await conv_logger.log_exchange(self._user(42), "hola", "respuesta")
+        await conv_logger.log_exchange(self._user(43), "otro", "usuario")
+        await conv_logger.flush(conv_logger._drain_queue(10))
+
+        self.assertEqual(len(bodies), 2)
+        self.assertEqual([m["telegram_id"] for m in bodies[1]], ["43", "43", "42", "42"])
+        self.assertNotIn("conversation", bodies[1][2])
+        self.assertEqual(identities.get(42), Identity(3, 8))
+        self.assertEqual(METRICS.counter("conversation_log.sent"), 4)
+
+    async def test_interrupted_resend_is_recovered(self):
+        with open(f"{self.spill_path}.sending", "w", encoding="utf-8") as f:
+            f.write(json.dumps({"telegram_id": "1", "sender": "user", "content": "hola"}) + "\n")
+            f.write('{"telegram_id": "1", "sen')  # línea a medio escribir
+        conv_logger = self._logger()
+        await conv_logger.flush([])
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(len(json.loads(self.requests[0].content)["messages"]), 1)
+        self.assertFalse(os.path.exists(f"{self.spill_path}.sending"))
+
+
+class APIClientTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.version = 1
+        self.requests = []
+
+    def _handler(self, request):
+        self.requests.append(request)
+        etag = f'"catalog-{self.version}-json"'
+        if request.headers.get("If-None-Match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, json={"results": [{"id": self.version}]}, headers={"ETag": etag})
+
+    async def test_get_json_revalidates_with_etag(self):
+        client = APIClient("http://api.test", transport=httpx.MockTransport(self._handler))
+        first = await client.get_json("/api/products/", params={"limit": 100})
+        second = await client.get_json("/api/products/", params={"limit": 100})
+        self.assertIs(second, first)
+        self.assertNotIn("If-None-Match", self.requests[0].headers)
+        self.assertEqual(self.requests[1].headers["If-None-Match"], '"catalog-1-json"')
+        self.assertEqual(METRICS.counter("api.not_modified"), 1)
+
+        self.version = 2
+        third = await client.get_json("/api/products/", params={"limit": 100})
+        self.assertEqual(third, {"results": [{"id": 2}]})
+        # Otra consulta (otros parámetros) no reutiliza el ETag
+        await client.get_json("/api/products/", params={"limit": 10})
+        self.assertNotIn("If-None-Match", self.requests[-1].headers)
+        await client.aclose()
+
+    async def test_requests_share_one_pooled_client(self):
+        client = APIClient("http://api.test", transport=httpx.MockTransport(self._handler))
+        await client.get("/api/faqs/")
+        pooled = client.client
+        await client.post("/api/faqs/", json={})
+        await client.delete("/api/faqs/1/")
+        self.assertIs(client.client, pooled)
+        self.assertEqual([r.method for r in self.requests], ["GET", "POST", "DELETE"])
+        self.assertEqual(str(self.requests[0].url), "http://api.test/api/faqs/")
+
+    async def test_aclose_closes_and_a_new_request_reopens(self):
+        client = APIClient("http://api.test", transport=httpx.MockTransport(self._handler))
+        await client.get("/api/faqs/")
+        pooled = client.client
+        await client.aclose()
+        self.assertTrue(pooled.is_closed)
+        await client.aclose()  # idempotente
+        await client.get("/api/faqs/")
+        self.assertIsNot(client.client, pooled)
+        await client.aclose()
+
+    async def test_per_call_timeout_overrides_the_default(self):
+        seen = []
+
+        def handler(request):
+            seen.append(request.extensions["timeout"])
+            return httpx.Response(200, json={})
+
+        client = APIClient("http://api.test", timeout=10, connect_timeout=5, transport=httpx.MockTransport(handler))
+        await client.get("/a/")
+        await client.get("/b/", timeout=2)
+        self.assertEqual(seen[0]["read"], 10)
+        self.assertEqual(seen[1]["read"], 2)
+        self.assertEqual(seen[1]["connect"], 2)
+        await client.aclose()
+
+    async def test_transport_errors_and_http_errors_surface(self):
+        def failing(request):
+            raise httpx.ConnectTimeout("sin respuesta", request=request)
+
+        client = APIClient("http://api.test", transport=httpx.MockTransport(failing))
+        with self.assertRaises(httpx.TimeoutException):
+            await client.get("/api/faqs/")
+        await client.aclose()
+
+        client = APIClient("http://api.test", transport=httpx.MockTransport(lambda request: httpx.Response(500)))
+        with self.assertRaises(httpx.HTTPStatusError):
+            await client.get_json("/api/faqs/")
+        await client.aclose()
+
+
+class CachedResourceTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.loads = 0
+        self.gate = None
+
+    async def _loader(self):
+        self.loads += 1
+        load = self.loads
+        if self.gate is not None:
+            await self.gate.wait()
+        return [{"id": load}]
+
+    def _cache(self):
+        return CachedResource("productos", self._loader, ttl=60, stale_ttl=600, clock=lambda: self.now)
+
+    async def test_fresh_then_stale_while_revalidate(self):
+        cache = self._cache()
+        self.assertEqual(await cache.get(), [{"id": 1}])
+        self.now = 30
+        self.assertEqual(await cache.get(), [{"id": 1}])
+        self.assertEqual(self.loads, 1)
+
+        # Caducada pero dentro de stale_ttl: se sirve lo viejo y se refresca en segundo plano
+        self.now = 100
+        self.assertEqual(await cache.get(), [{"id": 1}])
+        await cache._refresh_task
+        self.assertEqual(await cache.get(), [{"id": 2}])
+        self.assertEqual(cache.stats["stale_hits"], 1)
+
+        # Demasiado vieja: la lectura espera a la descarga
+        self.now = 1000
+        self.assertEqual(await cache.get(), [{"id": 3}])
+
+    async def test_concurrent_misses_share_one_refresh(self):
+        cache = self._cache()
+        self.gate = asyncio.Event()
+        readers = [asyncio.create_task(cache.get()) for _ in range(5)]
+        await asyncio.sleep(0)
+        self.gate.set()
+        results = await asyncio.gather(*readers)
+        self.assertEqual(self.loads, 1)
+        self.assertTrue(all(result == [{"id": 1}] for result in results))
+
+    async def test_invalidate_during_refresh_is_not_lost(self):
+        cache = self._cache()
+        await cache.get()
+        self.now = 100
+        self.gate = asyncio.Event()
+        await cache.get()  # lanza el refresco en segundo plano, que queda esperando
+        await asyncio.sleep(0)
+        cache.invalidate()
+        self.gate.set()
+        await cache._refresh_task
+        self.gate = None
+        # El refresco empezó antes del invalidate(): no cuenta como fresco
+        self.assertEqual(await cache.get(), [{"id": 3}])
+        self.assertEqual(cache.stats["misses"], 2)
+
+
+class GatherContextTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.started = []
+        self.finished = []
+
+    def _source(self, name, delay, *, result=None, error=None, deadline=1.0, required=True):
+        async def fetch():
+            self.started.append(name)
+            await asyncio.sleep(delay)
+            if error is not None:
+                raise error
+            self.finished.append(name)
+            return result or f"texto {name}"
+        return ContextSource(name, fetch, deadline=deadline, fallback=f"sin {name}", required=required)
+
+    async def test_sources_run_concurrently(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await gather_context([self._source(name, 0.1) for name in ("faqs", "products", "history")])
+        # Tres fuentes de 0.1 s tardan lo que la más lenta, no la suma
+        self.assertLess(loop.time() - started, 0.25)
+        self.assertEqual(results, {"faqs": "texto faqs", "products": "texto products", "history": "texto history"})
+
+    async def test_failure_and_timeout_fall_back_without_cancelling_others(self):
+        results = await gather_context([
+            self._source("faqs", 0.0, error=RuntimeError("API caída")),
+            self._source("products", 0.5, deadline=0.05),
+            self._source("history", 0.1),
+        ])
+        self.assertEqual(results, {"faqs": "sin faqs", "products": "sin products", "history": "texto history"})
+        self.assertEqual(self.finished, ["history"])
+
+    async def test_deadline_is_per_source(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        results = await gather_context([
+            self._source("orders", 5, deadline=0.05),
+            self._source("history", 0.15, deadline=1.0),
+        ])
+        elapsed = loop.time() - started
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertLess(elapsed, 1.0)
+        self.assertEqual(results, {"orders": "sin orders", "history": "texto history"})
+
+    async def test_optional_sources_never_extend_the_wait(self):
+        results = await gather_context([
+            self._source("history", 0.05),
+            self._source("orders", 1.0, required=False),
+        ])
+        self.assertEqual(results["orders"], "sin orders")
+        self.assertEqual(results["history"], "texto history")
+
+
+class ConversationMemoryTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.summary = {"summary": "", "summary_until": None}
+        self.messages = [
+            {"id": i, "sender": "user" if i % 2 else "bot", "content": f"mensaje {i}"} for i in range(1, 21)
+        ]
+        self.posted = []
+
+    def _context_memory(self, tail=4):
+        """Memoria como la devuelve /api/bot-context/."""
+        unsummarized = [m for m in self.messages if m["id"] > (self.summary["summary_until"] or 0)]
+        return {**self.summary, "tail": unsummarized[-tail:], "pending": unsummarized[:-tail]}
+
+    def _handler(self, request):
+        body = json.loads(request.content)
+        self.posted.append(body)
+        if body["previous_until"] != self.summary["summary_until"]:
+            return httpx.Response(409)
+        self.summary = {"summary": body["summary"], "summary_until": body["until"]}
+        return httpx.Response(200, json=self.summary)
+
+    def _memory(self, model):
+        client = APIClient("http://api.test", transport=httpx.MockTransport(self._handler))
+        return ConversationMemory(client, model, tail=4, summarize_every=8)
+
+    async def test_old_turns_are_condensed_and_prompt_stays_bounded(self):
+        model = FakeModel(["El cliente busca ", "un celular barato."])
+        memory = self._memory(model)
+
+        history = memory.render(5, self._context_memory())
+        lines = history.splitlines()
+        # 16 pendientes: se muestran los 8 más recientes y la cola; el resto espera al resumen
+        self.assertEqual(lines[0], "(8 mensajes anteriores pendientes de resumir)")
+        self.assertEqual(lines[2:], [f"{'Usuario' if i % 2 else 'Asistente'}: mensaje {i}" for i in range(9, 21)])
+
+        await memory.wait_idle()
+        self.assertEqual(self.posted, [{"summary": "El cliente busca un celular barato.", "until": 16, "previous_until": None}])
+        self.assertIn("Usuario: mensaje 1", model.prompts[0])
+
+        history = memory.render(5, self._context_memory())
+        self.assertTrue(history.startswith("Resumen de la conversación anterior: El cliente busca un celular barato."))
+        self.assertEqual(len(history.splitlines()), 6)
+        await memory.wait_idle()
+        self.assertEqual(len(model.prompts), 1)  # sin mensajes nuevos no se vuelve a resumir
+
+    async def test_nothing_to_summarize_below_threshold(self):
+        self.messages = self.messages[:10]
+        model = FakeModel(["x"])
+        history = self._memory(model).render(5, self._context_memory())
+        # Los 6 pendientes aún no resumidos también van al prompt, antes de la cola
+        self.assertEqual(len(history.splitlines()), 10)
+        self.assertTrue(history.startswith("Usuario: mensaje 1"))
+        self.assertEqual(model.prompts, [])
+
+    async def test_concurrent_writer_conflict_is_ignored(self):
+        memory = self._memory(FakeModel(["resumen"]))
+        result = await memory.summarize(5, "", 3, self.messages[3:12])
+        self.assertIsNone(result)
+        self.assertEqual(METRICS.counter("conversation_memory.conflicts"), 1)
+
+
+class IdentityCacheTests(unittest.TestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    def test_lru_eviction(self):
+        cache = IdentityCache(max_entries=2)
+        cache.remember(1, 10, 100)
+        cache.remember(2, 20, 200)
+        cache.get(1)
+        cache.remember(3, 30, 300)
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(1), Identity(10, 100))
+        self.assertEqual(len(cache), 2)
+
+    def test_fill_does_not_override_known_conversation(self):
+        cache = IdentityCache()
+        cache.remember("1", 10, 100)
+        cache.fill(1, 10, 99)
+        self.assertEqual(cache.get(1).conversation_pk, 100)
+
+    def test_forget_conversation_keeps_user(self):
+        cache = IdentityCache()
+        cache.remember(1, 10, 100)
+        cache.forget_conversation(1)
+        self.assertEqual(cache.get(1), Identity(10, None))
+        cache.fill(1, 10, 101)
+        self.assertEqual(cache.get(1), Identity(10, 101))
+
+    def test_hit_rate(self):
+        cache = IdentityCache()
+        cache.get(1)
+        cache.remember(1, 10)
+        cache.get(1)
+        cache.get(1)
+        self.assertAlmostEqual(cache.hit_rate, 2 / 3)
+        self.assertEqual(METRICS.counter("identity_cache.hits"), 2)
+
+
+class LLMSchedulerTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    def _scheduler(self, **kwargs):
+        options = {"max_concurrent": 1, "requests_per_minute": 6000, "tokens_per_minute": 10 ** 6,
+                   "max_queue": 10, "queue_timeout": 5}
+        options.update(kwargs)
+        return LLMScheduler(**options)
+
+    async def _hold(self, scheduler, priority, name, order, release: asyncio.Event):
+        async with scheduler.slot(priority):
+            order.append(name)
+            await release.wait()
+
+    def test_token_bucket_refills_over_time(self):
+        now = [0.0]
+        bucket = TokenBucket(60, clock=lambda: now[0])
+        bucket.consume(60)
+        self.assertAlmostEqual(bucket.wait_time(1), 1.0)
+        now[0] = 30.0
+        self.assertAlmostEqual(bucket.available, 30.0)
+        self.assertEqual(bucket.wait_time(500), 30.0)  # limitado a la capacidad
+
+    async def test_higher_priority_runs_first(self):
+        scheduler = self._scheduler()
+        order, release = [], asyncio.Event()
+        release.set()
+        await scheduler.acquire(Priority.NORMAL)
+        tasks = [
+            asyncio.create_task(self._hold(scheduler, Priority.LOW, "recomendar", order, release)),
+            asyncio.create_task(self._hold(scheduler, Priority.HIGH, "ayuda", order, release)),
+        ]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["ayuda", "recomendar"])
+        self.assertEqual(scheduler.in_flight, 0)
+
+    async def test_full_queue_sheds_low_priority_first(self):
+        scheduler = self._scheduler(max_queue=1)
+        await scheduler.acquire(Priority.NORMAL)
+        low = asyncio.create_task(scheduler.acquire(Priority.LOW))
+        await asyncio.sleep(0)
+        high = asyncio.create_task(scheduler.acquire(Priority.HIGH))
+        await asyncio.sleep(0)
+        with self.assertRaises(ModelOverloaded):
+            await low
+        with self.assertRaises(ModelOverloaded):
+            await scheduler.acquire(Priority.NORMAL)
+        scheduler.release()
+        await high
+        self.assertEqual(METRICS.counter("llm_scheduler.shed.low"), 1)
+        self.assertEqual(METRICS.counter("llm_scheduler.shed.normal"), 1)
+
+    async def test_rate_limit_delays_then_times_out(self):
+        scheduler = self._scheduler(max_concurrent=5, requests_per_minute=1, queue_timeout=0.05)
+        async with scheduler.slot(Priority.HIGH):
+            pass
+        with self.assertRaises(ModelOverloaded):
+            await scheduler.acquire(Priority.HIGH)
+        self.assertEqual(scheduler.queued(), {"high": 0, "normal": 0, "low": 0})
+        self.assertEqual(METRICS.observation("llm_scheduler.queue_seconds.high")["count"], 1)
+
+
+class WebhookTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.application = SimpleNamespace(bot=None, update_queue=asyncio.Queue())
+        self.app = create_webhook_app(
+            self.application, secret_token="s3cret", path="/telegram", webhook_url=None, manage_lifecycle=False,
+        )
+
+    async def _call(self, method="POST", path="/telegram", body=b"", headers=()):
+        sent = []
+        chunks = [{"type": "http.request", "body": body, "more_body": False}]
+
+        async def receive():
+            return chunks.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "headers": list(headers)}
+        await self.app(scope, receive, send)
+        return sent[0]["status"]
+
+    def _update(self, update_id=1):
+        return json.dumps({"update_id": update_id, "message": {
+            "message_id": 5, "date": 0, "chat": {"id": 9, "type": "private"}, "text": "hola",
+        }}).encode()
+
+    async def test_valid_update_is_queued_and_acknowledged(self):
+        status = await self._call(body=self._update(), headers=[(b"x-telegram-bot-api-secret-token", b"s3cret")])
+        self.assertEqual(status, 200)
+        update = self.application.update_queue.get_nowait()
+        self.assertEqual(update.message.text, "hola")
+
+    async def test_wrong_secret_is_rejected(self):
+        status = await self._call(body=self._update(), headers=[(b"x-telegram-bot-api-secret-token", b"otro")])
+        self.assertEqual(status, 403)
+        self.assertTrue(self.application.update_queue.empty())
+        self.assertEqual(METRICS.counter("webhook.unauthorized"), 1)
+
+    async def test_invalid_body_and_other_routes(self):
+        headers = [(b"x-telegram-bot-api-secret-token", b"s3cret")]
+        self.assertEqual(await self._call(body=b"no es json", headers=headers), 400)
+        self.assertEqual(await self._call(method="GET", path="/healthz"), 200)
+        self.assertEqual(await self._call(path="/otra"), 404)
+
+    def test_missing_secret_token_refuses_to_start(self):
+        with self.assertRaises(ValueError):
+            create_webhook_app(self.application, secret_token=None, webhook_url=None, manage_lifecycle=False)
+
+    async def test_metrics_route_returns_snapshot(self):
+        METRICS.incr("webhook.updates", 3)
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app({"type": "http", "method": "GET", "path": "/metrics", "headers": []}, None, send)
+        self.assertEqual(sent[0]["status"], 200)
+        self.assertEqual(json.loads(sent[1]["body"])["counters"]["webhook.updates"], 3)
+
+
+class MetricsReporterTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    async def test_logs_snapshot_periodically_and_on_stop(self):
+        METRICS.incr("bot.messages")
+        reporter = MetricsReporter(interval=0.01)
+        with self.assertLogs("metrics", level="INFO") as logs:
+            reporter.start()
+            await asyncio.sleep(0.035)
+            await reporter.stop()
+        self.assertGreaterEqual(len(logs.output), 3)
+        self.assertIn('"bot.messages": 1', logs.output[-1])
+
+    async def test_zero_interval_disables_reporter(self):
+        reporter = MetricsReporter(interval=0)
+        reporter.start()
+        self.assertIsNone(reporter._task)
+        await reporter.stop()
+
+
+class PerChatUpdateProcessorTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+
+    def _update(self, update_id, chat_id):
+        return Update.de_json({"update_id": update_id, "message": {
+            "message_id": update_id, "date": 0, "chat": {"id": chat_id, "type": "private"}, "text": "hola",
+        }}, None)
+
+    async def _handler(self, name, log, delay):
+        log.append(f"{name}:inicio")
+        await asyncio.sleep(delay)
+        log.append(f"{name}:fin")
+
+    async def test_same_chat_is_ordered_and_other_chats_run_in_parallel(self):
+        processor = PerChatUpdateProcessor(max_concurrent=4)
+        await processor.initialize()
+        log = []
+        await asyncio.gather(
+            processor.process_update(self._update(1, 10), self._handler("a1", log, 0.03)),
+            processor.process_update(self._update(2, 10), self._handler("a2", log, 0)),
+            processor.process_update(self._update(3, 20), self._handler("b1", log, 0)),
+        )
+        self.assertLess(log.index("a1:fin"), log.index("a2:inicio"))
+        self.assertLess(log.index("b1:fin"), log.index("a1:fin"))
+        self.assertEqual(processor.queue_depth, 0)
+        self.assertEqual(processor._chat_locks, {})
+        self.assertEqual(METRICS.observation("updates.chat_wait_seconds")["count"], 3)
+
+    async def test_global_limit(self):
+        processor = PerChatUpdateProcessor(max_concurrent=2)
+        await processor.initialize()
+        running, peak = 0, 0
+
+        async def handler():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        await asyncio.gather(*[processor.process_update(self._update(i, i), handler()) for i in range(6)])
+        self.assertEqual(peak, 2)
+
+
+class StateStoreTests(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        METRICS.reset()
+        self.now = [1000.0]
+        self.clock = lambda: self.now[0]
+
+    async def test_sqlite_store_survives_reopen_and_expires(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "state.sqlite3")
+        store = SQLiteStateStore(path, clock=self.clock)
+        await store.write_many([("cancel_map", "1", {"1": 50}, 1060.0), ("prefs", "1", {"idioma": "es"}, None)])
+        await store.close()
+
+        store = SQLiteStateStore(path, clock=self.clock)
+        self.assertEqual(await store.get("cancel_map", "1"), {"1": 50})
+        self.now[0] = 1061.0
+        self.assertIsNone(await store.get("cancel_map", "1"))
+        self.assertEqual(await store.purge_expired(), 1)
+        self.assertEqual(await store.get("prefs", "1"), {"idioma": "es"})
+        await store.close()
+
+    async def test_api_store_round_trip(self):
+        entries = {}
+
+        def handler(request):
+            if request.method == "POST" and request.url.path == "/api/bot-state/":
+                for write in json.loads(request.content)["writes"]:
+                    if write["value"] is None:
+                        entries.pop((write["namespace"], write["key"]), None)
+                    else:
+                        entries[(write["namespace"], write["key"])] = write["value"]
+                return httpx.Response(200, json={"written": 1})
+            if request.url.path == "/api/bot-state/purge/":
+                return httpx.Response(200, json={"purged": 0})
+            _, _, _, namespace, key, _ = request.url.path.split("/")
+            if (namespace, key) not in entries:
+                return httpx.Response(404)
+            return httpx.Response(200, json={"value": entries[(namespace, key)]})
+
+        store = APIStateStore(APIClient("http://api.test", transport=httpx.MockTransport(handler)))
+        await store.write_many([("cancel_map", "1", {"1": 50}, 1060.0), ("cancel_map", "2", None, None)])
+        self.assertEqual(await store.get("cancel_map", "1"), {"1": 50})
+        self.assertIsNone(await store.get("cancel_map", "2"))
+        self.assertEqual(await store.purge_expired(), 0)
+
+    def test_store_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            StateStore()
+
+    async def test_memory_store_is_bounded(self):
+        store = MemoryStateStore(max_entries=2, clock=self.clock)
+        await store.write_many([("ns", str(i), i, None) for i in range(3)])
+        self.assertEqual(len(store), 2)
+        self.assertIsNone(await store.get("ns", "0"))
+
+    async def test_writes_are_coalesced_and_visible_before_flush(self):
+        store = MemoryStateStore(clock=self.clock)
+        batches = []
+        original = store.write_many
+
+        async def recording_write_many(writes):
+            batches.append(writes)
+            await original(writes)
+
+        store.write_many = recording_write_many
+        state = BotState(store, clock=self.clock)
+        for i in range(5):
+            await state.set("cancel_map", 7, {"1": i}, ttl=60)
+        await state.set("cancel_map", 8, {"1": 99})
+        self.assertEqual(await state.get("cancel_map", 7), {"1": 4})
+
+        await state.flush()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(len(batches[0]), 2)
+        self.assertEqual(METRICS.counter("bot_state.coalesced"), 4)
+
+        await state.delete("cancel_map", 7)
+        self.assertIsNone(await state.get("cancel_map", 7))
+        await state.flush()
+        self.assertIsNone(await store.get("cancel_map", "7"))
+        self.assertEqual(await state.get("cancel_map", 8), {"1": 99})
+
+    async def test_ttl_expiry(self):
+        state = BotState(MemoryStateStore(clock=self.clock), clock=self.clock)
+        await state.set("cancel_map", 1, {"1": 5}, ttl=10)
+        self.now[0] += 11
+        self.assertIsNone(await state.get("cancel_map", 1))
+        await state.flush()
+        self.assertIsNone(await state.get("cancel_map", 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import time
+from typing import Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import METRICS
+
+# --- Configuración del procesamiento concurrente de actualizaciones ---
+# Actualizaciones ejecutando handlers a la vez (de chats distintos)
+BOT_MAX_CONCURRENT_UPDATES = int(os.environ.get("BOT_MAX_CONCURRENT_UPDATES", "16"))
+# Actualizaciones admitidas (en curso o esperando su turno en el chat); el resto espera en orden de llegada
+BOT_MAX_PENDING_UPDATES = int(os.environ.get("BOT_MAX_PENDING_UPDATES", "1000"))
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Procesa en paralelo las actualizaciones de chats distintos y en orden estricto
+    las de un mismo chat.
+
+    Cada chat tiene su propio candado: una actualización espera a que termine la
+    anterior del mismo chat y después a que haya hueco en el límite global
+    ``max_concurrent``. Así un usuario esperando a Gemini no retrasa a los demás, y
+    el estado por chat (p. ej. ``context.user_data['cancel_map']`` en un chat privado)
+    nunca lo modifican dos handlers a la vez. El candado se toma antes que el hueco
+    global para que un chat con muchos mensajes en cola no ocupe huecos sin usarlos.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = BOT_MAX_CONCURRENT_UPDATES,
+        max_pending: int = BOT_MAX_PENDING_UPDATES,
+    ):
+        super().__init__(max(max_pending, max_concurrent))
+        self.max_concurrent = max_concurrent
+        self._active: Optional[asyncio.Semaphore] = None
+        self._chat_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._chat_pending: Dict[Hashable, int] = {}
+        self._waiting = 0
+
+    @staticmethod
+    def chat_key(update: object) -> Optional[Hashable]:
+        """Clave de orden de una actualización: el chat o, si no tiene, el usuario."""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+        return None
+
+    @property
+    def queue_depth(self) -> int:
+        """Actualizaciones admitidas que aún esperan su turno."""
+        return self._waiting
+
+    async def initialize(self) -> None:
+        self._active = asyncio.Semaphore(self.max_concurrent)
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+        self._chat_pending.clear()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if self._active is None:
+            await self.initialize()
+        key = self.chat_key(update)
+        queued_at = time.monotonic()
+        self._waiting += 1
+        METRICS.observe("updates.queue_depth", self._waiting)
+        state = {"waiting": True}
+        try:
+            if key is None:
+                await self._run(coroutine, queued_at, state)
+                return
+            lock = self._chat_locks.get(key)
+            if lock is None:
+                lock = self._chat_locks[key] = asyncio.Lock()
+            self._chat_pending[key] = self._chat_pending.get(key, 0) + 1
+            try:
+                async with lock:
+                    await self._run(coroutine, queued_at, state)
+            finally:
+                self._chat_pending[key] -= 1
+                if not self._chat_pending[key]:
+                    # Nadie más espera en este chat: se libera su candado
+                    del self._chat_pending[key]
+                    del self._chat_locks[key]
+        finally:
+            if state["waiting"]:
+                # Cancelada antes de empezar
+                self._waiting -= 1
+
+    async def _run(self, coroutine, queued_at: float, state: dict):
+        async with self._active:
+            self._waiting -= 1
+            state["waiting"] = False
+            METRICS.observe("updates.chat_wait_seconds", time.monotonic() - queued_at)
+            await coroutine
@@ -0,0 +1,155 @@
+import hmac
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from telegram import Update
+
+from metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+# --- Configuración del modo webhook ---
+# URL pública (https) donde Telegram entrega las actualizaciones, p. ej. https://bot.example.com/telegram
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Telegram lo envía en la cabecera X-Telegram-Bot-Api-Secret-Token de cada petición
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")
+WEBHOOK_MAX_BODY_BYTES = int(os.environ.get("WEBHOOK_MAX_BODY_BYTES", str(1024 * 1024)))
+
+SECRET_TOKEN_HEADER = b"x-telegram-bot-api-secret-token"
+
+
+async def _respond(send, status: int, body: bytes = b"", content_type: bytes = b"text/plain; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive, limit: int) -> Optional[bytes]:
+    """Lee el cuerpo de la petición; ``None`` si supera ``limit`` bytes."""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return None
+        if not message.get("more_body", False):
+            return body
+
+
+def create_webhook_app(
+    application,
+    *,
+    secret_token: Optional[str] = WEBHOOK_SECRET_TOKEN,
+    path: str = WEBHOOK_PATH,
+    webhook_url: Optional[str] = WEBHOOK_URL,
+    max_body_bytes: int = WEBHOOK_MAX_BODY_BYTES,
+    manage_lifecycle: bool = True,
+):
+    """
+    App ASGI que recibe las actualizaciones de Telegram por webhook.
+
+    Cada POST a ``path`` se valida con el secret token (obligatorio), se encola en la
+    ``update_queue`` de la aplicación de Telegram y se responde 200 enseguida; los
+    handlers la procesan en segundo plano. Al no depender de un único proceso de
+    polling se pueden ejecutar varias réplicas detrás de un balanceador.
+
+    Con ``manage_lifecycle`` el evento *lifespan* del servidor arranca y detiene la
+    aplicación (incluidos ``post_init``/``post_shutdown``) y, si hay ``webhook_url``,
+    registra el webhook en Telegram. ``GET /healthz`` sirve para las comprobaciones
+    del balanceador y ``GET /metrics`` devuelve ``METRICS.snapshot()`` en JSON.
+    """
+    if not secret_token:
+        # Sin secreto cualquiera podría enviar actualizaciones falsas: no se arranca
+        raise ValueError("WEBHOOK_SECRET_TOKEN es obligatorio en modo webhook.")
+
+    async def startup():
+        await application.initialize()
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        if webhook_url:
+            await application.bot.set_webhook(
+                url=webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES
+            )
+            logger.info(f"Webhook registrado en {webhook_url}.")
+
+    async def shutdown():
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+    async def lifespan(receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    if manage_lifecycle:
+                        await startup()
+                except Exception as e:
+                    logger.critical(f"No se pudo iniciar el bot en modo webhook: {e}")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if manage_lifecycle:
+                    await shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            await lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] == "/healthz" and scope["method"] == "GET":
+            await _respond(send, 200, b"ok")
+            return
+        if scope["path"] == "/metrics" and scope["method"] == "GET":
+            body = json.dumps(METRICS.snapshot(), sort_keys=True).encode()
+            await _respond(send, 200, body, content_type=b"application/json")
+            return
+        if scope["path"] != path:
+            await _respond(send, 404)
+            return
+        if scope["method"] != "POST":
+            await _respond(send, 405)
+            return
+
+        received = dict(scope.get("headers", [])).get(SECRET_TOKEN_HEADER, b"")
+        if not hmac.compare_digest(received, secret_token.encode()):
+            METRICS.incr("webhook.unauthorized")
+            await _respond(send, 403)
+            return
+
+        started = time.monotonic()
+        body = await _read_body(receive, max_body_bytes)
+        if body is None:
+            await _respond(send, 413)
+            return
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Actualización de Telegram inválida: {e}")
+            METRICS.incr("webhook.invalid")
+            await _respond(send, 400)
+            return
+
+        # Se responde ya; los handlers procesan la actualización desde la cola
+        await application.update_queue.put(update)
+        METRICS.incr("webhook.updates")
+        METRICS.observe("webhook.ack_seconds", time.monotonic() - started)
+        await _respond(send, 200)
+
+    return app
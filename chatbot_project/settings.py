@@ -149,10 +149,18 @@ DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 # Django REST Framework configuration
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'telegram_bot.pagination.LimitPageNumberPagination',
     'PAGE_SIZE': 10,
 }
 
+# Inventario: 'counter' descuenta directamente Product.stock; 'ledger' registra cada
+# movimiento en StockMovement y los compacta periódicamente en Product.stock
+# (manage.py compact_stock). Ver telegram_bot.models.StockMovement.
+INVENTORY_BACKEND = os.environ.get('INVENTORY_BACKEND', 'counter')
+# Con 'ledger', filas StockBucket en las que se reparte el stock disponible de cada
+# producto: las reservas concurrentes de un mismo producto bloquean filas distintas.
+INVENTORY_BUCKETS = int(os.environ.get('INVENTORY_BUCKETS', '8'))
+
 # CORS Configuration
 if DEBUG:
     CORS_ALLOW_ALL_ORIGINS = True
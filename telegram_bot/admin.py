@@ -1,7 +1,8 @@
+from django.conf import settings
 from django.contrib import admin
 from .models import (
     Category, Product, User, Conversation, Message, 
-    ProductComparison, Order, OrderItem, FAQ, FAQCategory
+    ProductComparison, Order, OrderItem, FAQ, FAQCategory, StockMovement, StockBucket, DataVersion, BotIntent
 )
 
 @admin.register(Category)
@@ -11,9 +12,25 @@ class CategoryAdmin(admin.ModelAdmin):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'stock')
+    list_display = ('name', 'category', 'price', 'available_stock')
     list_filter = ('category', 'created_at')
     search_fields = ('name', 'description')
+    readonly_fields = ('stock_until',)
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).with_available_stock()
+
+    def get_readonly_fields(self, request, obj=None):
+        # Con el libro de inventario, Product.stock es la instantánea que mantiene
+        # compact_stock: el stock se cambia con movimientos (reposición o ajuste)
+        if settings.INVENTORY_BACKEND == 'ledger':
+            return self.readonly_fields + ('stock',)
+        return self.readonly_fields
+
+    def available_stock(self, obj):
+        return obj.available_stock
+    available_stock.short_description = 'Stock disponible'
+    available_stock.admin_order_field = 'available_stock'
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -58,6 +75,30 @@ class OrderAdmin(admin.ModelAdmin):
 class OrderItemAdmin(admin.ModelAdmin):
     list_display = ('order', 'product', 'quantity', 'price')
 
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ('product', 'delta', 'reason', 'order_id', 'user_id', 'staff_user', 'created_at')
+    list_filter = ('reason', 'created_at')
+    raw_id_fields = ('product',)
+    fields = ('product', 'delta', 'reason')
+
+    def save_model(self, request, obj, form, change):
+        # Reposiciones y ajustes manuales: quedan a nombre del usuario del admin
+        obj.staff_user = request.user
+        super().save_model(request, obj, form, change)
+        if obj.delta < 0:
+            # Lo retirado deja de estar repartido en los cubos de stock
+            StockBucket.refill(obj.product_id)
+        # Cambian el stock que muestra el bot
+        DataVersion.bump(DataVersion.CATALOG)
+
+    # El libro de inventario es de solo inserción
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
 @admin.register(FAQCategory)
 class FAQCategoryAdmin(admin.ModelAdmin):
     list_display = ('name',)
@@ -71,3 +112,9 @@ class FAQAdmin(admin.ModelAdmin):
     def question_preview(self, obj):
         return obj.question[:50] + '...' if len(obj.question) > 50 else obj.question
     question_preview.short_description = 'Pregunta'
+
+@admin.register(BotIntent)
+class BotIntentAdmin(admin.ModelAdmin):
+    list_display = ('name', 'priority', 'action', 'is_active')
+    list_filter = ('is_active',)
+    search_fields = ('name',)
@@ -0,0 +1,79 @@
+import time
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+
+from .models import DataVersion, Product, StockMovement
+
+
+class VersionedConditionalGetMixin:
+    """
+    Conditional GET for viewsets whose data is tracked by a ``DataVersion`` counter.
+
+    ``list`` and ``retrieve`` (and any action wrapped with ``conditional``) send an
+    ETag and Last-Modified built from the version, and answer ``If-None-Match`` /
+    ``If-Modified-Since`` with 304 Not Modified after a single query, before any
+    queryset or serializer runs. The version is read before the data, so a write that
+    lands in between can only make the body newer than its ETag, never older.
+
+    HTTP dates only have whole seconds, so Last-Modified is left out while the last
+    change is in the current second: another write within that second would keep the
+    same date, and ``If-Modified-Since`` would then answer 304 for stale data. Those
+    responses are revalidated by the ETag alone.
+    """
+    data_version = None
+
+    def version_stamp(self):
+        """Returns ``(etag_source, last_modified)`` for the current state of the data set."""
+        version, updated_at = DataVersion.stamp(self.data_version)
+        return f"{self.data_version}-{version}", updated_at
+
+    def conditional(self, handler, request, *args, **kwargs):
+        source, updated_at = self.version_stamp()
+        # The same URL renders differently per format (JSON, browsable API)
+        etag = quote_etag(f"{source}-{request.accepted_renderer.format}")
+        last_modified = int(updated_at.timestamp()) if updated_at else None
+        if last_modified is not None and last_modified >= int(time.time()):
+            last_modified = None
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+        response = handler(request, *args, **kwargs)
+        if response.status_code == 200:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional(super().retrieve, request, *args, **kwargs)
+
+
+class CatalogConditionalGetMixin(VersionedConditionalGetMixin):
+    """
+    Catalog endpoints. Stock changes only bump the catalog version when a product
+    sells out or comes back (see ``Product._availability_changed``), so one more
+    indexed query folds the latest stock change into the ETag. With the counter
+    inventory that is the newest ``Product.updated_at``; with the ledger it is the
+    last movement.
+    """
+    data_version = DataVersion.CATALOG
+
+    def version_stamp(self):
+        source, updated_at = super().version_stamp()
+        if settings.INVENTORY_BACKEND == 'ledger':
+            last = StockMovement.objects.order_by('-id').values_list('id', 'created_at').first()
+            if last is not None:
+                source = f"{source}-{last[0]}"
+                updated_at = max(updated_at, last[1]) if updated_at else last[1]
+        else:
+            changed = Product.objects.aggregate(last=Max('updated_at'))['last']
+            if changed is not None:
+                source = f"{source}-{int(changed.timestamp() * 1_000_000)}"
+                updated_at = max(updated_at, changed) if updated_at else changed
+        return source, updated_at
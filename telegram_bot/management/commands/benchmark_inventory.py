@@ -0,0 +1,110 @@
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.test.utils import override_settings
+
+from telegram_bot.models import Category, Product, StockBucket
+
+BACKENDS = ('counter', 'ledger')
+
+
+class Command(BaseCommand):
+    help = (
+        'Compara el inventario de contador (Product.stock) con el libro de movimientos bajo carga '
+        'paralela sobre un mismo producto. Crea un producto temporal y lo elimina al terminar. '
+        'Requiere PostgreSQL: es el único motor con escrituras concurrentes reales.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=16, help='Hilos, cada uno con su conexión.')
+        parser.add_argument('--operations', type=int, default=200, help='Operaciones por hilo.')
+        parser.add_argument('--release-ratio', type=float, default=0.3, help='Fracción de devoluciones de stock.')
+        parser.add_argument('--hold-ms', type=float, default=2.0,
+                            help='Trabajo simulado dentro de la transacción antes de tocar el stock.')
+        parser.add_argument('--hold-after-ms', type=float, default=0.0,
+                            help='Espera simulada entre tocar el stock y el COMMIT (p. ej. latencia de red), '
+                                 'con el bloqueo del stock ya tomado.')
+        parser.add_argument('--stock', type=int, default=None,
+                            help='Stock inicial; por defecto alcanza para todas las reservas.')
+        parser.add_argument('--buckets', type=int, default=settings.INVENTORY_BUCKETS,
+                            help='Cubos de stock por producto del libro de movimientos (INVENTORY_BUCKETS).')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError('benchmark_inventory requiere PostgreSQL.')
+        total = options['workers'] * options['operations']
+        initial = options['stock'] if options['stock'] is not None else total
+
+        category = Category.objects.create(name='benchmark_inventory')
+        try:
+            results = {}
+            for backend in BACKENDS:
+                product = Product.objects.create(
+                    name=f'benchmark {backend}', description='-', price=1, category=category, stock=initial
+                )
+                with override_settings(INVENTORY_BACKEND=backend, INVENTORY_BUCKETS=options['buckets']):
+                    results[backend] = self.run_load(product.pk, options)
+                    available = Product.objects.with_available_stock().get(pk=product.pk).available_stock
+                in_buckets = StockBucket.objects.filter(product=product).aggregate(total=Sum('quantity'))['total']
+                taken, released, rejected, elapsed = results[backend]
+                expected = initial - taken + released
+                heading = f"{backend} ({options['buckets']} cubos)" if backend == 'ledger' else backend
+                self.stdout.write(self.style.MIGRATE_HEADING(f'\n{heading}'))
+                self.stdout.write(
+                    f'  {total / elapsed:,.0f} operaciones/s ({elapsed:.2f} s) | reservas {taken}, '
+                    f'devoluciones {released}, rechazadas {rejected}'
+                )
+                if available == expected and available >= 0:
+                    self.stdout.write(self.style.SUCCESS(f'  Stock final {available}: consistente, sin sobreventa.'))
+                else:
+                    self.stdout.write(self.style.ERROR(f'  Stock final {available}, se esperaba {expected}.'))
+                if in_buckets is not None and in_buckets > available:
+                    self.stdout.write(self.style.ERROR(f'  Los cubos reparten {in_buckets} unidades de {available}.'))
+            speedup = results['counter'][3] / results['ledger'][3]
+            self.stdout.write(self.style.MIGRATE_HEADING(f'\nledger frente a counter: x{speedup:.2f}'))
+        finally:
+            # Elimina los productos y, en cascada, sus movimientos
+            category.delete()
+
+    def run_load(self, product_id, options):
+        counts = {'taken': 0, 'released': 0, 'rejected': 0}
+        lock = threading.Lock()
+        start = threading.Barrier(options['workers'] + 1)
+
+        def worker(seed):
+            rng = random.Random(seed)
+            local = dict.fromkeys(counts, 0)
+            try:
+                start.wait()
+                for _ in range(options['operations']):
+                    with transaction.atomic():
+                        # El resto de la reserva (pedido, líneas, total) antes del stock, como en la vista
+                        time.sleep(options['hold_ms'] / 1000)
+                        if rng.random() < options['release_ratio']:
+                            Product.restore_stock({product_id: 1})
+                            local['released'] += 1
+                        elif Product.take_stock(product_id, 1):
+                            local['taken'] += 1
+                        else:
+                            local['rejected'] += 1
+                        time.sleep(options['hold_after_ms'] / 1000)
+            finally:
+                connections.close_all()
+                with lock:
+                    for key, value in local.items():
+                        counts[key] += value
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(options['workers'])]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        return counts['taken'], counts['released'], counts['rejected'], elapsed
@@ -0,0 +1,138 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from telegram_bot.models import Conversation, Message, Order, User
+
+INDEXED_MODELS = (Conversation, Message, Order)
+
+
+class Command(BaseCommand):
+    help = (
+        'Carga un conjunto de datos grande y compara el plan (EXPLAIN) y el tiempo de las consultas '
+        'frecuentes del bot sin y con los índices compuestos. Todo se deshace al terminar. '
+        'Elimina índices temporalmente: ejecútalo contra una base de desarrollo, no en producción.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--conversations', type=int, default=3, help='Conversaciones por usuario.')
+        parser.add_argument('--messages', type=int, default=40, help='Mensajes por conversación.')
+        parser.add_argument('--orders', type=int, default=10, help='Pedidos por usuario.')
+        parser.add_argument('--repeat', type=int, default=200, help='Ejecuciones de cada consulta al medir.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        indexes = [(model, index) for model in INDEXED_MODELS for index in model._meta.indexes]
+        with connection.schema_editor(collect_sql=True) as editor:
+            drop_sql = [str(index.remove_sql(model, editor)) for model, index in indexes]
+            create_sql = [str(index.create_sql(model, editor)) for model, index in indexes]
+
+        with transaction.atomic():
+            started = time.perf_counter()
+            user_ids = self.seed(rng, options)
+            self.stdout.write(f"Datos cargados en {time.perf_counter() - started:.1f} s.")
+            self.analyze()
+
+            targets = self.targets(rng, user_ids, options['repeat'])
+            self.run_sql(drop_sql)
+            self.analyze()
+            before = self.measure('Sin índices compuestos', targets)
+
+            self.run_sql(create_sql)
+            self.analyze()
+            after = self.measure('Con índices compuestos', targets)
+
+            self.stdout.write(self.style.MIGRATE_HEADING('\nResumen (ms por consulta)'))
+            for name in before:
+                speedup = before[name] / after[name] if after[name] else float('inf')
+                self.stdout.write(f"  {name:<32} {before[name]:>9.3f} -> {after[name]:>9.3f}  (x{speedup:.1f})")
+
+            # No se deja nada en la base: ni los datos de prueba ni cambios en los índices
+            transaction.set_rollback(True)
+
+    def seed(self, rng, options):
+        now = timezone.now()
+        users = User.objects.bulk_create(
+            [User(telegram_id=f'bench-{i}') for i in range(options['users'])], batch_size=5000
+        )
+        conversations = Conversation.objects.bulk_create([
+            Conversation(user=user, start_time=now - timezone.timedelta(days=rng.randint(0, 365)))
+            for user in users for _ in range(options['conversations'])
+        ], batch_size=5000)
+        batch = []
+        for conversation in conversations:
+            for i in range(options['messages']):
+                batch.append(Message(
+                    conversation=conversation,
+                    sender='user' if i % 2 == 0 else 'bot',
+                    content=f'mensaje {i}',
+                    timestamp=conversation.start_time + timezone.timedelta(seconds=30 * i),
+                ))
+            if len(batch) >= 20000:
+                Message.objects.bulk_create(batch, batch_size=5000)
+                batch = []
+        Message.objects.bulk_create(batch, batch_size=5000)
+        # Pocos pedidos pendientes, como en producción: casi todos ya se procesaron
+        statuses = ['delivered'] * 6 + ['shipped'] * 2 + ['cancelled', 'processing']
+        orders = Order.objects.bulk_create([
+            Order(user=user, status='pending' if i == 0 and rng.random() < 0.2 else rng.choice(statuses))
+            for user in users for i in range(options['orders'])
+        ], batch_size=5000)
+        self.stdout.write(
+            f"{len(users)} usuarios, {len(conversations)} conversaciones, "
+            f"{len(conversations) * options['messages']} mensajes, {len(orders)} pedidos."
+        )
+        return [user.pk for user in users]
+
+    def targets(self, rng, user_ids, repeat):
+        """Pares (usuario, conversación) al azar para que cada ejecución lea filas distintas."""
+        users = [rng.choice(user_ids) for _ in range(repeat)]
+        conversations = dict(Conversation.objects.filter(user_id__in=users).values_list('user_id', 'id'))
+        return [(user, conversations[user]) for user in users]
+
+    def hot_queries(self, user, conversation):
+        """Consultas de los caminos frecuentes del bot y la API."""
+        return {
+            'Mensajes de una conversación':
+                Message.objects.filter(conversation_id=conversation).order_by('-timestamp', '-id')[:20],
+            'Ventana de memoria': Message.objects.filter(conversation_id=conversation).order_by('-id')[:6],
+            'Última conversación del usuario':
+                Conversation.objects.filter(user_id=user).order_by('-start_time', '-id')[:1],
+            'Pedidos del usuario': Order.objects.filter(user_id=user).order_by('-created_at', '-id')[:10],
+            'Pedidos del usuario por estado':
+                Order.objects.filter(user_id=user, status='shipped').order_by('-created_at'),
+            'Pedido pendiente (reserve)': Order.objects.filter(user_id=user, status='pending')[:1],
+        }
+
+    def measure(self, title, targets):
+        self.stdout.write(self.style.MIGRATE_HEADING(f'\n{title}'))
+        timings = {}
+        for name, queryset in self.hot_queries(*targets[0]).items():
+            self.stdout.write(self.style.MIGRATE_LABEL(f'  {name}'))
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f'    {line}')
+            # Se mide solo la base de datos: el SQL se compila antes y no se crean instancias
+            statements = [self.hot_queries(*target)[name].query.sql_with_params() for target in targets]
+            with connection.cursor() as cursor:
+                started = time.perf_counter()
+                for sql, params in statements:
+                    cursor.execute(sql, params)
+                    cursor.fetchall()
+                timings[name] = (time.perf_counter() - started) * 1000 / len(statements)
+            self.stdout.write(f'    {timings[name]:.3f} ms por consulta')
+        return timings
+
+    def analyze(self):
+        """Actualiza las estadísticas del planificador tras cargar datos o cambiar índices."""
+        tables = [model._meta.db_table for model in INDEXED_MODELS]
+        self.run_sql([f'ANALYZE {connection.ops.quote_name(table)}' for table in tables])
+
+    def run_sql(self, statements):
+        with connection.cursor() as cursor:
+            for statement in statements:
+                cursor.execute(statement)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from telegram_bot.models import Order
+
+
+class Command(BaseCommand):
+    help = (
+        'Comprueba que el total de cada pedido coincide con la suma de sus líneas. Los totales se '
+        'mantienen de forma incremental; esto detecta desvíos (p. ej. líneas creadas con bulk_create '
+        'o modificadas con update(), que no envían señales). Con --fix los recalcula.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', help='Recalcula los totales incorrectos.')
+        parser.add_argument('--show', type=int, default=20, help='Pedidos incorrectos a listar.')
+
+    def handle(self, *args, **options):
+        mismatched = (
+            Order.objects.annotate(items_total=Order.items_total())
+            .exclude(total_amount=F('items_total'))
+            .order_by('id')
+        )
+        wrong = list(mismatched.values_list('id', 'total_amount', 'items_total'))
+        if not wrong:
+            self.stdout.write(self.style.SUCCESS('Todos los totales de pedidos son correctos.'))
+            return
+
+        self.stdout.write(self.style.WARNING(f'{len(wrong)} pedidos con el total incorrecto.'))
+        for order_id, total, items_total in wrong[:options['show']]:
+            self.stdout.write(f'  Pedido {order_id}: total {total:.2f}, suma de líneas {items_total:.2f}')
+        if options['fix']:
+            fixed = Order.objects.filter(pk__in=[order_id for order_id, _, _ in wrong]).update(
+                total_amount=Order.items_total()
+            )
+            self.stdout.write(self.style.SUCCESS(f'{fixed} totales recalculados.'))
@@ -0,0 +1,24 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from telegram_bot.models import StockMovement
+
+
+class Command(BaseCommand):
+    help = (
+        'Compacta el libro de inventario: suma en Product.stock los movimientos con más de '
+        '--grace segundos y vuelve a repartir el stock disponible en los cubos. Pensado para ejecutarse periódicamente (cron) con INVENTORY_BACKEND=ledger.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace', type=int, default=300,
+            help='Antigüedad mínima (segundos) de un movimiento para compactarlo; mayor que cualquier transacción.',
+        )
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(seconds=options['grace'])
+        compacted = StockMovement.compact(older_than)
+        self.stdout.write(self.style.SUCCESS(f"Inventario compactado: {compacted} productos."))
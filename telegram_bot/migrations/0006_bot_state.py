@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0005_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotStateEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('namespace', models.CharField(max_length=50)),
+                ('key', models.CharField(max_length=100)),
+                ('value', models.JSONField()),
+                ('expires_at', models.FloatField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['expires_at'], name='botstateentry_expires_idx')],
+                'constraints': [models.UniqueConstraint(fields=('namespace', 'key'), name='botstateentry_namespace_key_uniq')],
+            },
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.3 on 2026-10-17 04:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('telegram_bot', '0006_bot_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BotIntent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('phrases', models.JSONField(default=list)),
+                ('priority', models.PositiveIntegerField(default=100)),
+                ('response', models.TextField(blank=True, default='')),
+                ('action', models.CharField(blank=True, default='', max_length=50)),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+        ),
+    ]
@@ -1,4 +1,9 @@
-from django.db import models
+import random
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import IntegrityError, models, transaction
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 class Category(models.Model):
@@ -11,6 +16,21 @@ class Category(models.Model):
     class Meta:
         verbose_name_plural = "Categories"
 
+class ProductQuerySet(models.QuerySet):
+    def with_available_stock(self):
+        """Annotates ``available_stock``: the stock plus the ledger movements not compacted yet."""
+        if settings.INVENTORY_BACKEND != 'ledger':
+            return self.annotate(available_stock=models.F('stock'))
+        pending = (
+            StockMovement.objects
+            .filter(product=models.OuterRef('pk'), id__gt=models.OuterRef('stock_until'))
+            .order_by()
+            .values('product')
+            .annotate(total=models.Sum('delta'))
+            .values('total')
+        )
+        return self.annotate(available_stock=models.F('stock') + Coalesce(models.Subquery(pending), 0))
+
 class Product(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
@@ -18,12 +38,108 @@ class Product(models.Model):
     category = models.ForeignKey(Category, related_name='products', on_delete=models.CASCADE)
     image_url = models.URLField(blank=True, null=True)
     stock = models.PositiveIntegerField(default=0)
+    # Last StockMovement folded into ``stock`` (ledger inventory only)
+    stock_until = models.PositiveBigIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+
+    objects = ProductQuerySet.as_manager()
     
     def __str__(self):
         return self.name
 
+    class Meta:
+        indexes = [
+            # Latest stock change, folded into the catalog ETag (see CatalogConditionalGetMixin)
+            models.Index(fields=['updated_at'], name='product_updated_idx'),
+        ]
+
+    @classmethod
+    def take_stock(cls, product_id, quantity, *, order_id=None, user_id=None):
+        """
+        Atomically takes ``quantity`` units if that many are available.
+
+        With the counter inventory this is a conditional UPDATE; with the ledger it
+        appends a movement (see ``StockMovement.take``). Either way concurrent
+        callers can never oversell. Returns whether the stock was taken.
+
+        The catalog version is only bumped when the product sells out, see
+        ``_availability_changed``.
+        """
+        if settings.INVENTORY_BACKEND == 'ledger':
+            return StockMovement.take(product_id, quantity, order_id=order_id, user_id=user_id)
+        take = {'stock': models.F('stock') - quantity, 'updated_at': timezone.now()}
+        if cls.objects.filter(pk=product_id, stock__gt=quantity).update(**take):
+            return True
+        # Only reached when the remaining stock is not above ``quantity``: this may sell out
+        if cls.objects.filter(pk=product_id, stock=quantity).update(**take):
+            cls._availability_changed()
+            return True
+        return False
+
+    @classmethod
+    def restore_stock(cls, quantities, *, order_id=None, user_id=None):
+        """Gives back ``{product_id: quantity}`` units to every product in one query."""
+        quantities = {pk: quantity for pk, quantity in quantities.items() if quantity}
+        if not quantities:
+            return
+        if settings.INVENTORY_BACKEND == 'ledger':
+            StockMovement.record(quantities, StockMovement.RELEASE, order_id=order_id, user_id=user_id)
+        else:
+            cls.objects.filter(pk__in=quantities).update(
+                stock=models.F('stock') + models.Case(
+                    *(models.When(pk=pk, then=models.Value(quantity)) for pk, quantity in quantities.items()),
+                    output_field=models.PositiveIntegerField(),
+                ),
+                updated_at=timezone.now(),
+            )
+        # A product whose availability now equals what was given back was sold out
+        restocked = models.Q()
+        for pk, quantity in quantities.items():
+            restocked |= models.Q(pk=pk, available_stock=quantity)
+        if cls.objects.with_available_stock().filter(restocked).exists():
+            cls._availability_changed()
+
+    @classmethod
+    def adjust_stock(cls, product_id, delta, *, staff_user=None):
+        """
+        Restocks (``delta > 0``) or adjusts a product's stock by hand. A negative
+        adjustment cannot take more than the available stock. With the ledger
+        inventory it records a movement, the only way the stock changes there.
+        Returns whether the stock was changed.
+        """
+        with transaction.atomic():
+            if settings.INVENTORY_BACKEND == 'ledger':
+                # The refill locks the product's buckets, so no reservation runs in between
+                if delta < 0 and StockBucket.refill(product_id) < -delta:
+                    return False
+                reason = StockMovement.RESTOCK if delta > 0 else StockMovement.ADJUST
+                StockMovement.record({product_id: delta}, reason, staff_user=staff_user)
+            else:
+                products = cls.objects.filter(pk=product_id)
+                if delta < 0:
+                    products = products.filter(stock__gte=-delta)
+                if not products.update(stock=models.F('stock') + delta, updated_at=timezone.now()):
+                    return False
+            # Rare manual changes: always refresh the bot's catalog
+            cls._availability_changed()
+        return True
+
+    @staticmethod
+    def _availability_changed():
+        """
+        Bumps the catalog version on commit when a product sells out or comes back.
+
+        Other stock changes leave the version alone. Bumping it on every reservation
+        would make the version row a hot spot, and it would also invalidate every
+        catalog cache. In between, cached catalogs may show a slightly old stock
+        count, but never a sold-out product as available or the other way round.
+        Reservations always check the real stock. update() skips the post_save
+        signal, and the bump waits for the commit so its row lock is not held
+        meanwhile.
+        """
+        transaction.on_commit(lambda: DataVersion.bump(DataVersion.CATALOG))
+
 class User(models.Model):
     telegram_id = models.CharField(max_length=100, unique=True)
     username = models.CharField(max_length=100, blank=True, null=True)
@@ -38,10 +154,19 @@ class Conversation(models.Model):
     user = models.ForeignKey(User, related_name='conversations', on_delete=models.CASCADE)
     start_time = models.DateTimeField(default=timezone.now)
     end_time = models.DateTimeField(blank=True, null=True)
+    summary = models.TextField(blank=True, default='')
+    summary_until = models.PositiveBigIntegerField(blank=True, null=True)
+    summary_updated_at = models.DateTimeField(blank=True, null=True)
     
     def __str__(self):
         return f"Conversation with {self.user} at {self.start_time}"
 
+    class Meta:
+        indexes = [
+            # A user's conversations newest first (latest conversation, cursor pages)
+            models.Index(fields=['user', 'start_time', 'id'], name='conversation_user_start_idx'),
+        ]
+
 class Message(models.Model):
     SENDER_CHOICES = (
         ('user', 'User'),
@@ -56,6 +181,14 @@ class Message(models.Model):
     def __str__(self):
         return f"{self.sender} message at {self.timestamp}"
 
+    class Meta:
+        indexes = [
+            # Cursor pages of a conversation's messages, in either direction
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conv_time_idx'),
+            # Memory window: messages of a conversation after the summarized id
+            models.Index(fields=['conversation', 'id'], name='message_conv_id_idx'),
+        ]
+
 class ProductComparison(models.Model):
     conversation = models.ForeignKey(Conversation, related_name='comparisons', on_delete=models.CASCADE)
     products = models.ManyToManyField(Product, related_name='comparisons')
@@ -83,10 +216,48 @@ class Order(models.Model):
     def __str__(self):
         return f"Order {self.id} by {self.user}"
 
+    class Meta:
+        indexes = [
+            # A user's orders newest first (bot order list, cursor pages)
+            models.Index(fields=['user', 'created_at', 'id'], name='order_user_created_idx'),
+            # A user's orders in a given status
+            models.Index(fields=['user', 'status', 'created_at'], name='order_user_status_idx'),
+            # The pending order ``reserve`` looks up; pending orders are a small fraction of the table
+            models.Index(fields=['user'], condition=models.Q(status='pending'), name='order_pending_user_idx'),
+        ]
+
     def calculate_total(self):
-        """Calculates or recalculates the total amount of the order from its items."""
-        self.total_amount = sum(item.get_item_price() for item in self.items.all())
-        self.save()
+        """
+        Recalculates the total amount of the order from its items, inside the database.
+
+        Totals are kept up to date incrementally by the order item save/delete receivers
+        (see ``signals.py``); this full recalculation is only needed to repair drift
+        (see ``check_order_totals``).
+        """
+        Order.objects.filter(pk=self.pk).update(total_amount=Order.items_total(), updated_at=timezone.now())
+        self.refresh_from_db(fields=['total_amount', 'updated_at'])
+
+    @staticmethod
+    def items_total():
+        """Expression for the sum of an order's line items, for ``annotate()``/``update()`` on orders."""
+        lines = (
+            OrderItem.objects
+            .filter(order=models.OuterRef('pk'))
+            .order_by()
+            .values('order')
+            .annotate(total=models.Sum(models.F('price') * models.F('quantity')))
+            .values('total')
+        )
+        amount = models.DecimalField(max_digits=10, decimal_places=2)
+        return Coalesce(models.Subquery(lines, output_field=amount), models.Value(Decimal(0)), output_field=amount)
+
+    @classmethod
+    def add_to_total(cls, order_id, amount):
+        """Atomically adds ``amount`` (possibly negative) to an order's total with a single UPDATE."""
+        if amount:
+            cls.objects.filter(pk=order_id).update(
+                total_amount=models.F('total_amount') + amount, updated_at=timezone.now()
+            )
 
 class OrderItem(models.Model):
     order = models.ForeignKey(Order, related_name='items', on_delete=models.CASCADE)
@@ -101,6 +272,30 @@ class OrderItem(models.Model):
         """Returns the total price for this line item."""
         return self.price * self.quantity
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_line = instance._line() if {'order_id', 'price', 'quantity'} <= set(field_names) else None
+        return instance
+
+    def _line(self):
+        return self.order_id, self.get_item_price()
+
+    def _stored(self):
+        """``(order_id, line total)`` as stored in the database, or ``None`` for a new item."""
+        if self._state.adding:
+            return None
+        stored = getattr(self, '_stored_line', None)
+        if stored is None:
+            row = OrderItem.objects.filter(pk=self.pk).values_list('order_id', 'price', 'quantity').first()
+            stored = (row[0], row[1] * row[2]) if row else None
+        return stored
+
+    def save(self, *args, **kwargs):
+        # The order total moves in the post_save receiver (see signals.py), in the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
 class FAQCategory(models.Model):
     name = models.CharField(max_length=100)
     
@@ -117,3 +312,324 @@ class FAQ(models.Model):
     
     def __str__(self):
         return self.question
+
+class BotIntent(models.Model):
+    """
+    Intent the bot recognizes by key phrases (same format as ``bot_service/intents.json``).
+
+    Editable from the admin; with ``INTENTS_SOURCE=api`` the bot loads the active ones
+    from ``/api/intents/`` at startup instead of the bundled file.
+    """
+    name = models.CharField(max_length=50, unique=True)
+    phrases = models.JSONField(default=list)
+    priority = models.PositiveIntegerField(default=100)
+    response = models.TextField(blank=True, default='')
+    action = models.CharField(max_length=50, blank=True, default='')
+    is_active = models.BooleanField(default=True)
+
+    def __str__(self):
+        return self.name
+
+class DataVersion(models.Model):
+    """Change counter for a data set the bot caches (e.g. the catalog or the FAQs)."""
+    CATALOG = 'catalog'
+    FAQS = 'faqs'
+
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} v{self.version}"
+
+    @classmethod
+    def bump(cls, name):
+        """Atomically increments the version of ``name``, creating the row the first time."""
+        updated = cls.objects.filter(name=name).update(version=models.F('version') + 1, updated_at=timezone.now())
+        if not updated:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, version=1)
+            except IntegrityError:
+                # Created concurrently by another request
+                cls.objects.filter(name=name).update(version=models.F('version') + 1, updated_at=timezone.now())
+
+    @classmethod
+    def current(cls, *names):
+        """Returns ``{name: version}``; data sets never changed are at version 0."""
+        versions = dict.fromkeys(names, 0)
+        versions.update(cls.objects.filter(name__in=names).values_list('name', 'version'))
+        return versions
+
+    @classmethod
+    def stamp(cls, name):
+        """Returns ``(version, updated_at)`` of ``name``; ``(0, None)`` if it never changed."""
+        return cls.objects.filter(name=name).values_list('version', 'updated_at').first() or (0, None)
+
+class StockMovement(models.Model):
+    """
+    Append-only inventory ledger: every change of a product's available stock.
+
+    With ``INVENTORY_BACKEND = 'ledger'`` reservations and releases insert rows here
+    instead of updating the product, so the product row is no longer written on every
+    reservation. The available stock is ``Product.stock`` (the snapshot) plus the
+    movements after ``Product.stock_until``; ``compact`` folds old movements into the
+    snapshot. Rows are never updated or deleted and keep the order and user (or the
+    staff user, for admin movements) even after those are deleted, so the table
+    doubles as the audit trail of who reserved what.
+
+    Reservations draw from the product's ``StockBucket`` rows instead of locking the
+    whole product, see ``take``.
+
+    Like the counter inventory, movements only bump the catalog ``DataVersion`` when
+    a product sells out or comes back (see ``Product._availability_changed``).
+    Compaction bumps it too, so other bot workers pick up the exact counts after the
+    next compaction or when their cache expires.
+    """
+    RESERVE = 'reserve'
+    RELEASE = 'release'
+    RESTOCK = 'restock'
+    ADJUST = 'adjust'
+    REASON_CHOICES = (
+        (RESERVE, 'Reserve'),
+        (RELEASE, 'Release'),
+        (RESTOCK, 'Restock'),
+        (ADJUST, 'Adjust'),
+    )
+
+    product = models.ForeignKey(Product, related_name='stock_movements', on_delete=models.CASCADE)
+    delta = models.IntegerField()
+    reason = models.CharField(max_length=20, choices=REASON_CHOICES)
+    order = models.ForeignKey(
+        Order, related_name='stock_movements', on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True
+    )
+    user = models.ForeignKey(
+        User, related_name='stock_movements', on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True
+    )
+    # Admin user behind a manual restock or adjustment
+    staff_user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, related_name='stock_movements', on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True,
+    )
+    created_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.delta:+d} x {self.product_id} ({self.reason})"
+
+    class Meta:
+        indexes = [
+            # Movements of a product after its snapshot
+            models.Index(fields=['product', 'id'], name='stockmovement_product_idx'),
+        ]
+
+    @classmethod
+    def available(cls, product_id):
+        """Snapshot plus the movements after it; 0 for an unknown product."""
+        snapshot = Product.objects.filter(pk=product_id).values_list('stock', 'stock_until').first()
+        if snapshot is None:
+            return 0
+        stock, until = snapshot
+        pending = cls.objects.filter(product_id=product_id, id__gt=until).aggregate(total=models.Sum('delta'))
+        return stock + (pending['total'] or 0)
+
+    @classmethod
+    def take(cls, product_id, quantity, *, order_id=None, user_id=None):
+        """
+        Appends a reservation of ``quantity`` units if that many are available.
+
+        The units come out of one of the product's ``StockBucket`` rows (see
+        ``StockBucket.draw``), so concurrent reservations of the same product lock
+        different rows instead of queueing on the whole product. The bucket row stays
+        locked until the caller's transaction commits: callers should take stock as
+        the last step of their transaction. When no bucket holds enough,
+        ``StockBucket.refill`` locks them all and splits the exact available stock again.
+
+        Only a reservation that empties its bucket checks whether the product sold out.
+        Two of them emptying the last buckets at the same time may both miss it; the
+        catalog version then moves at the next compaction.
+        """
+        with transaction.atomic():
+            emptied = StockBucket.draw(product_id, quantity)
+            if emptied is None:
+                available = StockBucket.refill(product_id, taking=quantity)
+                if available < quantity:
+                    return False
+            cls.objects.create(
+                product_id=product_id, delta=-quantity, reason=cls.RESERVE, order_id=order_id, user_id=user_id
+            )
+            if emptied is None:
+                sold_out = available == quantity
+            else:
+                sold_out = emptied and cls.available(product_id) == 0
+        if sold_out:
+            Product._availability_changed()
+        return True
+
+    @classmethod
+    def record(cls, quantities, reason, *, order_id=None, user_id=None, staff_user=None):
+        """
+        Appends ``{product_id: delta}`` movements in one INSERT.
+
+        Units given back take no lock: they reach the buckets at the next refill.
+        Units removed (a negative adjustment) refill the product's buckets right away,
+        so they can no longer be reserved.
+        """
+        with transaction.atomic():
+            cls.objects.bulk_create([
+                cls(
+                    product_id=product_id, delta=delta, reason=reason, order_id=order_id, user_id=user_id,
+                    staff_user=staff_user,
+                )
+                for product_id, delta in quantities.items()
+            ])
+            for product_id in sorted(pk for pk, delta in quantities.items() if delta < 0):
+                StockBucket.refill(product_id)
+
+    @classmethod
+    def compact(cls, older_than):
+        """
+        Folds the movements created before ``older_than`` into each product's snapshot.
+
+        Only a contiguous run of old movements is folded: ids are assigned before
+        commit, so a newer id can become visible before an older one, and stopping at
+        the first recent movement keeps a late commit from being skipped. ``older_than``
+        should leave a margin longer than any reserving transaction. The buckets of a
+        compacted product are refilled, which also hands out the stock given back
+        since. Returns the number of products compacted.
+        """
+        product_ids = list(
+            Product.objects.filter(stock_movements__id__gt=models.F('stock_until'))
+            .values_list('pk', flat=True).distinct()
+        )
+        compacted = 0
+        for product_id in product_ids:
+            with transaction.atomic():
+                until = Product.objects.select_for_update().values_list('stock_until', flat=True).get(pk=product_id)
+                pending = cls.objects.filter(product_id=product_id, id__gt=until)
+                first_recent = pending.filter(created_at__gte=older_than).order_by('id').values_list('id', flat=True).first()
+                if first_recent is not None:
+                    pending = pending.filter(id__lt=first_recent)
+                folded = pending.aggregate(total=models.Sum('delta'), until=models.Max('id'))
+                if folded['until'] is None:
+                    continue
+                Product.objects.filter(pk=product_id).update(
+                    stock=models.F('stock') + folded['total'], stock_until=folded['until'], updated_at=timezone.now()
+                )
+                StockBucket.refill(product_id)
+                compacted += 1
+        if compacted:
+            DataVersion.bump(DataVersion.CATALOG)
+        return compacted
+
+
+class StockBucket(models.Model):
+    """
+    Share of a product's available stock that reservations can take on their own
+    (ledger inventory only).
+
+    The available stock is split over ``INVENTORY_BUCKETS`` rows per product so
+    that concurrent reservations lock different rows. The buckets never add up to
+    more than the ledger says is available: reservations take from a bucket and
+    append their movement in the same transaction, and only ``refill`` puts units
+    back, under a lock on every bucket of the product. Units given back wait in the
+    ledger until the next refill.
+    """
+    product = models.ForeignKey(Product, related_name='stock_buckets', on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField()
+    quantity = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.product_id}[{self.index}]: {self.quantity}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'index'], name='stockbucket_product_index_uniq'),
+        ]
+
+    @classmethod
+    def draw(cls, product_id, quantity):
+        """
+        Takes ``quantity`` units from a random bucket that holds them. Returns whether
+        the bucket was emptied, or ``None`` if no bucket holds enough.
+
+        Buckets locked by other transactions are skipped first. Only when all of them
+        are locked (e.g. during a refill) does it wait for one, inside a savepoint that
+        is rolled back if the bucket no longer holds enough: a reservation never keeps
+        a lock on a bucket it does not take from, so it cannot deadlock with
+        ``refill``, which locks them all in order.
+        """
+        buckets = cls.objects.filter(product_id=product_id, quantity__gte=quantity)
+        bucket = buckets.select_for_update(skip_locked=True).order_by('?').values_list('pk', 'quantity').first()
+        if bucket is None:
+            candidates = list(buckets.values_list('pk', flat=True))
+            random.shuffle(candidates)
+            for pk in candidates:
+                with transaction.atomic():
+                    bucket = cls.objects.select_for_update().filter(pk=pk).values_list('pk', 'quantity').first()
+                    if bucket is not None and bucket[1] >= quantity:
+                        break
+                    bucket = None
+                    transaction.set_rollback(True)
+        if bucket is None:
+            return None
+        pk, held = bucket
+        cls.objects.filter(pk=pk).update(quantity=held - quantity)
+        return held == quantity
+
+    @classmethod
+    def refill(cls, product_id, taking=0):
+        """
+        Locks every bucket of the product and splits the available stock among them
+        again, less ``taking`` units when that many are available (the caller then
+        records their reservation). Creates the buckets the first time. Returns the
+        available stock as read under the lock.
+
+        Every unfinished reservation holds a bucket row, so once all of them are
+        locked the ledger is exact; stock given back in a transaction that has not
+        committed yet is left for the next refill.
+        """
+        count = settings.INVENTORY_BUCKETS
+        buckets = cls.objects.select_for_update().filter(product_id=product_id).order_by('index')
+        locked = list(buckets)
+        if len(locked) < count:
+            cls.objects.bulk_create(
+                [cls(product_id=product_id, index=index) for index in range(count)], ignore_conflicts=True
+            )
+            locked = list(buckets.all())
+        available = StockMovement.available(product_id)
+        remaining = available - taking if available >= taking else available
+        share, extra = divmod(max(remaining, 0), count)
+        changed = []
+        for bucket in locked:
+            quantity = share + (bucket.index < extra) if bucket.index < count else 0
+            if bucket.quantity != quantity:
+                bucket.quantity = quantity
+                changed.append(bucket)
+        cls.objects.bulk_update(changed, ['quantity'])
+        return available
+
+
+class BotStateEntry(models.Model):
+    """
+    Shared key/value state of the bot workers (e.g. the /cancelar index map).
+
+    Written in batches by the bot's ``APIStateStore`` so that every replica, on any
+    machine, sees the same in-progress flows. ``expires_at`` is a Unix timestamp;
+    expired entries read as missing and are removed by the purge endpoint.
+    """
+    namespace = models.CharField(max_length=50)
+    key = models.CharField(max_length=100)
+    value = models.JSONField()
+    expires_at = models.FloatField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.namespace}:{self.key}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['namespace', 'key'], name='botstateentry_namespace_key_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['expires_at'], name='botstateentry_expires_idx'),
+        ]
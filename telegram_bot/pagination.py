@@ -0,0 +1,52 @@
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+# Largest page a client may request with ?limit=
+MAX_PAGE_SIZE = 200
+
+
+class LimitPageNumberPagination(PageNumberPagination):
+    """Page number pagination whose page size can be chosen with ``?limit=``."""
+    page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+
+
+class LimitCursorPagination(CursorPagination):
+    """
+    Cursor pagination: the cursor carries the value of the first ordering field of
+    the last row, and the next page filters on it instead of scanning an OFFSET from
+    the start, so deep pages cost about the same as the first one.
+
+    DRF's cursor only encodes ``ordering[0]``; rows that tie on it are told apart
+    with a small offset stored in the cursor. Ordering on a nearly unique field
+    (timestamps) keeps that offset short. The ``id`` appended below as a tie-breaker
+    makes the order within a tie deterministic, so pages do not skip or repeat rows.
+    It is not part of the cursor.
+
+    The page size can be chosen with ``?limit=`` (up to ``MAX_PAGE_SIZE``). When the
+    view allows ``?ordering=``, the requested ordering is used.
+
+    Unlike page number pagination, responses have no ``count`` and there is no
+    ``?page=``: clients follow ``next``/``previous``. This is an API contract change
+    for the endpoints that use it (conversations, messages, orders). The bot only
+    reads ``results``.
+    """
+    page_size_query_param = 'limit'
+    max_page_size = MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        ordering = tuple(super().get_ordering(request, queryset, view))
+        if not any(field.lstrip('-') in ('id', 'pk') for field in ordering):
+            ordering += ('-id' if ordering[0].startswith('-') else 'id',)
+        return ordering
+
+
+class MessageCursorPagination(LimitCursorPagination):
+    ordering = ('-timestamp', '-id')
+
+
+class ConversationCursorPagination(LimitCursorPagination):
+    ordering = ('-start_time', '-id')
+
+
+class OrderCursorPagination(LimitCursorPagination):
+    ordering = ('-created_at', '-id')
@@ -1,7 +1,8 @@
+from django.conf import settings
 from rest_framework import serializers
 from .models import (
     Category, Product, User, Conversation, Message, 
-    ProductComparison, Order, OrderItem, FAQ, FAQCategory
+    ProductComparison, Order, OrderItem, FAQ, FAQCategory, BotIntent
 )
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -16,6 +17,22 @@ class ProductSerializer(serializers.ModelSerializer):
         model = Product
         fields = ['id', 'name', 'description', 'price', 'category', 'category_name', 'image_url', 'stock', 'created_at', 'updated_at']
 
+    def get_fields(self):
+        fields = super().get_fields()
+        if settings.INVENTORY_BACKEND == 'ledger':
+            # ``stock`` reports the available stock, not the snapshot: it changes
+            # through stock movements (see ProductViewSet.adjust_stock)
+            fields['stock'].read_only = True
+        return fields
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # With the ledger inventory ``stock`` is only the last snapshot
+        available = getattr(instance, 'available_stock', None)
+        if available is not None:
+            data['stock'] = available
+        return data
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -32,7 +49,8 @@ class ConversationSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
-        fields = ['id', 'user', 'user_details', 'start_time', 'end_time', 'messages']
+        fields = ['id', 'user', 'user_details', 'start_time', 'end_time', 'summary', 'summary_until', 'messages']
+        read_only_fields = ['summary', 'summary_until']
 
 class ProductComparisonSerializer(serializers.ModelSerializer):
     products_details = ProductSerializer(source='products', many=True, read_only=True)
@@ -66,4 +84,46 @@ class FAQSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = FAQ
-        fields = ['id', 'question', 'answer', 'category', 'category_name'] 
\ No newline at end of file
+        fields = ['id', 'question', 'answer', 'category', 'category_name'] 
+
+class BotIntentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = BotIntent
+        fields = ['id', 'name', 'phrases', 'priority', 'response', 'action', 'is_active']
+
+    def validate_phrases(self, value):
+        if not isinstance(value, list) or not all(isinstance(phrase, str) for phrase in value):
+            raise serializers.ValidationError("phrases must be a list of strings")
+        return value
+
+class BulkMessageItemSerializer(serializers.Serializer):
+    """One message of a bulk ingestion request, identified by conversation or by telegram_id."""
+    conversation = serializers.IntegerField(required=False)
+    telegram_id = serializers.CharField(max_length=100, required=False)
+    username = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    first_name = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    last_name = serializers.CharField(max_length=100, required=False, allow_null=True, allow_blank=True)
+    sender = serializers.ChoiceField(choices=Message.SENDER_CHOICES)
+    content = serializers.CharField(allow_blank=True, trim_whitespace=False)
+    timestamp = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if not attrs.get('conversation') and not attrs.get('telegram_id'):
+            raise serializers.ValidationError("conversation or telegram_id is required")
+        return attrs
+
+
+class ConversationSummarySerializer(serializers.Serializer):
+    """New rolling summary of a conversation, covering its messages up to ``until``."""
+    summary = serializers.CharField(trim_whitespace=True)
+    until = serializers.IntegerField(min_value=1)
+    # Value of summary_until the summary was built on; guards against concurrent writers
+    previous_until = serializers.IntegerField(required=False, allow_null=True)
+
+
+class BotStateWriteSerializer(serializers.Serializer):
+    """One write of a bot state batch; a null ``value`` deletes the entry."""
+    namespace = serializers.CharField(max_length=50)
+    key = serializers.CharField(max_length=100)
+    value = serializers.JSONField(allow_null=True)
+    expires_at = serializers.FloatField(required=False, allow_null=True)
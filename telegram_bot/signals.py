@@ -0,0 +1,68 @@
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import FAQ, Category, DataVersion, FAQCategory, Order, OrderItem, Product
+
+VERSIONED_MODELS = {
+    Product: DataVersion.CATALOG,
+    Category: DataVersion.CATALOG,
+    FAQ: DataVersion.FAQS,
+    FAQCategory: DataVersion.FAQS,
+}
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def bump_data_version(sender, **kwargs):
+    """Any saved or deleted product/FAQ (or their categories) invalidates the bot caches."""
+    name = VERSIONED_MODELS.get(sender)
+    if name and not kwargs.get('raw'):
+        DataVersion.bump(name)
+
+
+@receiver(pre_save, sender=OrderItem)
+@receiver(pre_delete, sender=OrderItem)
+def remember_order_line(sender, instance, raw=False, **kwargs):
+    if not raw:
+        instance._previous_line = instance._stored()
+
+
+@receiver(post_save, sender=OrderItem)
+def move_order_total_on_save(sender, instance, raw=False, **kwargs):
+    """
+    Moves the item's order total by the change in the line total: O(1) per edit.
+
+    ``bulk_create()`` and queryset ``update()`` send no signals; totals they leave
+    behind are repaired by ``check_order_totals --fix``.
+    """
+    if raw:
+        return
+    previous = instance.__dict__.pop('_previous_line', None)
+    current = instance._line()
+    if previous is None:
+        Order.add_to_total(instance.order_id, current[1])
+    elif previous[0] == current[0]:
+        Order.add_to_total(instance.order_id, current[1] - previous[1])
+    else:
+        Order.add_to_total(previous[0], -previous[1])
+        Order.add_to_total(instance.order_id, current[1])
+    instance._stored_line = current
+
+
+@receiver(post_delete, sender=OrderItem)
+def move_order_total_on_delete(sender, instance, origin=None, **kwargs):
+    """
+    Takes a deleted item's line out of its order total. Also runs for queryset
+    deletes and cascades (e.g. deleting a product), except when the order itself
+    is being deleted.
+    """
+    previous = instance.__dict__.pop('_previous_line', None)
+    instance._stored_line = None
+    if previous is None:
+        return
+    if isinstance(origin, Order) and origin.pk == previous[0]:
+        return
+    if isinstance(origin, QuerySet) and origin.model is Order:
+        return
+    Order.add_to_total(previous[0], -previous[1])
@@ -1,3 +1,832 @@
-from django.test import TestCase
+import threading
+import time
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.http import http_date
+from rest_framework import status
+from rest_framework.test import APIClient, APITestCase
+
+from .models import (
+    FAQ, BotIntent, BotStateEntry, Category, Conversation, DataVersion, FAQCategory, Message, Order, OrderItem, Product,
+    StockBucket, StockMovement, User,
+)
+from .pagination import MessageCursorPagination
+
+
+class BulkMessageIngestionTests(APITestCase):
+    url = '/api/messages/bulk/'
+
+    def _item(self, telegram_id, sender='user', content='hola', **extra):
+        return {'telegram_id': telegram_id, 'sender': sender, 'content': content, **extra}
+
+    def test_creates_users_conversations_and_messages(self):
+        payload = {'messages': [
+            self._item('100', 'user', 'hola', username='ana'),
+            self._item('100', 'bot', '¡Hola Ana!'),
+            self._item('200', 'user', 'precio?'),
+        ]}
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        results = response.data['results']
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertEqual(User.objects.count(), 2)
+        self.assertEqual(User.objects.get(telegram_id='100').username, 'ana')
+        self.assertEqual(results[0]['conversation'], results[1]['conversation'])
+        self.assertNotEqual(results[0]['conversation'], results[2]['conversation'])
+        self.assertEqual(
+            list(Message.objects.order_by('id').values_list('sender', 'content')),
+            [('user', 'hola'), ('bot', '¡Hola Ana!'), ('user', 'precio?')],
+        )
+
+    def test_reuses_latest_conversation(self):
+        user = User.objects.create(telegram_id='100')
+        Conversation.objects.create(user=user)
+        latest = Conversation.objects.create(user=user)
+
+        response = self.client.post(self.url, {'messages': [self._item('100')]}, format='json')
+
+        self.assertEqual(response.data['results'][0]['conversation'], latest.id)
+        self.assertEqual(response.data['results'][0]['user'], user.id)
+
+    def test_explicit_conversation(self):
+        conversation = Conversation.objects.create(user=User.objects.create(telegram_id='100'))
+        payload = [{'conversation': conversation.id, 'sender': 'bot', 'content': 'ok'}]
+
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(conversation.messages.count(), 1)
+
+    def test_query_count_does_not_grow_with_batch_size(self):
+        User.objects.create(telegram_id='1')
+        items = [self._item(str(i % 20), 'user' if i % 2 else 'bot') for i in range(200)]
+
+        # savepoint + users lookup/insert/re-read + latest conversations
+        # + conversations insert + messages insert + release savepoint
+        with self.assertNumQueries(8):
+            response = self.client.post(self.url, {'messages': items}, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(Message.objects.count(), 200)
+
+    def test_invalid_items_are_reported_by_index(self):
+        payload = {'messages': [self._item('100'), {'sender': 'robot', 'content': 'x'}]}
+
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([r['index'] for r in response.data['results']], [0])
+        self.assertEqual([e['index'] for e in response.data['errors']], [1])
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_batch_without_valid_items_is_rejected(self):
+        payload = {'messages': [{'sender': 'robot', 'content': 'x'}]}
+
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.data['errors'][0]['index'], 0)
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_unknown_conversation_is_rejected(self):
+        payload = [{'conversation': 999, 'sender': 'user', 'content': 'x'}]
+
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('conversation', response.data['errors'][0]['errors'])
+
+    def test_stale_conversation_falls_back_to_telegram_id(self):
+        user = User.objects.create(telegram_id='100')
+        latest = Conversation.objects.create(user=user)
+        payload = [
+            self._item('100', conversation=999),
+            {'conversation': 998, 'sender': 'bot', 'content': 'x'},
+        ]
+
+        response = self.client.post(self.url, payload, format='json')
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['results'], [
+            {'index': 0, 'id': Message.objects.get().id, 'conversation': latest.id, 'user': user.id},
+        ])
+        self.assertEqual([e['index'] for e in response.data['errors']], [1])
+
+
+class ConversationMemoryTests(APITestCase):
+    def setUp(self):
+        self.conversation = Conversation.objects.create(user=User.objects.create(telegram_id='100'))
+        self.messages = Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender='user' if i % 2 else 'bot', content=f'm{i}')
+            for i in range(10)
+        ])
+
+    def _memory(self, tail=3):
+        return self.client.get('/api/bot-context/100/', {'messages': tail}).data['memory']
+
+    def test_memory_splits_tail_and_pending(self):
+        data = self._memory()
+        self.assertEqual([m['content'] for m in data['tail']], ['m7', 'm8', 'm9'])
+        self.assertEqual([m['content'] for m in data['pending']], [f'm{i}' for i in range(7)])
+        self.assertEqual(data['summary'], '')
+
+    def test_summary_advances_the_window(self):
+        url = f'/api/conversations/{self.conversation.id}/summary/'
+        until = self.messages[4].id
+        response = self.client.post(url, {'summary': 'Busca un celular', 'until': until}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        data = self._memory()
+        self.assertEqual(data['summary'], 'Busca un celular')
+        self.assertEqual([m['content'] for m in data['pending']], ['m5', 'm6'])
+
+        stale = self.client.post(url, {'summary': 'otro', 'until': self.messages[6].id}, format='json')
+        self.assertEqual(stale.status_code, status.HTTP_409_CONFLICT)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_until, until)
+
+    def test_summary_for_unknown_conversation(self):
+        response = self.client.post('/api/conversations/999/summary/', {'summary': 'x', 'until': 1}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class BotContextTests(APITestCase):
+    def setUp(self):
+        category = Category.objects.create(name='Celulares')
+        Product.objects.create(name='iPhone', description='x', price=1000, category=category, stock=3)
+        FAQ.objects.create(question='¿Envíos?', answer='Sí', category=FAQCategory.objects.create(name='General'))
+        self.user = User.objects.create(telegram_id='100')
+        Conversation.objects.create(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user)
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, sender='user', content=f'm{i}') for i in range(8)
+        ])
+
+    def test_bundle_in_fixed_number_of_queries(self):
+        # conversation+user, memory tail, memory pending, versions, products, faqs
+        with self.assertNumQueries(6):
+            response = self.client.get('/api/bot-context/100/', {'messages': 3, 'include': 'products,faqs'})
+
+        data = response.data
+        self.assertEqual(data['user'], self.user.id)
+        self.assertEqual(data['conversation'], self.conversation.id)
+        self.assertEqual([m['content'] for m in data['memory']['tail']], ['m5', 'm6', 'm7'])
+        self.assertEqual(len(data['memory']['pending']), 5)
+        self.assertEqual(data['products'][0]['category_name'], 'Celulares')
+        self.assertEqual(data['faqs'][0]['question'], '¿Envíos?')
+
+    def test_versions_change_with_catalog_and_faqs(self):
+        before = self.client.get('/api/bot-context/100/').data['versions']
+        Product.objects.first().save()
+        after = self.client.get('/api/bot-context/100/').data['versions']
+        self.assertEqual(after[DataVersion.CATALOG], before[DataVersion.CATALOG] + 1)
+        self.assertEqual(after[DataVersion.FAQS], before[DataVersion.FAQS])
+
+    def test_unknown_user_and_user_without_conversation(self):
+        data = self.client.get('/api/bot-context/999/').data
+        self.assertIsNone(data['user'])
+        self.assertIsNone(data['memory'])
+
+        User.objects.create(telegram_id='200')
+        with self.assertNumQueries(3):
+            data = self.client.get('/api/bot-context/200/').data
+        self.assertIsNotNone(data['user'])
+        self.assertIsNone(data['conversation'])
+
+
+class QueryCountTests(APITestCase):
+    """List endpoints must cost a fixed number of queries whatever the page contents."""
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = [Category.objects.create(name=f'Categoría {i}') for i in range(3)]
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Producto {i}', description='x', price=10 + i, category=categories[i % 3], stock=i % 4)
+            for i in range(30)
+        ])
+        faq_categories = [FAQCategory.objects.create(name=f'General {i}') for i in range(2)]
+        FAQ.objects.bulk_create([
+            FAQ(question=f'¿Pregunta {i}?', answer='Respuesta', category=faq_categories[i % 2]) for i in range(20)
+        ])
+        users = User.objects.bulk_create([User(telegram_id=str(i)) for i in range(10)])
+        conversations = Conversation.objects.bulk_create([Conversation(user=users[i % 10]) for i in range(15)])
+        Message.objects.bulk_create([
+            Message(conversation=conversation, sender='user', content=f'm{i}')
+            for conversation in conversations for i in range(10)
+        ])
+        orders = Order.objects.bulk_create([Order(user=users[i % 10]) for i in range(20)])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=cls.products[(o + i) % 30], quantity=1, price=10)
+            for o, order in enumerate(orders) for i in range(3)
+        ])
+        cls.conversation = conversations[0]
+
+    def assertQueries(self, url, count, params=None):
+        with self.assertNumQueries(count):
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def test_orders(self):
+        # orders with users + items with products and categories (cursor pages skip the count)
+        data = self.assertQueries('/api/orders/', 2)
+        self.assertEqual(len(data['results'][0]['items']), 3)
+        self.assertTrue(data['results'][0]['items'][0]['product_details']['category_name'])
+        self.assertQueries('/api/orders/by_user/', 2, {'user_id': '1'})
+        self.assertQueries('/api/order-items/', 2)
+
+    def test_products_and_faqs(self):
+        # version stamp (plus the latest stock change for the catalog) + count + page
+        self.assertQueries('/api/products/', 4)
+        self.assertQueries('/api/products/in_stock/', 3)
+        self.assertQueries('/api/faqs/', 3)
+
+    def test_catalog_stamp_reads_an_index(self):
+        etag = self.client.get('/api/products/')['ETag']
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        latest_change = queries.captured_queries[-1]['sql']
+        self.assertIn('MAX', latest_change)
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # Too few rows for the planner to prefer the index on its own
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute(f'EXPLAIN {latest_change}')
+            else:
+                cursor.execute(f'EXPLAIN QUERY PLAN {latest_change}')
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('product_updated_idx', plan)
+
+    def test_conversations(self):
+        # conversations with users + messages
+        data = self.assertQueries('/api/conversations/', 2)
+        self.assertEqual(len(data['results'][0]['messages']), 10)
+        self.assertQueries(f'/api/conversations/{self.conversation.id}/', 2)
+        self.assertQueries(f'/api/conversations/{self.conversation.id}/messages/', 2)
+
+
+class PaginationTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Periféricos')
+        Product.objects.bulk_create([
+            Product(name=f'Producto {i}', description='x', price=10, category=category) for i in range(120)
+        ])
+        cls.user = User.objects.create(telegram_id='42')
+        cls.other = User.objects.create(telegram_id='43')
+        cls.conversation = Conversation.objects.create(user=cls.user)
+        Message.objects.bulk_create([
+            Message(conversation=cls.conversation, sender='user', content=f'm{i}') for i in range(25)
+        ])
+        Order.objects.bulk_create([Order(user=cls.user) for _ in range(7)] + [Order(user=cls.other)])
+
+    def walk(self, url, params):
+        """Follows ``next`` links and returns every id in the order they were served."""
+        ids, pages = [], 0
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            ids += [item['id'] for item in response.data['results']]
+            pages += 1
+            if not response.data['next']:
+                return ids, pages
+            response = self.client.get(response.data['next'])
+
+    def test_page_number_endpoints_honor_limit(self):
+        response = self.client.get('/api/products/', {'limit': 100})
+        self.assertEqual(len(response.data['results']), 100)
+        self.assertEqual(response.data['count'], 120)
+        response = self.client.get('/api/products/', {'limit': 1000})
+        self.assertEqual(len(response.data['results']), 120)
+        response = self.client.get('/api/products/')
+        self.assertEqual(len(response.data['results']), 10)
+
+    def test_message_cursor_walks_every_message_once(self):
+        ids, pages = self.walk('/api/messages/', {'conversation': self.conversation.id, 'limit': 10})
+        self.assertEqual(pages, 3)
+        expected = list(
+            Message.objects.filter(conversation=self.conversation)
+            .order_by('-timestamp', '-id').values_list('id', flat=True)
+        )
+        self.assertEqual(ids, expected)
+        ids, _ = self.walk('/api/messages/', {'conversation': self.conversation.id, 'ordering': 'timestamp'})
+        self.assertEqual(ids, expected[::-1])
+
+    def test_order_cursor_filters_by_telegram_id(self):
+        ids, pages = self.walk('/api/orders/', {'user__telegram_id': '42', 'ordering': '-created_at', 'limit': 3})
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(ids), sorted(Order.objects.filter(user=self.user).values_list('id', flat=True)))
+        self.assertEqual(len(set(ids)), 7)
+
+    def test_cursor_page_size_is_capped(self):
+        response = self.client.get('/api/conversations/', {'limit': 10000})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(MessageCursorPagination.max_page_size, 200)
+
+
+class BenchmarkQueriesCommandTests(TransactionTestCase):
+    def test_reports_both_plans_and_leaves_no_trace(self):
+        out = StringIO()
+        call_command('benchmark_queries', users=20, messages=5, orders=3, repeat=5, stdout=out)
+        output = out.getvalue()
+        self.assertIn('Sin índices compuestos', output)
+        self.assertIn('message_conv_time_idx', output)
+        self.assertIn('Pedido pendiente (reserve)', output)
+        self.assertFalse(User.objects.exists())
+        self.assertFalse(Message.objects.exists())
+
+
+class ReservationStockTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Monitores')
+        cls.monitor = Product.objects.create(name='Monitor', description='x', price=100, category=category, stock=5)
+        cls.cable = Product.objects.create(name='Cable', description='x', price=5, category=category, stock=10)
+
+    def reserve(self, product, quantity, telegram_id='7'):
+        return self.client.post(
+            f'/api/products/{product.id}/reserve/', {'telegram_id': telegram_id, 'quantity': quantity}, format='json'
+        )
+
+    def stock(self, product):
+        return Product.objects.with_available_stock().get(pk=product.pk).available_stock
+
+    def test_reserve_takes_stock_and_replaces_quantity(self):
+        response = self.reserve(self.monitor, 3)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_amount'], '300.00')
+        self.assertEqual(self.stock(self.monitor), 2)
+        # A new reservation of the same product replaces the quantity: only the difference moves stock
+        self.reserve(self.monitor, 1)
+        self.assertEqual(self.stock(self.monitor), 4)
+        response = self.reserve(self.monitor, 5)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(self.monitor), 0)
+        self.assertEqual(Order.objects.filter(status='pending').count(), 1)
+        self.assertEqual(OrderItem.objects.get().quantity, 5)
+
+    def test_reserve_without_stock_changes_nothing(self):
+        response = self.reserve(self.monitor, 6)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(self.monitor), 5)
+        self.assertFalse(Order.objects.exists())
+
+    def catalog_version(self):
+        return DataVersion.current(DataVersion.CATALOG)[DataVersion.CATALOG]
+
+    def test_catalog_version_moves_only_when_availability_changes(self):
+        before = self.catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.reserve(self.monitor, 1)
+        self.assertEqual(self.catalog_version(), before)
+        with self.captureOnCommitCallbacks(execute=True):
+            order_id = self.reserve(self.monitor, 5).data['id']  # sells out
+        self.assertEqual(self.catalog_version(), before + 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/orders/{order_id}/cancel/')  # back in stock
+        self.assertEqual(self.catalog_version(), before + 2)
+
+    def test_add_item_moves_stock(self):
+        order_id = self.reserve(self.cable, 1).data['id']
+        url = f'/api/orders/{order_id}/add_item/'
+        response = self.client.post(url, {'product_id': self.monitor.id, 'quantity': '3'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(self.monitor), 2)
+        self.client.post(url, {'product_id': self.monitor.id, 'quantity': 1}, format='json')
+        self.assertEqual(self.stock(self.monitor), 4)
+
+        response = self.client.post(url, {'product_id': self.monitor.id, 'quantity': 6}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(self.monitor), 4)
+        self.assertEqual(OrderItem.objects.get(product=self.monitor).quantity, 1)
+
+        for quantity in ('dos', 0):
+            response = self.client.post(url, {'product_id': self.monitor.id, 'quantity': quantity}, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        # Cancelling gives back exactly what was taken
+        self.client.delete(f'/api/orders/{order_id}/cancel/')
+        self.assertEqual((self.stock(self.monitor), self.stock(self.cable)), (5, 10))
+
+    def test_adjust_stock(self):
+        url = f'/api/products/{self.monitor.id}/adjust_stock/'
+        response = self.client.post(url, {'delta': 3}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['stock'], 8)
+        self.reserve(self.monitor, 2)
+        self.assertEqual(self.client.post(url, {'delta': -7}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.post(url, {'delta': -6}, format='json').data['stock'], 0)
+        for delta in (0, 'tres', None):
+            self.assertEqual(self.client.post(url, {'delta': delta}, format='json').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.reserve(self.monitor, 3).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_put_of_a_read_product_keeps_its_stock(self):
+        self.reserve(self.monitor, 2)
+        url = f'/api/products/{self.monitor.id}/'
+        data = self.client.get(url).data
+        self.assertEqual(self.client.put(url, data, format='json').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(self.monitor), 3)
+        self.assertEqual(self.reserve(self.monitor, 5).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.stock(self.monitor), 0)
+
+    def test_stock_filter_uses_the_available_stock(self):
+        self.reserve(self.cable, 10)
+        response = self.client.get('/api/products/', {'stock': 0})
+        self.assertEqual([product['id'] for product in response.data['results']], [self.cable.id])
+
+    def test_cancel_restores_every_product(self):
+        self.reserve(self.monitor, 2)
+        order_id = self.reserve(self.cable, 4).data['id']
+        response = self.client.delete(f'/api/orders/{order_id}/cancel/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual((self.stock(self.monitor), self.stock(self.cable)), (5, 10))
+        self.assertFalse(Order.objects.exists())
+
+    def test_item_removal_restores_stock_and_total(self):
+        self.reserve(self.monitor, 2)
+        order_id = self.reserve(self.cable, 4).data['id']
+        item = OrderItem.objects.get(product=self.cable)
+        response = self.client.delete(f'/api/order-items/{item.id}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(self.stock(self.cable), 10)
+        self.assertEqual(Order.objects.get(pk=order_id).total_amount, 200)
+
+
+@override_settings(INVENTORY_BACKEND='ledger')
+class LedgerReservationStockTests(ReservationStockTests):
+    """The same reservation behaviour with the append-only inventory ledger."""
+
+    def test_compaction_bumps_catalog_version(self):
+        self.reserve(self.monitor, 1)
+        before = self.catalog_version()
+        StockMovement.compact(timezone.now() + timezone.timedelta(seconds=1))
+        self.assertEqual(self.catalog_version(), before + 1)
+
+    def test_movements_are_an_audit_trail(self):
+        self.reserve(self.monitor, 3)
+        order_id = self.reserve(self.monitor, 1).data['id']
+        self.client.delete(f'/api/orders/{order_id}/cancel/')
+        user = User.objects.get(telegram_id='7')
+        movements = list(StockMovement.objects.order_by('id').values_list('delta', 'reason', 'order_id', 'user_id'))
+        self.assertEqual(movements, [
+            (-3, StockMovement.RESERVE, order_id, user.id),
+            (2, StockMovement.RELEASE, order_id, user.id),
+            (1, StockMovement.RELEASE, order_id, user.id),
+        ])
+        # The product row itself is only written by compaction
+        self.assertEqual(Product.objects.get(pk=self.monitor.pk).stock, 5)
+
+    def test_compaction_folds_old_movements_into_the_snapshot(self):
+        self.reserve(self.monitor, 2)
+        self.reserve(self.cable, 4)
+        cutoff = timezone.now() + timezone.timedelta(seconds=1)
+        StockMovement.objects.create(
+            product=self.monitor, delta=10, reason=StockMovement.RESTOCK,
+            created_at=cutoff + timezone.timedelta(minutes=5),
+        )
+        self.assertEqual(StockMovement.compact(cutoff), 2)
+
+        monitor = Product.objects.get(pk=self.monitor.pk)
+        # The recent restock stays outside the snapshot but still counts as available
+        self.assertEqual(monitor.stock, 3)
+        self.assertEqual(self.stock(self.monitor), 13)
+        self.assertEqual(Product.objects.get(pk=self.cable.pk).stock, 6)
+        self.assertEqual(StockMovement.objects.count(), 3)
+        self.assertEqual(StockMovement.compact(cutoff), 0)
+
+    def test_stock_is_read_only_in_the_api(self):
+        response = self.client.patch(f'/api/products/{self.monitor.id}/', {'stock': 50}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['stock'], 5)
+        self.assertEqual(Product.objects.get(pk=self.monitor.pk).stock, 5)
+
+    def buckets(self, product):
+        return list(StockBucket.objects.filter(product=product).order_by('index').values_list('quantity', flat=True))
+
+    @override_settings(INVENTORY_BUCKETS=4)
+    def test_reservations_draw_from_buckets(self):
+        self.reserve(self.cable, 1)
+        # The first reservation splits the rest of the stock over the buckets
+        self.assertEqual(self.buckets(self.cable), [3, 2, 2, 2])
+        self.reserve(self.cable, 2)
+        self.assertEqual(sum(self.buckets(self.cable)), 8)
+        # No bucket holds 6 more units: the buckets are refilled from the ledger
+        self.assertEqual(self.reserve(self.cable, 8).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.buckets(self.cable), [1, 1, 0, 0])
+        self.assertEqual(self.reserve(self.cable, 11).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.stock(self.cable), 2)
+
+    @override_settings(INVENTORY_BUCKETS=4)
+    def test_released_stock_waits_for_the_next_refill(self):
+        order_id = self.reserve(self.monitor, 5).data['id']
+        self.client.delete(f'/api/orders/{order_id}/cancel/')
+        self.assertEqual(sum(self.buckets(self.monitor)), 0)
+        self.assertEqual(self.reserve(self.monitor, 2).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.buckets(self.monitor), [1, 1, 1, 0])
+
+    def test_product_endpoints_show_available_stock(self):
+        self.reserve(self.cable, 10)
+        response = self.client.get(f'/api/products/{self.cable.id}/')
+        self.assertEqual(response.data['stock'], 0)
+        in_stock = self.client.get('/api/products/in_stock/')
+        self.assertEqual([product['id'] for product in in_stock.data], [self.monitor.id])
+
+
+@override_settings(INVENTORY_BACKEND='ledger', INVENTORY_BUCKETS=4)
+class LedgerAdminTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Monitores')
+        cls.product = Product.objects.create(name='Monitor', description='x', price=100, category=category, stock=5)
+        cls.staff = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'x')
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def test_movements_record_the_staff_user(self):
+        Product.take_stock(self.product.id, 1)
+        response = self.client.post('/admin/telegram_bot/stockmovement/add/', {
+            'product': self.product.id, 'delta': -3, 'reason': StockMovement.ADJUST,
+        })
+        self.assertEqual(response.status_code, 302)
+        movement = StockMovement.objects.get(reason=StockMovement.ADJUST)
+        self.assertEqual(movement.staff_user, self.staff)
+        # The adjustment comes out of the buckets right away
+        self.assertEqual(sum(StockBucket.objects.values_list('quantity', flat=True)), 1)
+        self.assertFalse(Product.take_stock(self.product.id, 2))
+
+    def test_product_stock_is_read_only(self):
+        url = f'/admin/telegram_bot/product/{self.product.id}/change/'
+        self.assertNotContains(self.client.get(url), 'name="stock"')
+        with override_settings(INVENTORY_BACKEND='counter'):
+            self.assertContains(self.client.get(url), 'name="stock"')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs row locks and concurrent connections')
+class ConcurrentReservationTests(TransactionTestCase):
+    def test_concurrent_reservations_never_oversell(self):
+        category = Category.objects.create(name='Ofertas')
+        product = Product.objects.create(name='Oferta', description='x', price=10, category=category, stock=20)
+        results = []
+        start = threading.Barrier(40)
+
+        def reserve(i):
+            client = APIClient()
+            start.wait()
+            try:
+                response = client.post(
+                    f'/api/products/{product.id}/reserve/', {'telegram_id': str(i % 25), 'quantity': 1}, format='json'
+                )
+                results.append(response.status_code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reserve, args=(i,)) for i in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        product = Product.objects.with_available_stock().get(pk=product.pk)
+        reserved = sum(OrderItem.objects.filter(product=product).values_list('quantity', flat=True))
+        self.assertEqual(product.available_stock + reserved, 20)
+        self.assertEqual(results.count(status.HTTP_200_OK), 40 - results.count(status.HTTP_400_BAD_REQUEST))
+        self.assertEqual(Order.objects.filter(status='pending').count(), OrderItem.objects.count())
+
+
+@override_settings(INVENTORY_BACKEND='ledger')
+class LedgerConcurrentReservationTests(ConcurrentReservationTests):
+    pass
+
+
+class OrderTotalTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Accesorios')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Accesorio {i}', description='x', price=10, category=category, stock=100) for i in range(40)
+        ])
+        cls.user = User.objects.create(telegram_id='99')
+
+    def order_with_items(self, count):
+        order = Order.objects.create(user=self.user)
+        for product in self.products[:count]:
+            OrderItem.objects.create(order=order, product=product, quantity=2, price=product.price)
+        return order
+
+    def total(self, order):
+        return Order.objects.values_list('total_amount', flat=True).get(pk=order.pk)
+
+    def test_item_changes_keep_the_total(self):
+        order = self.order_with_items(3)
+        self.assertEqual(self.total(order), 60)
+        item = order.items.first()
+        item.quantity = 5
+        item.save()
+        self.assertEqual(self.total(order), 90)
+        other = Order.objects.create(user=self.user)
+        item.order = other
+        item.save()
+        self.assertEqual((self.total(order), self.total(other)), (40, 50))
+        item.delete()
+        self.assertEqual(self.total(other), 0)
+        order.calculate_total()
+        self.assertEqual(order.total_amount, 40)
+
+    def test_editing_cost_does_not_grow_with_items(self):
+        for count in (2, 30):
+            order = self.order_with_items(count)
+            item = order.items.first()
+            # item UPDATE + order total UPDATE, inside a savepoint
+            with self.assertNumQueries(4):
+                item.quantity = 3
+                item.save()
+            # item, order, locked item, stock, sold-out check, item DELETE and order total UPDATE,
+            # inside a savepoint
+            with self.assertNumQueries(9):
+                response = self.client.delete(f'/api/order-items/{item.id}/')
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(self.total(order), 20 * (count - 1))
+
+    def test_queryset_and_cascade_deletes_update_totals(self):
+        order = self.order_with_items(4)
+        other = self.order_with_items(2)
+        OrderItem.objects.filter(order=order, product__in=self.products[:2]).delete()
+        self.assertEqual(self.total(order), 40)
+        # Deleting a product deletes its lines in every order
+        Product.objects.get(pk=self.products[2].pk).delete()
+        self.assertEqual((self.total(order), self.total(other)), (20, 40))
+        self.products[0].delete()
+        self.assertEqual(self.total(other), 20)
+
+    def test_deleting_an_order_does_not_update_its_total(self):
+        order = self.order_with_items(3)
+        # The order, its items, and the two DELETEs: no total UPDATE per item
+        with self.assertNumQueries(4):
+            Order.objects.get(pk=order.pk).delete()
+        self.assertFalse(OrderItem.objects.exists())
+
+    def test_add_item_updates_total(self):
+        order = self.order_with_items(1)
+        response = self.client.post(
+            f'/api/orders/{order.id}/add_item/', {'product_id': self.products[5].id, 'quantity': 3}, format='json'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.total(order), 50)
+
+    def test_check_order_totals_finds_and_fixes_drift(self):
+        order = self.order_with_items(2)
+        # bulk_create skips save(): the total drifts
+        OrderItem.objects.bulk_create([OrderItem(order=order, product=self.products[9], quantity=1, price=10)])
+        out = StringIO()
+        call_command('check_order_totals', stdout=out)
+        self.assertIn(f'Pedido {order.id}: total 40.00, suma de líneas 50.00', out.getvalue())
+        self.assertEqual(self.total(order), 40)
+        call_command('check_order_totals', fix=True, stdout=StringIO())
+        self.assertEqual(self.total(order), 50)
+        out = StringIO()
+        call_command('check_order_totals', stdout=out)
+        self.assertIn('Todos los totales de pedidos son correctos.', out.getvalue())
+
+
+class ConditionalGetTests(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Audio')
+        cls.product = Product.objects.create(name='Auriculares', description='x', price=30, category=cls.category, stock=3)
+        cls.faq = FAQ.objects.create(question='¿Envíos?', answer='Sí', category=FAQCategory.objects.create(name='General'))
+        # Last-Modified is only sent for changes before the current second
+        an_hour_ago = timezone.now() - timezone.timedelta(hours=1)
+        DataVersion.objects.update(updated_at=an_hour_ago)
+        Product.objects.update(updated_at=an_hour_ago)
+
+    def revalidate(self, url, etag, queries=1):
+        with self.assertNumQueries(queries):
+            return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_data_answers_304_from_the_version_stamp(self):
+        # FAQs: the version; catalog: the version and the latest stock change
+        for url, queries in (('/api/products/', 2), (f'/api/products/{self.product.id}/', 2),
+                             ('/api/products/in_stock/', 2), ('/api/categories/', 2),
+                             ('/api/faqs/', 1), (f'/api/faqs/{self.faq.id}/', 1)):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(response.has_header('Last-Modified'))
+            response = self.revalidate(url, response['ETag'], queries=queries)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED, url)
+            self.assertEqual(response.content, b'')
+
+    def test_writes_change_the_etag(self):
+        products = self.client.get('/api/products/')['ETag']
+        faqs = self.client.get('/api/faqs/')['ETag']
+        self.assertNotEqual(products, faqs)
+
+        self.category.name = 'Sonido'
+        self.category.save()
+        self.assertEqual(self.revalidate('/api/products/', products, queries=4).status_code, status.HTTP_200_OK)
+        self.assertEqual(self.revalidate('/api/faqs/', faqs).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Stock changes skip post_save and, unless the product sells out, the catalog version
+        products = self.client.get('/api/products/')['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Product.take_stock(self.product.id, 1)
+        self.assertEqual(self.revalidate('/api/products/', products, queries=4).status_code, status.HTTP_200_OK)
+
+        self.faq.delete()
+        # version stamp + count; the page is empty
+        self.assertEqual(self.revalidate('/api/faqs/', faqs, queries=2).status_code, status.HTTP_200_OK)
+
+    @override_settings(INVENTORY_BACKEND='ledger')
+    def test_ledger_movements_change_the_catalog_etag(self):
+        etag = self.client.get('/api/products/')['ETag']
+        self.assertEqual(self.revalidate('/api/products/', etag, queries=2).status_code, status.HTTP_304_NOT_MODIFIED)
+        Product.take_stock(self.product.id, 1)
+        response = self.client.get('/api/products/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'][0]['stock'], 2)
+
+    def test_if_modified_since(self):
+        response = self.client.get('/api/faqs/')
+        response = self.client.get('/api/faqs/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_changes_in_the_current_second_have_no_last_modified(self):
+        last_modified = self.client.get('/api/faqs/')['Last-Modified']
+        FAQ.objects.create(question='¿Devoluciones?', answer='Sí', category=self.faq.category)
+        changed_at = DataVersion.stamp(DataVersion.FAQS)[1].timestamp()
+        with mock.patch('telegram_bot.conditional.time') as clock:
+            clock.time.return_value = changed_at
+            response = self.client.get('/api/faqs/')
+            self.assertFalse(response.has_header('Last-Modified'))
+            # A date in the second of the change cannot tell whether it came before or after it
+            response = self.client.get('/api/faqs/', HTTP_IF_MODIFIED_SINCE=http_date(changed_at))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get('/api/faqs/', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.revalidate('/api/faqs/', response['ETag']).status_code, status.HTTP_304_NOT_MODIFIED)
+
+
+class BotStateApiTests(APITestCase):
+    url = '/api/bot-state/'
+
+    def _write(self, *writes):
+        return self.client.post(self.url, {'writes': list(writes)}, format='json')
+
+    def test_batch_upserts_and_deletes(self):
+        BotStateEntry.objects.create(namespace='cancel_map', key='2', value={'1': 5})
+        with self.assertNumQueries(5):  # savepoint + select + delete + upsert + release
+            response = self._write(
+                {'namespace': 'cancel_map', 'key': '1', 'value': {'1': 10}},
+                {'namespace': 'cancel_map', 'key': '1', 'value': {'1': 11}},
+                {'namespace': 'cancel_map', 'key': '2', 'value': None},
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(f'{self.url}cancel_map/1/').data, {'value': {'1': 11}})
+        self.assertEqual(self.client.get(f'{self.url}cancel_map/2/').status_code, status.HTTP_404_NOT_FOUND)
+
+        self._write({'namespace': 'cancel_map', 'key': '1', 'value': {'1': 12}})
+        self.assertEqual(BotStateEntry.objects.get(key='1').value, {'1': 12})
+
+    def test_expired_entries_are_hidden_and_purged(self):
+        self._write(
+            {'namespace': 'cancel_map', 'key': '1', 'value': 1, 'expires_at': time.time() - 1},
+            {'namespace': 'cancel_map', 'key': '2', 'value': 2, 'expires_at': time.time() + 60},
+        )
+        self.assertEqual(self.client.get(f'{self.url}cancel_map/1/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get(f'{self.url}cancel_map/2/').data, {'value': 2})
+
+        response = self.client.post(f'{self.url}purge/')
+        self.assertEqual(response.data, {'purged': 1})
+        self.assertEqual(list(BotStateEntry.objects.values_list('key', flat=True)), ['2'])
+
+    def test_invalid_batch_is_rejected(self):
+        self.assertEqual(self._write({'namespace': 'cancel_map'}).status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post(self.url, {'nope': []}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BotIntentApiTests(APITestCase):
+    def test_lists_active_intents_by_priority(self):
+        BotIntent.objects.create(name='como_cancelar', priority=20, phrases=['cancelar pedido'], response='Usa /cancelar')
+        BotIntent.objects.create(name='mis_pedidos', priority=10, phrases=['mis pedidos'], action='orders')
+        BotIntent.objects.create(name='antigua', phrases=['vieja'], is_active=False)
+
+        response = self.client.get('/api/intents/', {'is_active': 'true'})
+
+        self.assertEqual([i['name'] for i in response.data['results']], ['mis_pedidos', 'como_cancelar'])
+        self.assertEqual(response.data['results'][0]['phrases'], ['mis pedidos'])
+
+    def test_phrases_must_be_a_list_of_strings(self):
+        response = self.client.post('/api/intents/', {'name': 'x', 'phrases': 'hola'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
@@ -12,8 +12,13 @@ router.register(r'orders', views.OrderViewSet)
 router.register(r'order-items', views.OrderItemViewSet)
 router.register(r'faq-categories', views.FAQCategoryViewSet)
 router.register(r'faqs', views.FAQViewSet)
+router.register(r'intents', views.BotIntentViewSet)
 
 urlpatterns = [
     path('api/', include(router.urls)),
+    path('api/bot-context/<str:telegram_id>/', views.bot_context, name='bot_context'),
+    path('api/bot-state/', views.bot_state_write, name='bot_state_write'),
+    path('api/bot-state/purge/', views.bot_state_purge, name='bot_state_purge'),
+    path('api/bot-state/<str:namespace>/<str:key>/', views.bot_state_entry, name='bot_state_entry'),
     path('reports/chatbot/', views.chatbot_report_view, name='chatbot_report'),
 ] 
\ No newline at end of file
@@ -3,11 +3,14 @@ from rest_framework import viewsets, filters, status
 from rest_framework.decorators import api_view, action
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
-from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Count, Avg
+from django_filters.rest_framework import DjangoFilterBackend, FilterSet, NumberFilter
+from django.db import transaction
+from django.db.models import Count, Avg, OuterRef, Prefetch, Q, Subquery
+from django.utils import timezone
 from django.contrib.admin.views.decorators import staff_member_required
 from django.http import HttpResponseForbidden
 import os
+import time
 import google.generativeai as genai
 import logging
 
@@ -15,34 +18,91 @@ logger = logging.getLogger(__name__)
 
 from .models import (
     Category, Product, User, Conversation, Message, 
-    ProductComparison, Order, OrderItem, FAQ, FAQCategory
+    ProductComparison, Order, OrderItem, FAQ, FAQCategory, DataVersion, BotStateEntry, BotIntent
 )
+from .conditional import CatalogConditionalGetMixin, VersionedConditionalGetMixin
+from .pagination import ConversationCursorPagination, MessageCursorPagination, OrderCursorPagination
 from .serializers import (
     CategorySerializer, ProductSerializer, UserSerializer, 
     ConversationSerializer, MessageSerializer, ProductComparisonSerializer,
-    OrderSerializer, OrderItemSerializer, FAQSerializer, FAQCategorySerializer
+    OrderSerializer, OrderItemSerializer, FAQSerializer, FAQCategorySerializer,
+    BulkMessageItemSerializer, ConversationSummarySerializer, BotStateWriteSerializer, BotIntentSerializer
 )
 
-class CategoryViewSet(viewsets.ModelViewSet):
+def conversation_memory(conversation, tail_size, max_pending=200):
+    """
+    Rolling summary of ``conversation`` plus its last ``tail_size`` messages and the
+    older messages not covered by the summary yet (``pending``, oldest first).
+    """
+    unsummarized = Message.objects.filter(conversation=conversation)
+    if conversation.summary_until:
+        unsummarized = unsummarized.filter(id__gt=conversation.summary_until)
+    tail = list(unsummarized.order_by('-id')[:tail_size])[::-1]
+    pending = []
+    if tail or not tail_size:
+        older = unsummarized.filter(id__lt=tail[0].id) if tail else unsummarized
+        pending = list(older.order_by('id')[:max_pending])
+    return {
+        "summary": conversation.summary,
+        "summary_until": conversation.summary_until,
+        "tail": MessageSerializer(tail, many=True).data,
+        "pending": MessageSerializer(pending, many=True).data,
+    }
+
+class CategoryViewSet(CatalogConditionalGetMixin, viewsets.ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     filter_backends = [filters.SearchFilter]
     search_fields = ['name']
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+class ProductFilter(FilterSet):
+    # The stock the API reports: with the ledger inventory ``Product.stock`` is only a snapshot
+    stock = NumberFilter(field_name='available_stock')
+
+    class Meta:
+        model = Product
+        fields = ['category', 'stock']
+
+class ProductViewSet(CatalogConditionalGetMixin, viewsets.ModelViewSet):
+    queryset = Product.objects.select_related('category')
     serializer_class = ProductSerializer
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
-    filterset_fields = ['category', 'stock']
+    filterset_class = ProductFilter
     search_fields = ['name', 'description']
     ordering_fields = ['price', 'name', 'created_at']
+
+    def get_queryset(self):
+        return super().get_queryset().with_available_stock()
     
     @action(detail=False, methods=['get'])
     def in_stock(self, request):
-        in_stock = Product.objects.filter(stock__gt=0)
+        return self.conditional(self._in_stock, request)
+
+    def _in_stock(self, request):
+        in_stock = self.get_queryset().filter(available_stock__gt=0)
         serializer = self.get_serializer(in_stock, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['post'])
+    def adjust_stock(self, request, pk=None):
+        """
+        Restocks (positive ``delta``) or adjusts a product's stock. With the ledger
+        inventory ``stock`` is read-only and this records a stock movement instead.
+        """
+        product = self.get_object()
+        try:
+            delta = int(request.data.get('delta'))
+            if not delta:
+                raise ValueError()
+        except (ValueError, TypeError):
+            return Response({"error": "A non-zero integer delta is required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        staff_user = request.user if request.user.is_authenticated else None
+        if not Product.adjust_stock(product.pk, delta, staff_user=staff_user):
+            return Response({"error": "Not enough stock available"}, status=status.HTTP_400_BAD_REQUEST)
+        serializer = self.get_serializer(self.get_queryset().get(pk=product.pk))
+        return Response(serializer.data)
+
     @action(detail=True, methods=['post'])
     def reserve(self, request, pk=None):
         """
@@ -74,30 +134,36 @@ class ProductViewSet(viewsets.ModelViewSet):
             }
         )
 
-        if product.stock < quantity:
-            return Response({"error": "Not enough stock available"}, status=status.HTTP_400_BAD_REQUEST)
-            
-        # Get or create a pending order for the user
-        order, _ = Order.objects.get_or_create(
-            user=user, 
-            status='pending',
-            defaults={'conversation': Conversation.objects.filter(user=user).last()}
-        )
-        
-        # Create or update the order item
-        OrderItem.objects.update_or_create(
-            order=order, 
-            product=product,
-            defaults={'quantity': quantity, 'price': product.price}
-        )
-        
-        # Update stock - this should be done carefully, ideally in a transaction
-        product.stock -= quantity
-        product.save()
+        with transaction.atomic():
+            # Serializes this user's reservations so they share one pending order;
+            # other users only contend on the product's stock below.
+            User.objects.select_for_update().get(pk=user.pk)
+            order = Order.objects.filter(user=user, status='pending').first()
+            item = None
+            if order is not None:
+                item = OrderItem.objects.select_for_update().filter(order=order, product=product).first()
+            # The item's quantity is replaced, so only the difference moves stock
+            delta = quantity - (item.quantity if item else 0)
 
-        # Recalculate order total
-        order.calculate_total()
-        
+            if order is None:
+                order = Order.objects.create(
+                    user=user, status='pending', conversation=Conversation.objects.filter(user=user).last()
+                )
+            # Saving the item moves the order total by the line's difference
+            if item is None:
+                OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+            else:
+                item.quantity, item.price = quantity, product.price
+                item.save(update_fields=['quantity', 'price'])
+
+            # Stock goes last: the product's lock is held only until the commit right after
+            if delta > 0 and not Product.take_stock(product.pk, delta, order_id=order.pk, user_id=user.pk):
+                transaction.set_rollback(True)
+                return Response({"error": "Not enough stock available"}, status=status.HTTP_400_BAD_REQUEST)
+            if delta < 0:
+                Product.restore_stock({product.pk: -delta}, order_id=order.pk, user_id=user.pk)
+
+        order.refresh_from_db(fields=['total_amount', 'updated_at'])
         serializer = OrderSerializer(order)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -109,10 +175,19 @@ class UserViewSet(viewsets.ModelViewSet):
     filterset_fields = ['telegram_id']
 
 class ConversationViewSet(viewsets.ModelViewSet):
-    queryset = Conversation.objects.all()
+    queryset = Conversation.objects.select_related('user')
     serializer_class = ConversationSerializer
-    filter_backends = [DjangoFilterBackend]
+    pagination_class = ConversationCursorPagination
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['user']
+    ordering_fields = ['start_time']
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action in ('list', 'retrieve'):
+            # Only the serializer embeds the messages; actions load what they need
+            queryset = queryset.prefetch_related('messages')
+        return queryset
     
     @action(detail=True, methods=['get'])
     def messages(self, request, pk=None):
@@ -121,17 +196,182 @@ class ConversationViewSet(viewsets.ModelViewSet):
         serializer = MessageSerializer(messages, many=True)
         return Response(serializer.data)
 
+    @action(detail=True, methods=['post'])
+    def summary(self, request, pk=None):
+        """
+        Stores a new rolling summary. It only applies if ``previous_until`` still
+        matches, so two bot workers summarizing at once cannot overwrite each other
+        (the loser gets 409).
+        """
+        serializer = ConversationSummarySerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        conversations = Conversation.objects.filter(pk=pk)
+        previous = data.get('previous_until')
+        current = conversations.filter(summary_until=previous) if previous else conversations.filter(summary_until__isnull=True)
+        updated = current.update(
+            summary=data['summary'], summary_until=data['until'], summary_updated_at=timezone.now()
+        )
+        if updated:
+            return Response({"summary": data['summary'], "summary_until": data['until']})
+        if not conversations.exists():
+            return Response({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"error": "The summary changed meanwhile"}, status=status.HTTP_409_CONFLICT)
+
 class MessageViewSet(viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
-    filter_backends = [DjangoFilterBackend]
+    pagination_class = MessageCursorPagination
+    filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
     filterset_fields = ['conversation', 'sender']
+    ordering_fields = ['timestamp']
+
+    # Maximum number of messages accepted by a single bulk request
+    BULK_MAX_MESSAGES = 1000
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        """
+        Creates many messages in one request, possibly for many users and conversations.
+
+        Each item gives either a ``conversation`` pk or a ``telegram_id``. Unknown users
+        are created, and items without a conversation go to the user's latest
+        conversation (created if the user has none). Everything is written with
+        ``bulk_create`` inside a single transaction, with a fixed number of queries
+        regardless of batch size. The response lists, in input order, the new message
+        id together with its conversation and user.
+
+        Items are validated one by one so a single bad item does not sink the batch:
+        an item whose ``conversation`` no longer exists falls back to its
+        ``telegram_id`` when it has one, and the items that still cannot be stored
+        are reported under ``errors`` by input index. The request only fails with
+        400 when no item is valid.
+        """
+        items = request.data.get('messages') if isinstance(request.data, dict) else request.data
+        if not isinstance(items, list) or not items:
+            return Response({"error": "A non-empty 'messages' list is required"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > self.BULK_MAX_MESSAGES:
+            return Response(
+                {"error": f"At most {self.BULK_MAX_MESSAGES} messages per request"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        rows, errors = [], []
+        for index, item in enumerate(items):
+            serializer = BulkMessageItemSerializer(data=item)
+            if serializer.is_valid():
+                rows.append((index, dict(serializer.validated_data)))
+            else:
+                errors.append({"index": index, "errors": serializer.errors})
+
+        with transaction.atomic():
+            # 1. Conversations given explicitly must exist; stale ones fall back to telegram_id
+            conv_ids = {row['conversation'] for _, row in rows if row.get('conversation')}
+            conv_users = dict(Conversation.objects.filter(pk__in=conv_ids).values_list('id', 'user_id'))
+            valid_rows = []
+            for index, row in rows:
+                if row.get('conversation') and row['conversation'] not in conv_users:
+                    if not row.get('telegram_id'):
+                        errors.append({
+                            "index": index,
+                            "errors": {"conversation": [f"Unknown conversation id {row['conversation']}"]},
+                        })
+                        continue
+                    del row['conversation']
+                valid_rows.append((index, row))
+            rows = valid_rows
+            errors.sort(key=lambda error: error['index'])
+            if not rows:
+                return Response(
+                    {"error": "No valid messages in the batch", "errors": errors},
+                    status=status.HTTP_400_BAD_REQUEST,
+                )
+
+            # 2. Resolve (or create) users by telegram_id
+            profiles = {}
+            for _, row in rows:
+                if not row.get('conversation'):
+                    profiles.setdefault(row['telegram_id'], row)
+            users = self._resolve_users(profiles)
+
+            # 3. Latest conversation per user, creating one where needed
+            latest = self._latest_conversations(users.values())
+
+            messages = []
+            for _, row in rows:
+                conversation_id = row.get('conversation') or latest[users[row['telegram_id']]]
+                message = Message(conversation_id=conversation_id, sender=row['sender'], content=row['content'])
+                if row.get('timestamp'):
+                    message.timestamp = row['timestamp']
+                messages.append(message)
+            Message.objects.bulk_create(messages)
+
+        conv_users.update({conv_id: user_id for user_id, conv_id in latest.items()})
+        results = [
+            {
+                "index": index,
+                "id": message.id,
+                "conversation": message.conversation_id,
+                "user": conv_users[message.conversation_id],
+            }
+            for (index, _), message in zip(rows, messages)
+        ]
+        logger.info(f"Ingesta masiva: {len(messages)} mensajes en {len({m.conversation_id for m in messages})} conversaciones")
+        if errors:
+            logger.warning(f"Ingesta masiva: {len(errors)} mensajes rechazados")
+        return Response({"results": results, "errors": errors}, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def _resolve_users(profiles):
+        """Returns ``{telegram_id: user_pk}``, creating the users that do not exist yet."""
+        if not profiles:
+            return {}
+        users = dict(User.objects.filter(telegram_id__in=profiles).values_list('telegram_id', 'id'))
+        new_ids = [telegram_id for telegram_id in profiles if telegram_id not in users]
+        if new_ids:
+            User.objects.bulk_create(
+                [
+                    User(
+                        telegram_id=telegram_id,
+                        username=profiles[telegram_id].get('username'),
+                        first_name=profiles[telegram_id].get('first_name'),
+                        last_name=profiles[telegram_id].get('last_name'),
+                    )
+                    for telegram_id in new_ids
+                ],
+                ignore_conflicts=True,  # another request may have created them concurrently
+            )
+            users.update(User.objects.filter(telegram_id__in=new_ids).values_list('telegram_id', 'id'))
+        return users
+
+    @staticmethod
+    def _latest_conversations(user_ids):
+        """Returns ``{user_pk: conversation_pk}`` with each user's latest conversation."""
+        user_ids = set(user_ids)
+        if not user_ids:
+            return {}
+        latest_conv = Conversation.objects.filter(user=OuterRef('pk')).order_by('-start_time', '-id').values('id')[:1]
+        latest = dict(
+            User.objects.filter(pk__in=user_ids)
+            .annotate(latest_conversation=Subquery(latest_conv))
+            .filter(latest_conversation__isnull=False)
+            .values_list('id', 'latest_conversation')
+        )
+        without = [user_id for user_id in user_ids if user_id not in latest]
+        if without:
+            created = Conversation.objects.bulk_create([Conversation(user_id=user_id) for user_id in without])
+            latest.update({conv.user_id: conv.id for conv in created})
+        return latest
 
 class OrderViewSet(viewsets.ModelViewSet):
-    queryset = Order.objects.all()
+    queryset = Order.objects.select_related('user').prefetch_related(
+        Prefetch('items', queryset=OrderItem.objects.select_related('product__category'))
+    )
     serializer_class = OrderSerializer
+    pagination_class = OrderCursorPagination
     filter_backends = [DjangoFilterBackend, filters.OrderingFilter]
-    filterset_fields = ['user', 'status']
+    filterset_fields = ['user', 'user__telegram_id', 'status']
     ordering_fields = ['created_at', 'total_amount']
     
     @action(detail=False, methods=['get'])
@@ -140,40 +380,51 @@ class OrderViewSet(viewsets.ModelViewSet):
         if not user_id:
             return Response({"error": "User ID is required"}, status=status.HTTP_400_BAD_REQUEST)
         
-        orders = Order.objects.filter(user__telegram_id=user_id).order_by('-created_at')
+        orders = self.get_queryset().filter(user__telegram_id=user_id).order_by('-created_at')
         serializer = self.get_serializer(orders, many=True)
         return Response(serializer.data)
     
     @action(detail=True, methods=['post'])
     def add_item(self, request, pk=None):
+        """Adds a product to the order or replaces its quantity, moving stock like ``reserve``."""
         order = self.get_object()
         
         product_id = request.data.get('product_id')
-        quantity = request.data.get('quantity', 1)
-        
         if not product_id:
             return Response({"error": "Product ID is required"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            quantity = int(request.data.get('quantity', 1))
+            if quantity <= 0:
+                raise ValueError()
+        except (ValueError, TypeError):
+            return Response({"error": "A valid positive integer quantity is required"}, status=status.HTTP_400_BAD_REQUEST)
         
         try:
             product = Product.objects.get(pk=product_id)
-        except Product.DoesNotExist:
+        except (Product.DoesNotExist, ValueError, TypeError):
             return Response({"error": "Product not found"}, status=status.HTTP_404_NOT_FOUND)
         
-        if product.stock < quantity:
-            return Response({"error": "Not enough stock available"}, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Crear o actualizar el item del pedido
-        order_item, created = OrderItem.objects.update_or_create(
-            order=order,
-            product=product,
-            defaults={'quantity': quantity, 'price': product.price}
-        )
-        
-        # Actualizar el monto total del pedido
-        order_items = OrderItem.objects.filter(order=order)
-        total_amount = sum(item.price * item.quantity for item in order_items)
-        order.total_amount = total_amount
-        order.save()
+        with transaction.atomic():
+            # Serializes changes to this order's items, as reserve does per user
+            if not Order.objects.select_for_update().filter(pk=order.pk).exists():
+                return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
+            order_item = OrderItem.objects.select_for_update().filter(order=order, product=product).first()
+            # The item's quantity is replaced, so only the difference moves stock
+            delta = quantity - (order_item.quantity if order_item else 0)
+
+            # Saving the item moves the order total by the line's difference
+            if order_item is None:
+                order_item = OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+            else:
+                order_item.quantity, order_item.price = quantity, product.price
+                order_item.save(update_fields=['quantity', 'price'])
+
+            # Stock goes last: the product's lock is held only until the commit right after
+            if delta > 0 and not Product.take_stock(product.pk, delta, order_id=order.pk, user_id=order.user_id):
+                transaction.set_rollback(True)
+                return Response({"error": "Not enough stock available"}, status=status.HTTP_400_BAD_REQUEST)
+            if delta < 0:
+                Product.restore_stock({product.pk: -delta}, order_id=order.pk, user_id=order.user_id)
         
         serializer = OrderItemSerializer(order_item)
         return Response(serializer.data)
@@ -183,65 +434,173 @@ class OrderViewSet(viewsets.ModelViewSet):
         """Cancela un pedido completo eliminándolo de la base de datos."""
         order = self.get_object()
         logger.info(f"Eliminando pedido {order.id} para usuario {order.user.telegram_id}")
-        
-        # Restaurar el stock de los productos
-        try:
-            for item in order.items.all():
-                product = item.product
-                product.stock += item.quantity
-                product.save()
-                logger.info(f"Stock restaurado para producto {product.id}: +{item.quantity} unidades")
-        except Exception as e:
-            logger.error(f"Error al restaurar stock en eliminación de pedido {order.id}: {e}")
-        
-        # Eliminar el pedido completamente
-        order.delete()
-        
+
+        with transaction.atomic():
+            # Bloquea el pedido: dos cancelaciones simultáneas no devuelven el stock dos veces
+            if not Order.objects.select_for_update().filter(pk=order.pk).exists():
+                return Response({"error": "Order not found"}, status=status.HTTP_404_NOT_FOUND)
+
+            # Restaurar el stock de todos los productos en una sola consulta
+            quantities = {}
+            for product_id, quantity in order.items.values_list('product_id', 'quantity'):
+                quantities[product_id] = quantities.get(product_id, 0) + quantity
+            Product.restore_stock(quantities, order_id=order.pk, user_id=order.user_id)
+            logger.info(f"Stock restaurado para {len(quantities)} productos del pedido {order.id}")
+
+            # Eliminar el pedido completamente
+            order.delete()
+
         logger.info(f"Pedido {pk} eliminado completamente de la base de datos")
         return Response({"status": "deleted", "message": "Pedido eliminado completamente"}, 
                         status=status.HTTP_204_NO_CONTENT)
 
 class OrderItemViewSet(viewsets.ModelViewSet):
-    queryset = OrderItem.objects.all()
+    queryset = OrderItem.objects.select_related('product__category')
     serializer_class = OrderItemSerializer
     
     def destroy(self, request, *args, **kwargs):
         """Elimina un item de pedido y actualiza el total del pedido."""
         item = self.get_object()
         order = item.order
-        product = item.product
-        quantity = item.quantity
-        
+
         logger.info(f"Eliminando item {item.id} del pedido {order.id}")
-        
-        # Restaurar el stock del producto
-        try:
-            product.stock += quantity
-            product.save()
-            logger.info(f"Stock restaurado para producto {product.id}: +{quantity} unidades")
-        except Exception as e:
-            logger.error(f"Error al restaurar stock: {e}")
-        
-        # Eliminar el item
-        item.delete()
-        
-        # Recalcular el total del pedido
-        order.calculate_total()
-        
-        logger.info(f"Item eliminado y pedido recalculado: {order.total_amount}")
+
+        with transaction.atomic():
+            # Se relee bloqueada: la cantidad a devolver es la vigente y solo se devuelve una vez
+            item = OrderItem.objects.select_for_update().filter(pk=item.pk).first()
+            if item is None:
+                return Response({"error": "Order item not found"}, status=status.HTTP_404_NOT_FOUND)
+
+            # Restaurar el stock del producto
+            Product.restore_stock({item.product_id: item.quantity}, order_id=order.pk, user_id=order.user_id)
+            logger.info(f"Stock restaurado para producto {item.product_id}: +{item.quantity} unidades")
+
+            # Eliminar el item (descuenta su importe del total del pedido)
+            item.delete()
+
+        logger.info(f"Item eliminado y total del pedido {order.id} actualizado")
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-class FAQCategoryViewSet(viewsets.ModelViewSet):
+class FAQCategoryViewSet(VersionedConditionalGetMixin, viewsets.ModelViewSet):
     queryset = FAQCategory.objects.all()
     serializer_class = FAQCategorySerializer
+    data_version = DataVersion.FAQS
 
-class FAQViewSet(viewsets.ModelViewSet):
-    queryset = FAQ.objects.all()
+class FAQViewSet(VersionedConditionalGetMixin, viewsets.ModelViewSet):
+    queryset = FAQ.objects.select_related('category')
     serializer_class = FAQSerializer
+    data_version = DataVersion.FAQS
     filter_backends = [DjangoFilterBackend, filters.SearchFilter]
     filterset_fields = ['category']
     search_fields = ['question', 'answer']
 
+class BotIntentViewSet(viewsets.ModelViewSet):
+    queryset = BotIntent.objects.order_by('priority', 'id')
+    serializer_class = BotIntentSerializer
+    filterset_fields = ['is_active']
+
+BOT_CONTEXT_MAX_MESSAGES = 50
+BOT_CONTEXT_INCLUDES = {'products', 'faqs'}
+
+@api_view(['GET'])
+def bot_context(request, telegram_id):
+    """
+    Everything the bot needs to answer one message, in one round trip.
+
+    Returns the user and active conversation pks, the conversation memory (rolling
+    summary, last ``messages`` messages and unsummarized older ones) and the
+    catalog/FAQ version stamps. ``include=products,faqs`` adds those data sets
+    inline. The number of SQL queries is fixed: conversation+user, user (only when
+    there is no conversation), two for the memory, one for the versions and one per
+    included data set.
+    """
+    try:
+        tail_size = min(max(int(request.query_params.get('messages', 6)), 0), BOT_CONTEXT_MAX_MESSAGES)
+    except ValueError:
+        return Response({"error": "messages must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+    includes = {part for part in request.query_params.get('include', '').split(',') if part}
+    unknown = includes - BOT_CONTEXT_INCLUDES
+    if unknown:
+        return Response({"error": f"Unknown include: {sorted(unknown)}"}, status=status.HTTP_400_BAD_REQUEST)
+
+    conversation = (
+        Conversation.objects.select_related('user')
+        .filter(user__telegram_id=str(telegram_id))
+        .order_by('-start_time', '-id')
+        .first()
+    )
+    if conversation is not None:
+        user_pk = conversation.user_id
+    else:
+        user_pk = User.objects.filter(telegram_id=str(telegram_id)).values_list('id', flat=True).first()
+
+    data = {
+        "user": user_pk,
+        "conversation": conversation.id if conversation else None,
+        "memory": conversation_memory(conversation, tail_size) if conversation else None,
+        "versions": DataVersion.current(DataVersion.CATALOG, DataVersion.FAQS),
+    }
+    if 'products' in includes:
+        data["products"] = ProductSerializer(
+            Product.objects.select_related('category').with_available_stock().order_by('id'), many=True
+        ).data
+    if 'faqs' in includes:
+        data["faqs"] = FAQSerializer(FAQ.objects.select_related('category').order_by('id'), many=True).data
+    return Response(data)
+
+@api_view(['POST'])
+def bot_state_write(request):
+    """
+    Applies a batch of bot state writes in one transaction: ``{"writes": [...]}``
+    where a null ``value`` deletes the entry. Repeated keys keep the last write.
+    The number of queries does not grow with the batch size.
+    """
+    items = request.data.get('writes') if isinstance(request.data, dict) else None
+    if not isinstance(items, list):
+        return Response({"error": "A 'writes' list is required"}, status=status.HTTP_400_BAD_REQUEST)
+    serializer = BotStateWriteSerializer(data=items, many=True)
+    serializer.is_valid(raise_exception=True)
+
+    writes = {(row['namespace'], row['key']): row for row in serializer.validated_data}
+    upserts = [
+        BotStateEntry(namespace=namespace, key=key, value=row['value'], expires_at=row.get('expires_at'))
+        for (namespace, key), row in writes.items() if row['value'] is not None
+    ]
+    deletes = Q()
+    for (namespace, key), row in writes.items():
+        if row['value'] is None:
+            deletes |= Q(namespace=namespace, key=key)
+    with transaction.atomic():
+        if deletes:
+            BotStateEntry.objects.filter(deletes).delete()
+        if upserts:
+            BotStateEntry.objects.bulk_create(
+                upserts,
+                update_conflicts=True,
+                unique_fields=['namespace', 'key'],
+                update_fields=['value', 'expires_at', 'updated_at'],
+            )
+    return Response({"written": len(writes)})
+
+@api_view(['GET'])
+def bot_state_entry(request, namespace, key):
+    """Returns ``{"value": ...}`` for a live entry, or 404 if it is missing or expired."""
+    entry = (
+        BotStateEntry.objects.filter(namespace=namespace, key=key)
+        .filter(Q(expires_at__isnull=True) | Q(expires_at__gt=time.time()))
+        .values_list('value', flat=True)
+        .first()
+    )
+    if entry is None:
+        return Response(status=status.HTTP_404_NOT_FOUND)
+    return Response({"value": entry})
+
+@api_view(['POST'])
+def bot_state_purge(request):
+    """Deletes the expired bot state entries and returns how many there were."""
+    purged, _ = BotStateEntry.objects.filter(expires_at__lte=time.time()).delete()
+    return Response({"purged": purged})
+
 def chatbot_report_view(request):
     """
     Vista de reporte del chatbot.